@@ -0,0 +1,155 @@
+"""
+Run a full `brbd-sync sync` end to end, against fake Baserow and Buttondown
+servers (see `fake_servers.py`) seeded with synthetic data (see
+`synthetic.py`), and report wall time and requests per second.
+
+Every run starts from freshly seeded servers. Use --latency to simulate the
+round trip to the real APIs, and --concurrency to compare how well we hide it.
+
+Usage:
+
+    python benchmarks/bench_end_to_end.py [--subscribers 10000] \\
+        [--mix '{"adds": 0.02}'] [--latency 0.02] [--page-size 100] \\
+        [--requests-per-second 100] [--concurrency 1 4 16] [--shards 1]
+
+With --shards, every shard runs in its own process (see `brbd-sync sync
+--shards`).
+"""
+
+import argparse
+import contextlib
+import os
+import time
+from typing import Any
+
+from fake_servers import FakeBaserow, FakeButtondown
+from synthetic import Mix, generate
+
+from brbd_sync import baserow as br
+from brbd_sync import buttondown as bd
+from brbd_sync.cli import main as cli_main
+from brbd_sync.serve import row_id_of
+from brbd_sync.util import group_by
+
+TABLE_ID = 1
+FIELD_TYPES = {
+    "Email": "email",
+    "Full Name": "text",
+    "Tags": "multiple_select",
+    "Sport": "text",
+}
+
+
+def seed_baserow(fake: FakeBaserow, data: br.Data):
+    subs_by_row_id = group_by(data.subscribers, lambda sub: row_id_of(sub.id))
+    for row_id, subs in subs_by_row_id.items():
+        fake.set_row(
+            row_id,
+            {
+                "Email": "; ".join(sub.email or "" for sub in subs),
+                "Full Name": subs[0].full_name,
+                "Tags": sorted(subs[0].tags),
+                "Sport": subs[0].metadata["Sport"],
+            },
+        )
+
+
+def seed_buttondown(fake: FakeButtondown, subscribers: list[bd.Subscriber]):
+    for sub in subscribers:
+        fake.add_subscriber(sub.email, sorted(sub.tags), sub.metadata)
+
+
+def run_one(args: argparse.Namespace, concurrency: int) -> dict[str, Any]:
+    baserow_data, buttondown_subscribers = generate(args.subscribers, args.mix)
+    server_options: dict[str, Any] = dict(
+        latency=args.latency, requests_per_second=args.requests_per_second
+    )
+
+    with (
+        FakeBaserow(
+            "baserow-key", TABLE_ID, FIELD_TYPES, **server_options
+        ) as fake_baserow,
+        FakeButtondown(
+            "buttondown-key", page_size=args.page_size, **server_options
+        ) as fake_buttondown,
+    ):
+        seed_baserow(fake_baserow, baserow_data)
+        seed_buttondown(fake_buttondown, buttondown_subscribers)
+
+        # The sync prints every operation. Don't let the terminal slow it down.
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            cli_main(
+                [
+                    "sync",
+                    "--no-dry-run",
+                    "--baserow-api-key=baserow-key",
+                    f"--baserow-table-id={TABLE_ID}",
+                    "--baserow-tags-column=Tags",
+                    "--baserow-metadata-column=Sport",
+                    f"--baserow-url={fake_baserow.url}",
+                    "--buttondown-api-key=buttondown-key",
+                    f"--buttondown-api-url={fake_buttondown.url}",
+                    f"--concurrency={concurrency}",
+                    f"--shards={args.shards}",
+                ],
+                standalone_mode=False,
+            )
+        seconds = time.perf_counter() - start
+
+        requests = fake_baserow.request_count + fake_buttondown.request_count
+        return {
+            "seconds": seconds,
+            "baserow_requests": fake_baserow.request_count,
+            "buttondown_requests": fake_buttondown.request_count,
+            "throttled": fake_baserow.throttled_count + fake_buttondown.throttled_count,
+            "requests_per_second": requests / seconds,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=10_000)
+    parser.add_argument(
+        "--mix",
+        type=Mix.model_validate_json,
+        default=Mix(),
+        help="JSON object overriding fields of synthetic.Mix",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="Seconds each request to either server takes",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=100,
+        help="The most subscribers the fake Buttondown returns per page",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=int,
+        default=None,
+        help="Rate limit each server to this many requests per second",
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--shards", type=int, default=1)
+    args = parser.parse_args()
+
+    print(
+        f"{args.subscribers} subscribers, {args.shards} shard(s), {args.latency * 1000:.0f}ms latency, mix: {args.mix!r}"
+    )
+    print(
+        f"{'concurrency':>12} {'wall (s)':>9} {'Baserow reqs':>13} {'Buttondown reqs':>16} {'throttled':>10} {'reqs/s':>8}"
+    )
+    for concurrency in args.concurrency:
+        result = run_one(args, concurrency)
+        print(
+            f"{concurrency:>12} {result['seconds']:>9.2f} {result['baserow_requests']:>13} {result['buttondown_requests']:>16} {result['throttled']:>10} {result['requests_per_second']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
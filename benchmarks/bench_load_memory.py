@@ -0,0 +1,136 @@
+"""
+Measure peak memory (RSS) of loading a large, synthetic Buttondown mailing
+list into `buttondown.Data`.
+
+Compares two strategies:
+
+  - list: collect every subscriber from the API into a list, convert that
+    into a second list, and only then build `buttondown.Data` (how we used to
+    load subscribers).
+  - stream: build `buttondown.Data` straight from the stream of subscribers
+    yielded by `Client.list_subscribers` (how we load subscribers now).
+
+Each strategy runs in its own subprocess so they don't pollute each other's
+peak RSS.
+
+Usage:
+
+    python benchmarks/bench_load_memory.py [--subscribers 500000]
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from urllib.parse import parse_qs, urlparse
+
+from brbd_sync import buttondown as bd
+from brbd_sync import buttondown_api as api
+
+
+class SyntheticClient(api.Client):
+    def __init__(self, subscriber_count: int):
+        super().__init__(api_key="bogus")
+        self._subscriber_count = subscriber_count
+
+    def get_bytes(self, path: str) -> bytes:
+        query = parse_qs(urlparse(path).query)
+        page = int(query["page"][0])
+        page_size = int(query["page_size"][0])
+
+        start = (page - 1) * page_size
+        end = min(start + page_size, self._subscriber_count)
+        has_next = end < self._subscriber_count
+        page_json = {
+            "results": [
+                {
+                    "type": "regular",
+                    "email_address": f"subscriber{i}@example.com",
+                    "tags": ["member", f"cohort-{i % 20}"],
+                    "metadata": {"id": str(i), "Full Name": f"Subscriber {i}"},
+                }
+                for i in range(start, end)
+            ],
+            "next": f"{api.BUTTONDOWN_API_URL}/v1/subscribers?page={page + 1}&page_size={page_size}"
+            if has_next
+            else None,
+            "count": self._subscriber_count,
+        }
+        return json.dumps(page_json).encode()
+
+
+def load_as_list(client: api.Client) -> bd.Data:
+    api_subs = list(client.list_subscribers())
+    subs = [
+        bd.Subscriber(
+            id=api_sub.metadata.get("id"),
+            email=api_sub.email_address,
+            tags=api_sub.tags,
+            metadata=api_sub.metadata,
+        )
+        for api_sub in api_subs
+    ]
+    return bd.Data(subscribers=subs, api_client=client)
+
+
+def load_as_stream(client: api.Client) -> bd.Data:
+    return bd.Data.load(client)
+
+
+STRATEGIES = {
+    "list": load_as_list,
+    "stream": load_as_stream,
+}
+
+
+def peak_rss_mib() -> float:
+    # On Linux, `ru_maxrss` is in KiB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_one(strategy: str, subscriber_count: int):
+    client = SyntheticClient(subscriber_count)
+    baseline = peak_rss_mib()
+
+    start = time.perf_counter()
+    data = STRATEGIES[strategy](client)
+    elapsed = time.perf_counter() - start
+
+    assert len(data.subscribers) == subscriber_count
+    print(f"{peak_rss_mib() - baseline:.1f} {elapsed:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=500_000)
+    parser.add_argument("--strategy", choices=STRATEGIES.keys())
+    args = parser.parse_args()
+
+    if args.strategy is not None:
+        run_one(args.strategy, args.subscribers)
+        return
+
+    print(f"Loading {args.subscribers} synthetic subscribers")
+    print(f"{'strategy':<10} {'peak RSS (MiB)':>16} {'time (s)':>10}")
+    for strategy in STRATEGIES:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--strategy",
+                strategy,
+                "--subscribers",
+                str(args.subscribers),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        rss, elapsed = output.split()
+        print(f"{strategy:<10} {float(rss):>16.1f} {float(elapsed):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
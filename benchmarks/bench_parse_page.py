@@ -0,0 +1,96 @@
+"""
+Measure how long it takes to turn one raw page of Buttondown subscribers
+(the bytes of the HTTP response) into `buttondown.Subscriber`s.
+
+Compares two strategies:
+
+  - dict: parse the bytes into Python dicts with `json.loads` (what
+    `response.json()` does), validate those with `ListSubscribersResponse`,
+    then convert each subscriber (how we used to parse pages).
+  - bytes: validate the bytes directly with
+    `ListSubscribersResponse.model_validate_json`, then convert each
+    subscriber (how we parse pages now).
+
+Usage:
+
+    python benchmarks/bench_parse_page.py [--page-sizes 100 1000]
+"""
+
+import argparse
+import json
+import timeit
+from typing import Callable
+
+from brbd_sync import buttondown as bd
+from brbd_sync import buttondown_api as api
+
+
+# Buttondown sends a lot more about each subscriber than we care about.
+def page_bytes(page_size: int) -> bytes:
+    return json.dumps(
+        {
+            "results": [
+                {
+                    "id": f"00000000-0000-0000-0000-{i:012}",
+                    "type": "regular",
+                    "email_address": f"subscriber{i}@example.com",
+                    "tags": ["member", f"cohort-{i % 20}"],
+                    "metadata": {"id": str(i), "Sport": "speedcubing"},
+                    "creation_date": "2024-01-01T00:00:00Z",
+                    "last_updated": "2024-06-01T00:00:00Z",
+                    "notes": "",
+                    "referrer_url": "",
+                    "secondary_id": i,
+                    "source": "api",
+                    "utm_campaign": "",
+                    "utm_medium": "",
+                    "utm_source": "",
+                    "subscriber_type": "regular",
+                }
+                for i in range(page_size)
+            ],
+            "next": "https://api.buttondown.com/v1/subscribers?page=2",
+            "count": 10 * page_size,
+        }
+    ).encode()
+
+
+def parse_via_dict(raw: bytes) -> list[bd.Subscriber]:
+    page = api.ListSubscribersResponse(**json.loads(raw))
+    return [bd.Subscriber.from_api(sub) for sub in page.results]
+
+
+def parse_via_bytes(raw: bytes) -> list[bd.Subscriber]:
+    page = api.ListSubscribersResponse.model_validate_json(raw)
+    return [bd.Subscriber.from_api(sub) for sub in page.results]
+
+
+STRATEGIES: dict[str, Callable[[bytes], list[bd.Subscriber]]] = {
+    "dict": parse_via_dict,
+    "bytes": parse_via_bytes,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[100, 1000])
+    args = parser.parse_args()
+
+    print(f"{'page size':>10} {'strategy':<10} {'per page (ms)':>14} {'speedup':>8}")
+    for page_size in args.page_sizes:
+        raw = page_bytes(page_size)
+        assert parse_via_dict(raw) == parse_via_bytes(raw)
+
+        baseline = None
+        for name, parse in STRATEGIES.items():
+            timer = timeit.Timer(lambda: parse(raw))
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat=5, number=number)) / number
+            baseline = baseline or best
+            print(
+                f"{page_size:>10} {name:<10} {best * 1000:>14.3f} {baseline / best:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
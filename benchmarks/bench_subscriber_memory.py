@@ -0,0 +1,120 @@
+"""
+Measure memory (RSS) and construction time of the in-memory subscriber
+indices the diff engine works on, for a large, synthetic mailing list.
+
+  - buttondown: `buttondown.Data`, built from subscribers as they come out of
+    the Buttondown API.
+  - baserow: `baserow.DataWithUniqueEmails`, built from subscribers as they
+    come out of Baserow.
+
+Each side runs in its own subprocess so they don't pollute each other's
+peak RSS.
+
+Usage:
+
+    python benchmarks/bench_subscriber_memory.py [--subscribers 500000]
+"""
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+from brbd_sync import baserow as br
+from brbd_sync import buttondown as bd
+from brbd_sync import buttondown_api as api
+
+# A realistic amount of variety: a handful of tag combinations, shared by
+# many subscribers.
+TAGS = [[], ["member"], ["member", "volunteer"], ["alumni"]]
+
+
+def build_buttondown(n: int) -> Any:
+    api_subs = (
+        api.Subscriber(
+            id=f"bd-{i}",
+            type="regular",
+            email_address=f"subscriber{i}@example.com",
+            tags=set(TAGS[i % len(TAGS)]),
+            metadata={"id": str(i), "Sport": "speedcubing"},
+        )
+        for i in range(n)
+    )
+    return bd.Data(
+        subscribers=(bd.Subscriber.from_api(api_sub) for api_sub in api_subs),
+        api_client=api.Client(api_key="bogus"),
+    )
+
+
+def build_baserow(n: int) -> Any:
+    subs = (
+        br.Subscriber(
+            id=str(i),
+            email=f"subscriber{i}@example.com",
+            tags=set(TAGS[i % len(TAGS)]),
+            metadata={"Sport": "speedcubing"},
+            **{"Full Name": f"Subscriber {i}"},
+        )
+        for i in range(n)
+    )
+    return br.DataWithUniqueEmails(
+        subscribers=(br.SubscriberWithEmail.from_subscriber(sub) for sub in subs)
+    )
+
+
+SIDES: dict[str, Callable[[int], Any]] = {
+    "buttondown": build_buttondown,
+    "baserow": build_baserow,
+}
+
+
+def rss_mib() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def run_one(side: str, subscriber_count: int):
+    baseline = rss_mib()
+
+    start = time.perf_counter()
+    data = SIDES[side](subscriber_count)
+    elapsed = time.perf_counter() - start
+
+    assert len(data.subscribers) == subscriber_count
+    print(f"{rss_mib() - baseline:.1f} {elapsed:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=500_000)
+    parser.add_argument("--side", choices=SIDES.keys())
+    args = parser.parse_args()
+
+    if args.side is not None:
+        run_one(args.side, args.subscribers)
+        return
+
+    print(f"Building indices for {args.subscribers} synthetic subscribers")
+    print(f"{'side':<12} {'retained RSS (MiB)':>20} {'time (s)':>10}")
+    for side in SIDES:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--side",
+                side,
+                "--subscribers",
+                str(args.subscribers),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        rss, elapsed = output.split()
+        print(f"{side:<12} {float(rss):>20.1f} {float(elapsed):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Time the sync engine on synthetic data of various sizes, and record peak
+memory. See `synthetic.py` for how the data is generated.
+
+For each size, this times:
+
+  - dedupe: `baserow.Data.with_no_duplicate_emails`
+  - index: building `buttondown.Data`
+  - plan: `sync.plan`
+  - sync: a full dry-run `sync.sync`
+
+Each size runs in its own subprocess so they don't pollute each other's peak
+RSS.
+
+Results can be written to a JSON file with --output, and compared against an
+earlier run with --baseline. Any metric that got worse by more than
+--threshold (as a fraction) is a regression, and makes this exit non-zero.
+
+Usage:
+
+    python benchmarks/bench_sync.py [--sizes 1000 10000 100000 1000000] \\
+        [--mix '{"adds": 0.02}'] [--output results.json] \\
+        [--baseline old-results.json] [--threshold 0.25]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from synthetic import Mix, generate
+
+from brbd_sync import buttondown as bd
+from brbd_sync import buttondown_api as api
+from brbd_sync.sync import plan, sync
+
+# Timings this short are mostly noise, so they never count as regressions.
+MIN_SECONDS = 0.01
+
+
+def peak_rss_mib() -> float:
+    # On Linux, `ru_maxrss` is in KiB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_one(size: int, mix: Mix) -> dict[str, float]:
+    baserow_data, buttondown_subscribers = generate(size, mix)
+
+    start = time.perf_counter()
+    baserow_data.with_no_duplicate_emails()
+    dedupe = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buttondown_data = bd.Data(
+        subscribers=buttondown_subscribers, api_client=api.Client(api_key="bogus")
+    )
+    index = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan(baserow_data, buttondown_data)
+    plan_seconds = time.perf_counter() - start
+
+    # `sync` prints every operation. Don't let the terminal slow it down.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        sync(baserow_data, buttondown_data, dry_run=True)
+        sync_seconds = time.perf_counter() - start
+
+    return {
+        "dedupe_seconds": dedupe,
+        "index_seconds": index,
+        "plan_seconds": plan_seconds,
+        "sync_seconds": sync_seconds,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+# Returns a description of each regression.
+def compare(
+    baseline: dict[str, dict[str, float]],
+    results: dict[str, dict[str, float]],
+    threshold: float,
+) -> list[str]:
+    regressions: list[str] = []
+    for size, metrics in results.items():
+        for metric, value in metrics.items():
+            old_value = baseline.get(size, {}).get(metric)
+            if old_value is None:
+                continue
+
+            if metric.endswith("_seconds") and max(old_value, value) < MIN_SECONDS:
+                continue
+
+            if value > old_value * (1 + threshold):
+                regressions.append(
+                    f"{size} subscribers: {metric} went from {old_value:.3f} to {value:.3f} (+{value / old_value - 1:.0%})"
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--mix",
+        type=Mix.model_validate_json,
+        default=Mix(),
+        help="JSON object overriding fields of synthetic.Mix",
+    )
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        (size,) = args.sizes
+        print(json.dumps(run_one(size, args.mix)))
+        return
+
+    print(f"Mix: {args.mix!r}")
+    print(
+        f"{'subscribers':>12} {'dedupe (s)':>11} {'index (s)':>10} {'plan (s)':>9} {'sync (s)':>9} {'peak RSS (MiB)':>15}"
+    )
+    results: dict[str, dict[str, float]] = {}
+    for size in args.sizes:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--one",
+                "--sizes",
+                str(size),
+                "--mix",
+                args.mix.model_dump_json(),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        metrics = results[str(size)] = json.loads(output)
+        print(
+            f"{size:>12} {metrics['dedupe_seconds']:>11.3f} {metrics['index_seconds']:>10.3f} {metrics['plan_seconds']:>9.3f} {metrics['sync_seconds']:>9.3f} {metrics['peak_rss_mib']:>15.1f}"
+        )
+
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps({"mix": args.mix.model_dump(), "results": results}, indent=2)
+            + "\n"
+        )
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline["mix"] != args.mix.model_dump():
+            print("Warning: the baseline was run with a different mix")
+
+        regressions = compare(baseline["results"], results, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+        print(f"No regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,522 @@
+import gzip
+import json
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Self
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# In-process stand-ins for the Buttondown and Baserow APIs, so the code that
+# talks to them can be tested and benchmarked without the internet. They only
+# implement the parts of each API that brbd-sync (and `baserowapi`) use.
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    # Only the first value of each query parameter.
+    query: dict[str, str]
+    body: Any
+
+
+@dataclass
+class Response:
+    status: int
+    body: Any = None
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+def error(status: HTTPStatus, detail: str, **extra: str) -> Response:
+    return Response(status, {"detail": detail, **extra})
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeServer:
+    # Every request sleeps for `latency` seconds before being handled.
+    # Listings return at most `page_size` items per page. More than
+    # `requests_per_second` requests in any one second get a 429, telling the
+    # client to retry after `retry_after` seconds.
+    def __init__(
+        self,
+        api_key: str,
+        latency: float = 0.0,
+        page_size: int = 100,
+        requests_per_second: int | None = None,
+        retry_after: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.api_key = api_key
+        self.latency = latency
+        self.page_size = page_size
+        self.requests_per_second = requests_per_second
+        self.retry_after = retry_after
+        self._clock = clock
+
+        self.requests_by_method: Counter[str] = Counter()
+        self.throttled_count = 0
+
+        # All state is guarded by this lock, so handling a request is atomic.
+        # Latency is simulated outside of it, so slow requests still overlap.
+        self._lock = threading.Lock()
+        self._recent_request_times: deque[float] = deque()
+        # Each with whether to handle the request before failing.
+        self._injected_failures: deque[tuple[Response, bool]] = deque()
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        # Poll often, so shutting down is quick.
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.01}
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    @property
+    def request_count(self) -> int:
+        return self.requests_by_method.total()
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    # Respond to the next `count` requests with `status` (and `body`), no
+    # matter what they are. With `after_handling`, the requests are handled
+    # first anyway, as if the real response got lost on its way back.
+    def fail_next(
+        self,
+        status: HTTPStatus,
+        body: Any = None,
+        count: int = 1,
+        after_handling: bool = False,
+    ):
+        headers = {}
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            headers["Retry-After"] = str(self.retry_after)
+
+        with self._lock:
+            for _ in range(count):
+                self._injected_failures.append(
+                    (Response(status, body, headers), after_handling)
+                )
+
+    def handle(self, request: Request) -> Response:
+        raise NotImplementedError()  # pragma: no cover (duh)
+
+    def _respond(self, request: Request, authorization: str | None) -> Response:
+        time.sleep(self.latency)
+
+        with self._lock:
+            self.requests_by_method[request.method] += 1
+
+            if authorization != f"Token {self.api_key}":
+                return error(HTTPStatus.UNAUTHORIZED, "Invalid token.")
+
+            if self._is_throttled():
+                self.throttled_count += 1
+                response = error(HTTPStatus.TOO_MANY_REQUESTS, "Slow down.")
+                response.headers["Retry-After"] = str(self.retry_after)
+                return response
+
+            if len(self._injected_failures) > 0:
+                failure, after_handling = self._injected_failures.popleft()
+                if after_handling:
+                    self.handle(request)
+                return failure
+
+            return self.handle(request)
+
+    def _is_throttled(self) -> bool:
+        if self.requests_per_second is None:
+            return False
+
+        now = self._clock()
+        while (
+            len(self._recent_request_times) > 0
+            and self._recent_request_times[0] <= now - 1
+        ):
+            self._recent_request_times.popleft()
+
+        if len(self._recent_request_times) >= self.requests_per_second:
+            return True
+
+        self._recent_request_times.append(now)
+        return False
+
+    # The requested page of `items`, its number and size, and whether there
+    # are more pages after it.
+    def _page(
+        self, items: list[Any], request: Request, page_size_param: str
+    ) -> tuple[list[Any], int, int, bool]:
+        page = int(request.query.get("page", "1"))
+        page_size = min(
+            int(request.query.get(page_size_param, self.page_size)), self.page_size
+        )
+        start = (page - 1) * page_size
+        has_next = start + page_size < len(items)
+        return items[start : start + page_size], page, page_size, has_next
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive, like the real APIs do.
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def do_PATCH(self):
+                self._handle()
+
+            def do_DELETE(self):
+                self._handle()
+
+            def _handle(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                raw_body = self.rfile.read(length)
+                request = Request(
+                    method=self.command,
+                    path=url.path,
+                    query={k: v[0] for k, v in parse_qs(url.query).items()},
+                    body=json.loads(raw_body) if raw_body else None,
+                )
+                response = fake._respond(request, self.headers.get("Authorization"))
+
+                payload = (
+                    b"" if response.body is None else json.dumps(response.body).encode()
+                )
+                # Like the real APIs, compress responses for clients that
+                # accept it. Not empty ones, though: a 204 has no body, so
+                # the client wouldn't read it.
+                compress = bool(payload) and "gzip" in self.headers.get(
+                    "Accept-Encoding", ""
+                )
+                if compress:
+                    payload = gzip.compress(payload)
+                self.send_response(response.status)
+                self.send_header("Content-Type", "application/json")
+                if compress:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in response.headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format: str, *args: Any):
+                pass
+
+        return Handler
+
+
+# See https://docs.buttondown.com/api-introduction.
+class FakeButtondown(FakeServer):
+    def __init__(self, api_key: str, **kwargs: Any):
+        super().__init__(api_key, **kwargs)
+        # Keyed by Buttondown id, in the order they were created.
+        self.subscribers: dict[str, dict[str, Any]] = {}
+        self._id_by_email: dict[str, str] = {}
+        # Tag name -> tag id.
+        self.tags: dict[str, str] = {}
+        self.bulk_actions: list[dict[str, Any]] = []
+        self._next_id = 0
+
+    def add_subscriber(
+        self, email: str, tags: list[str] = [], metadata: dict[str, str] = {}
+    ) -> dict[str, Any]:
+        with self._lock:
+            return self._add_subscriber(email, tags, metadata)
+
+    def _new_id(self) -> str:
+        self._next_id += 1
+        return str(uuid.UUID(int=self._next_id))
+
+    def _add_subscriber(
+        self, email: str, tags: list[str], metadata: dict[str, str]
+    ) -> dict[str, Any]:
+        now = now_iso()
+        sub = {
+            "id": self._new_id(),
+            "type": "regular",
+            "email_address": email,
+            "tags": sorted(tags),
+            "metadata": dict(metadata),
+            "creation_date": now,
+            "last_updated": now,
+        }
+        self.subscribers[sub["id"]] = sub
+        self._id_by_email[email] = sub["id"]
+        return sub
+
+    def _delete_subscriber(self, sub: dict[str, Any]):
+        del self.subscribers[sub["id"]]
+        del self._id_by_email[sub["email_address"]]
+
+    # The API accepts either a subscriber's id or their email.
+    def _find(self, id_or_email: str) -> dict[str, Any] | None:
+        id = self._id_by_email.get(id_or_email, id_or_email)
+        return self.subscribers.get(id)
+
+    def _validate_email(self, email: str, existing_id: str | None) -> Response | None:
+        if "@" not in email:
+            return error(
+                HTTPStatus.BAD_REQUEST, f"{email!r} is invalid.", code="email_invalid"
+            )
+
+        other = self._find(email)
+        if other is not None and other["id"] != existing_id:
+            return error(
+                HTTPStatus.BAD_REQUEST,
+                f"{email!r} is already subscribed.",
+                code="email_already_exists",
+            )
+
+        return None
+
+    def handle(self, request: Request) -> Response:
+        match request.method, request.path.strip("/").split("/"):
+            case "GET", ["v1", "subscribers"]:
+                return self._list_subscribers(request)
+            case "POST", ["v1", "subscribers"]:
+                return self._create_subscriber(request.body)
+            case method, ["v1", "subscribers", id_or_email]:
+                sub = self._find(id_or_email)
+                if sub is None:
+                    return error(HTTPStatus.NOT_FOUND, "Not found.")
+                return self._subscriber(method, sub, request.body)
+            case "GET", ["v1", "tags"]:
+                tags = [{"id": id, "name": name} for name, id in self.tags.items()]
+                results, page, page_size, has_next = self._page(
+                    tags, request, "page_size"
+                )
+                return self._list_response(
+                    "/v1/tags", results, page, page_size, has_next, len(tags)
+                )
+            case "POST", ["v1", "tags"]:
+                name = request.body["name"]
+                self.tags.setdefault(name, self._new_id())
+                return Response(
+                    HTTPStatus.CREATED, {"id": self.tags[name], "name": name}
+                )
+            case "POST", ["v1", "bulk_actions"]:
+                return self._bulk_action(request.body)
+            case _:
+                return error(HTTPStatus.NOT_FOUND, "Not found.")
+
+    def _list_response(
+        self,
+        path: str,
+        results: list[Any],
+        page: int,
+        page_size: int,
+        has_next: bool,
+        count: int,
+        filters: dict[str, str] = {},
+    ) -> Response:
+        next = None
+        if has_next:
+            query = urlencode({**filters, "page": page + 1, "page_size": page_size})
+            next = f"{self.url}{path}?{query}"
+
+        return Response(
+            HTTPStatus.OK, {"results": results, "next": next, "count": count}
+        )
+
+    def _list_subscribers(self, request: Request) -> Response:
+        filters: dict[str, str] = {}
+        subs = list(self.subscribers.values())
+
+        updated_since = request.query.get("last_updated__start")
+        if updated_since is not None:
+            filters["last_updated__start"] = updated_since
+            since = datetime.fromisoformat(updated_since)
+            subs = [
+                s for s in subs if datetime.fromisoformat(s["last_updated"]) >= since
+            ]
+
+        results, page, page_size, has_next = self._page(subs, request, "page_size")
+        return self._list_response(
+            "/v1/subscribers", results, page, page_size, has_next, len(subs), filters
+        )
+
+    def _create_subscriber(self, body: dict[str, Any]) -> Response:
+        invalid = self._validate_email(body["email_address"], existing_id=None)
+        if invalid is not None:
+            return invalid
+
+        sub = self._add_subscriber(
+            body["email_address"], body.get("tags", []), body.get("metadata", {})
+        )
+        return Response(HTTPStatus.CREATED, sub)
+
+    def _subscriber(self, method: str, sub: dict[str, Any], body: Any) -> Response:
+        match method:
+            case "PATCH":
+                email = body.get("email_address")
+                if email is not None:
+                    invalid = self._validate_email(email, existing_id=sub["id"])
+                    if invalid is not None:
+                        return invalid
+                    del self._id_by_email[sub["email_address"]]
+                    self._id_by_email[email] = sub["id"]
+                    sub["email_address"] = email
+
+                if "tags" in body:
+                    sub["tags"] = sorted(body["tags"])
+                if "metadata" in body:
+                    sub["metadata"] = body["metadata"]
+                sub["last_updated"] = now_iso()
+                return Response(HTTPStatus.OK, sub)
+            case "DELETE":
+                self._delete_subscriber(sub)
+                return Response(HTTPStatus.NO_CONTENT)
+            case _:
+                return Response(HTTPStatus.OK, sub)
+
+    # The real API runs bulk actions in the background. We do them right away.
+    def _bulk_action(self, body: dict[str, Any]) -> Response:
+        self.bulk_actions.append(body)
+        metadata = body["metadata"]
+        subs = [
+            self.subscribers[id] for id in metadata["ids"] if id in self.subscribers
+        ]
+
+        match body["type"]:
+            case "delete_subscribers":
+                for sub in subs:
+                    self._delete_subscriber(sub)
+            case "apply_tags":
+                tag_name = next(
+                    name for name, id in self.tags.items() if id == metadata["tag"]
+                )
+                for sub in subs:
+                    tags = set(sub["tags"])
+                    if metadata["action"] == "add":
+                        tags.add(tag_name)
+                    else:
+                        tags.discard(tag_name)
+                    sub["tags"] = sorted(tags)
+                    sub["last_updated"] = now_iso()
+            case _:
+                return error(HTTPStatus.BAD_REQUEST, f"Unknown type {body['type']!r}.")
+
+        return Response(HTTPStatus.CREATED, {"id": self._new_id(), **body})
+
+
+# See https://api.baserow.io/api/redoc/. This serves a single table, and is
+# read only: brbd-sync never writes to Baserow.
+class FakeBaserow(FakeServer):
+    def __init__(
+        self,
+        api_key: str,
+        table_id: int,
+        field_types: dict[str, str],
+        page_size: int = 200,
+        **kwargs: Any,
+    ):
+        super().__init__(api_key, page_size=page_size, **kwargs)
+        self.table_id = table_id
+        # Field name -> Baserow field type (e.g. "text", "multiple_select").
+        self.field_types = field_types
+        # Keyed by row id, as the API returns them (with user field names).
+        self.rows: dict[int, dict[str, Any]] = {}
+
+    # Values are keyed by field name. Values of "multiple_select" fields are
+    # lists of option names.
+    def set_row(self, id: int, values: dict[str, Any]):
+        row: dict[str, Any] = {"id": id, "order": f"{id}.00000000000000000000"}
+        for name, type in self.field_types.items():
+            value = values.get(name)
+            match type:
+                case "multiple_select":
+                    value = [
+                        {"id": 0, "value": v, "color": "blue"} for v in value or []
+                    ]
+                case "last_modified":
+                    value = now_iso()
+                case _:
+                    value = "" if value is None else value
+            row[name] = value
+
+        with self._lock:
+            self.rows[id] = row
+
+    def delete_row(self, id: int):
+        with self._lock:
+            del self.rows[id]
+
+    def _fields(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "id": id,
+                "table_id": self.table_id,
+                "name": name,
+                "order": id,
+                "type": type,
+                "primary": id == 0,
+                "read_only": type == "last_modified",
+                "select_options": [],
+            }
+            for id, (name, type) in enumerate(self.field_types.items())
+        ]
+
+    def handle(self, request: Request) -> Response:
+        table_id = str(self.table_id)
+        match request.method, request.path.strip("/").split("/"):
+            case "GET", ["api", "database", "fields", "table", id] if id == table_id:
+                return Response(HTTPStatus.OK, self._fields())
+            case "GET", ["api", "database", "rows", "table", id] if id == table_id:
+                return self._list_rows(request)
+            case "GET", ["api", "database", "rows", "table", id, row_id] if (
+                id == table_id
+            ):
+                row = self.rows.get(int(row_id))
+                if row is None:
+                    return error(HTTPStatus.NOT_FOUND, "The row does not exist.")
+                return Response(HTTPStatus.OK, row)
+            case _:
+                return error(HTTPStatus.NOT_FOUND, "Not found.")
+
+    # Filters are ignored, which is allowed of a fake: callers must cope with
+    # extra rows anyway.
+    def _list_rows(self, request: Request) -> Response:
+        if request.query.get("user_field_names") != "true":
+            return error(HTTPStatus.BAD_REQUEST, "Only user_field_names is supported.")
+
+        rows = list(self.rows.values())
+        include = request.query.get("include")
+        if include is not None:
+            names = {"id", "order", *include.split(",")}
+            rows = [{k: v for k, v in row.items() if k in names} for row in rows]
+
+        results, page, page_size, has_next = self._page(rows, request, "size")
+        next = None
+        if has_next:
+            query = urlencode({**request.query, "page": page + 1, "size": page_size})
+            next = f"{self.url}{request.path}?{query}"
+
+        return Response(
+            HTTPStatus.OK,
+            {"count": len(rows), "next": next, "previous": None, "results": results},
+        )
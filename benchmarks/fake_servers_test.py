@@ -0,0 +1,281 @@
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+
+import pytest
+import requests
+from fake_servers import FakeBaserow, FakeButtondown, Request, Response
+
+from brbd_sync import baserow as br
+from brbd_sync import buttondown_api as api
+
+
+def test_buttondown_lists_subscribers_in_pages():
+    with FakeButtondown("key", page_size=2) as fake:
+        for i in range(5):
+            fake.add_subscriber(
+                f"{i}@example.com", tags=["b", "a"], metadata={"id": str(i)}
+            )
+
+        for page_prefetch in [1, 3]:
+            client = api.Client("key", base_url=fake.url, page_prefetch=page_prefetch)
+            subs = list(client.list_subscribers())
+            assert [sub.email_address for sub in subs] == [
+                f"{i}@example.com" for i in range(5)
+            ]
+            assert subs[0].tags == {"a", "b"}
+            assert subs[0].metadata == {"id": "0"}
+
+        # Three pages, twice.
+        assert fake.requests_by_method == {"GET": 6}
+
+
+def test_buttondown_list_changes_while_paging():
+    # Someone gets deleted right after we fetch the first page, so everyone
+    # after them moves up a spot.
+    class ShrinkingButtondown(FakeButtondown):
+        def handle(self, request: Request) -> Response:
+            response = super().handle(request)
+            if request.query.get("page") == "1" and "0@example.com" in {
+                sub["email_address"] for sub in self.subscribers.values()
+            }:
+                self._delete_subscriber(next(iter(self.subscribers.values())))
+            return response
+
+    with ShrinkingButtondown("key", page_size=2) as fake:
+        for i in range(5):
+            fake.add_subscriber(f"{i}@example.com")
+
+        client = api.Client("key", base_url=fake.url, page_prefetch=3)
+        assert sorted(sub.email_address for sub in client.list_subscribers()) == [
+            f"{i}@example.com" for i in range(5)
+        ]
+        # Three pages, then the two pages that are left, again.
+        assert fake.requests_by_method == {"GET": 5}
+
+
+def test_buttondown_lists_subscribers_updated_since():
+    with FakeButtondown("key") as fake:
+        fake.add_subscriber("old@example.com")
+        time.sleep(0.01)
+        cutoff = datetime.now(timezone.utc)
+        fake.add_subscriber("new@example.com")
+
+        client = api.Client("key", base_url=fake.url)
+        assert [sub.email_address for sub in client.list_subscribers(cutoff)] == [
+            "new@example.com"
+        ]
+
+
+def test_buttondown_operations():
+    with FakeButtondown("key") as fake:
+        client = api.Client("key", base_url=fake.url)
+
+        api.AddSub(email="a@example.com", tags={"x"}, metadata={"id": "1"}).doit(client)
+        (sub,) = fake.subscribers.values()
+        assert client.get_subscriber(sub["id"]) == api.Subscriber(
+            id=sub["id"],
+            type="regular",
+            email_address="a@example.com",
+            tags={"x"},
+            metadata={"id": "1"},
+        )
+
+        api.EditSub(
+            old_email="a@example.com", new_email="b@example.com", tags={"y"}
+        ).doit(client)
+        assert sub["email_address"] == "b@example.com"
+        assert sub["tags"] == ["y"]
+
+        api.EditSub(old_email="b@example.com", metadata={"id": "2"}).doit(client)
+        assert sub["metadata"] == {"id": "2"}
+
+        api.DeleteSub(email="b@example.com").doit(client)
+        assert fake.subscribers == {}
+        assert client.get_subscriber(sub["id"]) is None
+
+
+def test_buttondown_errors():
+    with FakeButtondown("key", retry_after=0) as fake:
+        client = api.Client("key", base_url=fake.url)
+        fake.add_subscriber("taken@example.com")
+
+        with pytest.raises(api.SkippableEmailError):
+            api.AddSub(email="nope", tags=set(), metadata={}).doit(client)
+
+        with pytest.raises(api.SkippableEmailError):
+            api.EditSub(old_email="taken@example.com", new_email="nope").doit(client)
+
+        with pytest.raises(requests.HTTPError):
+            api.AddSub(email="taken@example.com", tags=set(), metadata={}).doit(client)
+
+        fake.fail_next(HTTPStatus.UNPROCESSABLE_ENTITY, {"code": "whatever"})
+        with pytest.raises(api.SkippableEmailError):
+            api.AddSub(email="a@example.com", tags=set(), metadata={}).doit(client)
+
+        # We retry after a 429.
+        fake.fail_next(HTTPStatus.TOO_MANY_REQUESTS)
+        api.AddSub(email="a@example.com", tags=set(), metadata={}).doit(client)
+        assert client.request_stats().throttled == 1
+
+        # A delete that went through even though we got a 502 is retried, and
+        # the 404 from the retry means it's done.
+        fake.add_subscriber("gone@example.com")
+        fake.fail_next(HTTPStatus.BAD_GATEWAY, after_handling=True)
+        api.DeleteSub(email="gone@example.com").doit(client)
+        assert client.request_stats().retried == 2
+        assert "gone@example.com" not in {
+            sub["email_address"] for sub in fake.subscribers.values()
+        }
+
+        # Without a retry, a 404 is still an error.
+        with pytest.raises(requests.HTTPError):
+            api.DeleteSub(email="gone@example.com").doit(client)
+
+        fake.fail_next(HTTPStatus.BAD_REQUEST, {"code": "whatever"})
+        with pytest.raises(requests.HTTPError):
+            api.EditSub(old_email="taken@example.com", tags={"colby"}).doit(client)
+
+        with pytest.raises(requests.HTTPError):
+            api.Client("wrong", base_url=fake.url).get("/v1/subscribers")
+
+        with pytest.raises(requests.HTTPError):
+            api.Client("wrong", base_url=fake.url).get_subscriber("nope")
+
+        with pytest.raises(requests.HTTPError):
+            client.get("/v1/nope")
+
+
+def test_buttondown_connection_errors(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(api, "backoff", lambda attempt: 0)
+    failures: list[requests.ConnectionError] = []
+    request = requests.Session.request
+
+    def flaky_request(self: requests.Session, *args, **kwargs):
+        if len(failures) > 0:
+            raise failures.pop()
+        return request(self, *args, **kwargs)
+
+    monkeypatch.setattr(requests.Session, "request", flaky_request)
+
+    with FakeButtondown("key") as fake:
+        client = api.Client("key", base_url=fake.url)
+
+        # Safe to retry.
+        failures.append(requests.ConnectionError("Connection reset"))
+        assert client.get("/v1/subscribers")["count"] == 0
+        assert client.request_stats().retried == 1
+
+        # The subscriber may or may not have been created, so we can't retry.
+        failures.append(requests.ConnectionError("Connection reset"))
+        with pytest.raises(requests.ConnectionError):
+            api.AddSub(email="a@example.com", tags=set(), metadata={}).doit(client)
+        assert fake.requests_by_method.get("POST") is None
+
+
+def test_buttondown_bulk_actions():
+    with FakeButtondown("key", page_size=1) as fake:
+        client = api.Client("key", base_url=fake.url)
+        a = fake.add_subscriber("a@example.com", tags=["old"])
+        b = fake.add_subscriber("b@example.com", tags=["old"])
+        c = fake.add_subscriber("c@example.com")
+        fake.tags = {"old": "old-id", "unused": "unused-id"}
+
+        api.BulkEditTags(
+            emails=["a@example.com", "b@example.com"],
+            buttondown_ids=[a["id"], b["id"]],
+            add_tags={"new"},
+            remove_tags={"old", "never-existed"},
+        ).doit(client)
+        assert a["tags"] == b["tags"] == ["new"]
+        assert set(fake.tags) == {"old", "unused", "new"}
+
+        api.BulkDeleteSubs(
+            emails=["a@example.com", "c@example.com"],
+            buttondown_ids=[a["id"], c["id"]],
+        ).doit(client)
+        assert list(fake.subscribers) == [b["id"]]
+
+        with pytest.raises(requests.HTTPError):
+            client.bulk_action("explode", {"ids": []})
+
+
+def test_rate_limit():
+    now = 0.0
+    with FakeButtondown(
+        "key", requests_per_second=2, retry_after=7, clock=lambda: now
+    ) as fake:
+
+        def get() -> requests.Response:
+            headers = {"Authorization": "Token key"}
+            return requests.get(f"{fake.url}/v1/subscribers", headers=headers)
+
+        assert get().status_code == 200
+        now = 0.5
+        assert get().status_code == 200
+
+        response = get()
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "7"
+
+        # The first request is now over a second ago.
+        now = 1.0
+        assert get().status_code == 200
+        assert get().status_code == 429
+
+        assert fake.throttled_count == 2
+        assert fake.request_count == 5
+
+
+def test_latency():
+    with FakeButtondown("key", latency=0.05) as fake:
+        start = time.perf_counter()
+        api.Client("key", base_url=fake.url).get("/v1/subscribers")
+        assert time.perf_counter() - start >= 0.05
+
+
+def test_baserow():
+    with FakeBaserow(
+        "key",
+        table_id=42,
+        field_types={
+            "Email": "email",
+            "Full Name": "text",
+            "Tags": "multiple_select",
+            "Sport": "text",
+            "Last modified": "last_modified",
+        },
+        page_size=2,
+    ) as fake:
+        fake.set_row(1, {"Email": "a@example.com", "Full Name": "A", "Tags": ["x"]})
+        fake.set_row(2, {"Email": "b@example.com; c@example.com", "Full Name": "B"})
+        fake.set_row(3, {"Full Name": "No email"})
+        fake.set_row(4, {"Email": "gone@example.com", "Full Name": "Gone"})
+        fake.delete_row(4)
+
+        data = br.Data.load(
+            api_key="key",
+            table_id=42,
+            tags_column_names=["Tags"],
+            metadata_column_names=["Sport"],
+            url=fake.url,
+        )
+        assert [(sub.id, sub.email, sub.tags) for sub in data.subscribers] == [
+            ("1", "a@example.com", {"x"}),
+            ("2-1", "b@example.com", set()),
+            ("2-2", "c@example.com", set()),
+        ]
+
+        table = br.get_table("key", 42, url=fake.url)
+        assert table.get_row(2)["Full Name"] == "B"
+        assert [
+            row.id for row in table.row_generator(include=["Last modified"], size=200)
+        ] == [1, 2, 3]
+
+        def get(path: str) -> int:
+            headers = {"Authorization": "Token key"}
+            return requests.get(fake.url + path, headers=headers).status_code
+
+        assert get("/api/database/rows/table/42/4/") == 404
+        assert get("/api/database/rows/table/42/") == 400
+        assert get("/api/database/rows/table/43/") == 404
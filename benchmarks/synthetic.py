@@ -0,0 +1,121 @@
+import random
+
+from pydantic import BaseModel
+
+from brbd_sync import baserow as br
+from brbd_sync import buttondown as bd
+
+# A realistic amount of variety: a handful of tag combinations, shared by
+# many subscribers.
+TAGS = [set(), {"member"}, {"member", "volunteer"}, {"alumni"}]
+
+
+# What fraction of subscribers fall into each scenario. Everyone else is
+# already in sync.
+class Mix(BaseModel):
+    # In Baserow, but not yet in Buttondown.
+    adds: float = 0.01
+    # In Buttondown, but no longer in Baserow. This is a fraction of the
+    # Baserow rows, added on top of them.
+    deletes: float = 0.01
+    # Different tags in Baserow and Buttondown.
+    edits: float = 0.05
+    # Pairs of rows whose emails were swapped in Baserow.
+    email_swaps: float = 0.005
+    # Rows that have the same email as another row.
+    duplicate_emails: float = 0.001
+    # Rows with two emails.
+    multi_email_rows: float = 0.01
+
+
+def email_address(i: int) -> str:
+    return f"subscriber{i}@example.com"
+
+
+# Generate a Baserow table with `row_count` rows, and a Buttondown mailing
+# list that differs from it according to `mix`. The same arguments always
+# generate the same data.
+def generate(
+    row_count: int, mix: Mix = Mix(), seed: int = 0
+) -> tuple[br.Data, list[bd.Subscriber]]:
+    rng = random.Random(seed)
+
+    # Carve the rows up into consecutive ranges, one per scenario.
+    scenarios: list[str] = []
+    first_row_by_scenario: dict[str, int] = {}
+    for scenario, fraction in [
+        ("add", mix.adds),
+        ("edit", mix.edits),
+        ("swap", mix.email_swaps),
+        ("duplicate", mix.duplicate_emails),
+        ("multi_email", mix.multi_email_rows),
+    ]:
+        count = round(fraction * row_count)
+        # Swaps come in pairs.
+        if scenario == "swap":
+            count -= count % 2
+        first_row_by_scenario[scenario] = len(scenarios)
+        scenarios.extend([scenario] * count)
+    assert len(scenarios) <= row_count, f"The fractions in {mix} add up to over 1"
+    scenarios.extend(["in_sync"] * (row_count - len(scenarios)))
+
+    baserow_subscribers: list[br.Subscriber] = []
+    buttondown_subscribers: list[bd.Subscriber] = []
+
+    def add_to_baserow(id: str, email: str, tags: set[str]):
+        baserow_subscribers.append(
+            br.Subscriber(
+                id=id,
+                email=email,
+                tags=tags,
+                metadata={"Sport": "speedcubing"},
+                **{"Full Name": f"Subscriber {id}"},
+            )
+        )
+
+    def add_to_buttondown(id: str, email: str, tags: set[str]):
+        buttondown_subscribers.append(
+            bd.Subscriber(
+                id=id,
+                email=email,
+                tags=frozenset(tags),
+                metadata={"id": id, "Sport": "speedcubing"},
+            )
+        )
+
+    for i, scenario in enumerate(scenarios):
+        id = str(i)
+        tags = TAGS[i % len(TAGS)]
+        match scenario:
+            case "add":
+                add_to_baserow(id, email_address(i), tags)
+            case "edit":
+                add_to_baserow(id, email_address(i), tags)
+                add_to_buttondown(id, email_address(i), tags ^ {"stale"})
+            case "swap":
+                # Even rows swap with the row after them, odd rows with the
+                # row before them.
+                if (i - first_row_by_scenario["swap"]) % 2 == 0:
+                    other = i + 1
+                else:
+                    other = i - 1
+                add_to_baserow(id, email_address(other), tags)
+                add_to_buttondown(id, email_address(i), tags)
+            case "duplicate":
+                other = i - 1 if i > 0 else row_count - 1
+                add_to_baserow(id, email_address(other), tags)
+                add_to_buttondown(id, email_address(i), tags)
+            case "multi_email":
+                add_to_baserow(f"{i}-1", email_address(i), tags)
+                add_to_baserow(f"{i}-2", f"alt-{email_address(i)}", tags)
+                add_to_buttondown(id, email_address(i), tags)
+            case _:
+                add_to_baserow(id, email_address(i), tags)
+                add_to_buttondown(id, email_address(i), tags)
+
+    for i in range(row_count, row_count + round(mix.deletes * row_count)):
+        add_to_buttondown(str(i), email_address(i), TAGS[i % len(TAGS)])
+
+    rng.shuffle(baserow_subscribers)
+    rng.shuffle(buttondown_subscribers)
+    return br.Data(subscribers=baserow_subscribers), buttondown_subscribers
@@ -0,0 +1,65 @@
+from synthetic import Mix, email_address, generate
+
+from brbd_sync.buttondown_api import AddSub, DeleteSub, EditSub
+from brbd_sync.sync import plan
+from brbd_sync.sync_test import ml
+
+
+def test_generate_is_deterministic():
+    assert generate(100, seed=1) == generate(100, seed=1)
+    assert generate(100, seed=1) != generate(100, seed=2)
+
+
+def test_generate_in_sync():
+    baserow_data, buttondown_subscribers = generate(
+        10, Mix(**dict.fromkeys(Mix.model_fields, 0))
+    )
+    assert len(baserow_data.subscribers) == 10
+    assert plan(baserow_data, ml(buttondown_subscribers)).operations == []
+
+
+def test_generate():
+    mix = Mix(
+        adds=0.1,
+        deletes=0.1,
+        edits=0.1,
+        email_swaps=0.2,
+        duplicate_emails=0.1,
+        multi_email_rows=0.1,
+    )
+    baserow_data, buttondown_subscribers = generate(10, mix)
+    the_plan = plan(baserow_data, ml(buttondown_subscribers))
+
+    # Row 0 is an add, row 1 an edit, rows 2 and 3 swapped emails, row 4 is
+    # a duplicate of row 3, row 5 has two emails, and row 10 is a delete.
+    assert the_plan.warnings == [
+        f"Unexpectedly found multiple Baserow rows with email={email_address(3)!r}. I picked the one with id='2'"
+    ]
+    assert the_plan.operations == [
+        AddSub(
+            email=email_address(0),
+            tags=set(),
+            metadata={"id": "0", "Sport": "speedcubing"},
+        ),
+        EditSub(old_email=email_address(1), tags={"member"}),
+        DeleteSub(email=email_address(10)),
+        DeleteSub(email=email_address(3)),
+        EditSub(old_email=email_address(2), new_email=email_address(3)),
+        AddSub(
+            email=email_address(2),
+            tags={"alumni"},
+            metadata={"id": "3", "Sport": "speedcubing"},
+        ),
+        DeleteSub(email=email_address(4)),
+        DeleteSub(email=email_address(5)),
+        AddSub(
+            email=email_address(5),
+            tags={"member"},
+            metadata={"id": "5-1", "Sport": "speedcubing"},
+        ),
+        AddSub(
+            email=f"alt-{email_address(5)}",
+            tags={"member"},
+            metadata={"id": "5-2", "Sport": "speedcubing"},
+        ),
+    ]
@@ -1,9 +1,19 @@
-from typing import Any, Callable, Self
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Iterable, Self
 
-from baserowapi import Baserow
+from baserowapi import Baserow, Filter, Row, Table
 from pydantic import BaseModel, Field
 
-from brbd_sync.util import unique_group_by
+from brbd_sync.metrics import Metrics
+from brbd_sync.util import (
+    ChangedIds,
+    group_by,
+    intern_keys,
+    intern_tags,
+    write_atomically,
+)
 
 
 def assert_not_none[V](v: V | None) -> V:
@@ -14,42 +24,64 @@ def assert_not_none[V](v: V | None) -> V:
 class Subscriber(BaseModel):
     id: str
     email: str | None
-    tags: set[str]
+    # Interned, like `buttondown.Subscriber.tags`: there are only a handful of
+    # different tag sets, shared between everyone on both sides.
+    tags: frozenset[str]
     metadata: dict[str, str]
     full_name: str = Field(alias="Full Name")
 
     def model_post_init(self, context: Any):
+        self.tags = intern_tags(self.tags)
         self.metadata["id"] = self.id
         if self.email == "":
             self.email = None
 
 
-class SubscriberWithEmail(BaseModel):
+# What the diff engine needs to know about a Baserow subscriber. Like
+# `buttondown.Subscriber`, this is kept as small as possible.
+@dataclass(slots=True)
+class SubscriberWithEmail:
     id: str
     email: str
-    tags: set[str]
+    tags: frozenset[str]
     metadata: dict[str, str]
-    full_name: str
 
+    def __post_init__(self):
+        self.tags = intern_tags(self.tags)
+        self.metadata = intern_keys(self.metadata)
 
-def group_by[K, V](arr: list[V], key: Callable[[V], K]) -> dict[K, list[V]]:
-    result: dict[K, list[V]] = {}
-    for v in arr:
-        k = key(v)
-        if k not in result:
-            result[k] = []
+    @classmethod
+    def from_subscriber(cls, sub: Subscriber) -> Self:
+        return cls(
+            id=sub.id,
+            email=assert_not_none(sub.email),
+            tags=sub.tags,
+            metadata=sub.metadata,
+        )
 
-        result[k].append(v)
 
-    return result
+class DataWithUniqueEmails:
+    def __init__(self, subscribers: Iterable[SubscriberWithEmail]):
+        self._subscriber_by_id: dict[str, SubscriberWithEmail] = {}
+        self._subscriber_by_email: dict[str, SubscriberWithEmail] = {}
+        for sub in subscribers:
+            self.add(sub)
 
+    @property
+    def subscribers(self) -> list[SubscriberWithEmail]:
+        return list(self._subscriber_by_id.values())
 
-class DataWithUniqueEmails(BaseModel):
-    subscribers: list[SubscriberWithEmail]
+    def add(self, sub: SubscriberWithEmail):
+        assert sub.id not in self._subscriber_by_id, f"Id {sub.id} already exists."
+        assert sub.email not in self._subscriber_by_email, (
+            f"Email {sub.email} already exists."
+        )
+        self._subscriber_by_id[sub.id] = sub
+        self._subscriber_by_email[sub.email] = sub
 
-    def model_post_init(self, context: Any):
-        self._subscriber_by_id = unique_group_by(self.subscribers, lambda s: s.id)
-        self._subscriber_by_email = unique_group_by(self.subscribers, lambda s: s.email)
+    def delete(self, id: str):
+        sub = self._subscriber_by_id.pop(id)
+        del self._subscriber_by_email[sub.email]
 
     def get_subscriber(
         self, *, id: str | None = None, email: str | None = None
@@ -65,8 +97,15 @@ class DataWithUniqueEmails(BaseModel):
             assert False, "Must query for something"  # pragma: no cover
 
 
+BASEROW_URL = "https://api.baserow.io"
+
+
 class Data(BaseModel):
     subscribers: list[Subscriber]
+    # Set by `load_incrementally`: when the snapshot written alongside this
+    # was taken, and (if there was a snapshot before it) what changed since.
+    snapshot_taken_at: datetime | None = None
+    changes: ChangedIds | None = None
 
     def with_no_duplicate_emails(self) -> tuple[list[str], DataWithUniqueEmails]:
         baserow_sub_by_email: dict[str, Subscriber] = {}
@@ -92,13 +131,7 @@ class Data(BaseModel):
             dupe_emails,
             DataWithUniqueEmails(
                 subscribers=[
-                    SubscriberWithEmail(
-                        id=s.id,
-                        email=assert_not_none(s.email),
-                        tags=s.tags,
-                        metadata=s.metadata,
-                        full_name=s.full_name,
-                    )
+                    SubscriberWithEmail.from_subscriber(s)
                     for s in baserow_sub_by_email.values()
                 ]
             ),
@@ -111,44 +144,305 @@ class Data(BaseModel):
         table_id: int,
         tags_column_names: list[str],
         metadata_column_names: list[str],
-    ) -> Self:  # pragma: no cover (requires internet)
-        baserow = Baserow(url="https://api.baserow.io", token=api_key)
-        table = baserow.get_table(table_id)
+        url: str = BASEROW_URL,
+        metrics: Metrics | None = None,
+    ) -> Self:
+        table = get_table(api_key, table_id, url=url, metrics=metrics)
 
         subscribers: list[Subscriber] = []
-        for row in table.row_generator():
-            assert row.id is not None, f"Unexpectedly found a row with a None id? {row}"
+        for row in table.row_generator(
+            include=subscriber_fields(tags_column_names, metadata_column_names),
+            size=PAGE_SIZE,
+        ):
+            subscribers.extend(
+                subscribers_from_row(row, tags_column_names, metadata_column_names)
+            )
+
+        return cls(subscribers=subscribers)
+
+    # Like `load`, but keeps a snapshot of the table in `snapshot_path`, and
+    # only fetches rows that were created or modified since the previous
+    # snapshot (according to `last_modified_column_name`, which should be a
+    # Baserow "Last modified" field).
+    @classmethod
+    def load_incrementally(
+        cls,
+        api_key: str,
+        table_id: int,
+        tags_column_names: list[str],
+        metadata_column_names: list[str],
+        last_modified_column_name: str,
+        snapshot_path: Path,
+        full_refresh_interval: timedelta,
+        url: str = BASEROW_URL,
+        metrics: Metrics | None = None,
+    ) -> Self:
+        now = datetime.now(timezone.utc)
+        previous = Snapshot.read(snapshot_path)
+        if previous is not None and not previous.is_usable(
+            now=now,
+            full_refresh_interval=full_refresh_interval,
+            tags_column_names=tags_column_names,
+            metadata_column_names=metadata_column_names,
+            last_modified_column_name=last_modified_column_name,
+        ):
+            previous = None
+
+        snapshot = Snapshot.load(
+            get_table(api_key, table_id, url=url, metrics=metrics),
+            tags_column_names=tags_column_names,
+            metadata_column_names=metadata_column_names,
+            last_modified_column_name=last_modified_column_name,
+            previous=previous,
+            now=now,
+        )
+        snapshot.write(snapshot_path)
+
+        return cls(
+            subscribers=snapshot.subscribers(),
+            snapshot_taken_at=snapshot.taken_at,
+            changes=None
+            if previous is None
+            else ChangedIds(
+                since=previous.taken_at, ids=snapshot.changed_subscriber_ids(previous)
+            ),
+        )
+
+
+# The largest page size Baserow allows when listing rows.
+PAGE_SIZE = 200
+
+# The Baserow filter for "this date field is on or after the given day".
+DATE_ON_OR_AFTER_FILTER = "date_is_on_or_after"
+
+
+def get_table(
+    api_key: str, table_id: int, url: str = BASEROW_URL, metrics: Metrics | None = None
+) -> Table:
+    baserow = Baserow(url=url.removesuffix("/"), token=api_key)
+    if metrics is not None:
+        metrics.instrument(baserow.session, "baserow")
+    return baserow.get_table(table_id)
+
+
+# The fields `subscribers_from_row` needs. Tables tend to have plenty of
+# others (long text, files, ...), so we only ask Baserow for these.
+def subscriber_fields(
+    tags_column_names: list[str], metadata_column_names: list[str]
+) -> list[str]:
+    return list(
+        dict.fromkeys(
+            ["Email", "Full Name", *tags_column_names, *metadata_column_names]
+        )
+    )
+
+
+def subscribers_from_row(
+    row: Row, tags_column_names: list[str], metadata_column_names: list[str]
+) -> list[Subscriber]:
+    assert row.id is not None, f"Unexpectedly found a row with a None id? {row}"
+
+    tags = set(
+        tag for tags_column_name in tags_column_names for tag in row[tags_column_name]
+    )
+
+    metadata = {
+        metadata_key: row[metadata_key] for metadata_key in metadata_column_names
+    }
+
+    joined_emails = row["Email"]
 
-            tags = set(
-                tag
-                for tags_column_name in tags_column_names
-                for tag in row[tags_column_name]
+    # Ignore people with no email.
+    if joined_emails == "":
+        return []
+
+    emails = [email.strip() for email in joined_emails.split(";")]
+
+    subscribers: list[Subscriber] = []
+    for n, email in enumerate(emails):
+        unique_id = str(row.id)
+        if len(emails) > 1:
+            unique_id += f"-{n + 1}"
+        br_sub = Subscriber(
+            **{"Full Name": row["Full Name"]},
+            tags=tags,
+            email=email,
+            metadata=metadata,
+            id=unique_id,
+        )
+        subscribers.append(br_sub)
+
+    return subscribers
+
+
+class SnapshotRow(BaseModel):
+    last_modified: str | None
+    subscribers: list[Subscriber]
+
+
+# The subscribers in every row of the Baserow table, as of a previous run.
+class Snapshot(BaseModel):
+    taken_at: datetime
+    # Changes that don't touch a row's "Last modified" field (for example, a
+    # lookup field whose linked row changed) are invisible to an incremental
+    # load, so every so often we re-fetch everything.
+    last_full_refresh_at: datetime
+    tags_column_names: list[str]
+    metadata_column_names: list[str]
+    last_modified_column_name: str
+    rows: dict[int, SnapshotRow]
+
+    def subscribers(self) -> list[Subscriber]:
+        return [sub for row in self.rows.values() for sub in row.subscribers]
+
+    def is_usable(
+        self,
+        now: datetime,
+        full_refresh_interval: timedelta,
+        tags_column_names: list[str],
+        metadata_column_names: list[str],
+        last_modified_column_name: str,
+    ) -> bool:
+        return (
+            now - self.last_full_refresh_at < full_refresh_interval
+            # The CLI passes tuples.
+            and self.tags_column_names == list(tags_column_names)
+            and self.metadata_column_names == list(metadata_column_names)
+            and self.last_modified_column_name == last_modified_column_name
+        )
+
+    # The rows that are new or have been modified, given the current "Last
+    # modified" value of every row in the table.
+    def changed_row_ids(self, last_modified_by_id: dict[int, str | None]) -> set[int]:
+        return {
+            id
+            for id, last_modified in last_modified_by_id.items()
+            if id not in self.rows or self.rows[id].last_modified != last_modified
+        }
+
+    # The rows of the table now: rows that no longer exist are dropped, and
+    # changed rows are replaced.
+    def merge(
+        self,
+        last_modified_by_id: dict[int, str | None],
+        changed_rows: dict[int, SnapshotRow],
+    ) -> dict[int, SnapshotRow]:
+        return {
+            id: changed_rows[id] if id in changed_rows else self.rows[id]
+            for id in last_modified_by_id
+        }
+
+    # The ids of everyone who may have changed since `previous`: the
+    # subscribers in rows that were added, modified or deleted, and anyone
+    # sharing an email with one of them (as that decides who gets to keep a
+    # duplicate email, see `Data.with_no_duplicate_emails`).
+    def changed_subscriber_ids(self, previous: Self) -> set[str]:
+        last_modified_by_id = {id: row.last_modified for id, row in self.rows.items()}
+        changed_row_ids = previous.changed_row_ids(last_modified_by_id) | (
+            previous.rows.keys() - self.rows.keys()
+        )
+        changed_subscribers = [
+            sub
+            for snapshot in [previous, self]
+            for id in changed_row_ids
+            if id in snapshot.rows
+            for sub in snapshot.rows[id].subscribers
+        ]
+        emails = {sub.email for sub in changed_subscribers if sub.email is not None}
+        return {sub.id for sub in changed_subscribers} | {
+            sub.id for sub in self.subscribers() if sub.email in emails
+        }
+
+    @classmethod
+    def load(
+        cls,
+        table: Table,
+        tags_column_names: list[str],
+        metadata_column_names: list[str],
+        last_modified_column_name: str,
+        previous: Self | None,
+        now: datetime,
+    ) -> Self:
+        def snapshot_row(row: Row) -> SnapshotRow:
+            return SnapshotRow(
+                last_modified=row[last_modified_column_name],
+                subscribers=subscribers_from_row(
+                    row, tags_column_names, metadata_column_names
+                ),
             )
 
-            metadata = {
-                metadata_key: row[metadata_key]
-                for metadata_key in metadata_column_names
-            }
+        include = [
+            *subscriber_fields(tags_column_names, metadata_column_names),
+            last_modified_column_name,
+        ]
+
+        def snapshot(rows: dict[int, SnapshotRow], last_full_refresh_at: datetime):
+            return cls(
+                taken_at=now,
+                last_full_refresh_at=last_full_refresh_at,
+                tags_column_names=tags_column_names,
+                metadata_column_names=metadata_column_names,
+                last_modified_column_name=last_modified_column_name,
+                rows=rows,
+            )
 
-            joined_emails = row["Email"]
+        if previous is None:
+            rows = {
+                assert_not_none(row.id): snapshot_row(row)
+                for row in table.row_generator(include=include, size=PAGE_SIZE)
+            }
+            return snapshot(rows, last_full_refresh_at=now)
+
+        # First, a cheap listing of just the id and "Last modified" value of
+        # every row. This tells us which rows were deleted, added, or changed.
+        last_modified_by_id: dict[int, str | None] = {
+            assert_not_none(row.id): row[last_modified_column_name]
+            for row in table.row_generator(
+                include=[last_modified_column_name], size=PAGE_SIZE
+            )
+        }
+        changed_ids = previous.changed_row_ids(last_modified_by_id)
+        changed_rows: dict[int, SnapshotRow] = {}
+
+        # Then, fetch all the rows that changed on or after the day of the
+        # oldest change.
+        changed_timestamps = [
+            last_modified
+            for id in changed_ids
+            if (last_modified := last_modified_by_id[id]) is not None
+        ]
+        if len(changed_timestamps) > 0:
+            since = datetime.fromisoformat(min(changed_timestamps)).astimezone(
+                timezone.utc
+            )
+            date_filter = Filter(
+                last_modified_column_name,
+                f"UTC?{since.date().isoformat()}?exact_date",
+                operator=DATE_ON_OR_AFTER_FILTER,
+            )
+            for row in table.row_generator(
+                include=include, filters=[date_filter], size=PAGE_SIZE
+            ):
+                if row.id in changed_ids:
+                    changed_rows[row.id] = snapshot_row(row)
+
+        # Anything that slipped through the filter (for example, rows with no
+        # "Last modified" value), we fetch one by one.
+        for id in changed_ids - changed_rows.keys():
+            changed_rows[id] = snapshot_row(table.get_row(id))
+
+        return snapshot(
+            previous.merge(last_modified_by_id, changed_rows),
+            last_full_refresh_at=previous.last_full_refresh_at,
+        )
 
-            # Ignore people with no email.
-            if joined_emails == "":
-                continue
+    @classmethod
+    def read(cls, path: Path) -> Self | None:
+        if not path.exists():
+            return None
 
-            emails = [email.strip() for email in joined_emails.split(";")]
-
-            for n, email in enumerate(emails):
-                unique_id = str(row.id)
-                if len(emails) > 1:
-                    unique_id += f"-{n + 1}"
-                br_sub = Subscriber(
-                    **row.to_dict(),
-                    tags=tags,
-                    email=email,
-                    metadata=metadata,
-                    id=unique_id,
-                )
-                subscribers.append(br_sub)
+        return cls.model_validate_json(path.read_bytes())
 
-        return cls(subscribers=subscribers)
+    def write(self, path: Path):
+        # `Subscriber` is validated using its aliases, so dump it with them too.
+        write_atomically(path, self.model_dump_json(by_alias=True))
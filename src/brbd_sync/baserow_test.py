@@ -0,0 +1,266 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any
+
+from fake_servers import FakeBaserow
+
+from . import baserow as br
+from .baserow import (
+    Snapshot,
+    SnapshotRow,
+    Subscriber,
+    subscriber_fields,
+    subscribers_from_row,
+)
+from .metrics import Metrics
+from .sync_test import bd_sub
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeRow:
+    def __init__(self, id: int, **values: Any):
+        self.id = id
+        self._values = values
+
+    def __getitem__(self, key: str) -> Any:
+        return self._values[key]
+
+
+def row(id: int, email: str, **values: Any) -> FakeRow:
+    return FakeRow(
+        id,
+        **{
+            "Email": email,
+            "Full Name": "Jeremy",
+            "Cheeses": [],
+            "Sport": "speedcubing",
+            **values,
+        },
+    )
+
+
+def sub(id: str, email: str, tags: set[str] = set()) -> Subscriber:
+    return Subscriber(
+        id=id,
+        email=email,
+        tags=tags,
+        metadata={"Sport": "speedcubing"},
+        **{"Full Name": "Jeremy"},
+    )
+
+
+def from_row(row: FakeRow) -> list[Subscriber]:
+    return subscribers_from_row(
+        row,  # type: ignore
+        tags_column_names=["Cheeses"],
+        metadata_column_names=["Sport"],
+    )
+
+
+def test_tags_are_shared():
+    tags = sub("1", "j1@example.com", tags={"colby", "gouda"}).tags
+    assert sub("2", "j2@example.com", tags={"gouda", "colby"}).tags is tags
+    # With Buttondown, too.
+    assert bd_sub(id="3", email="j3@example.com", tags={"colby", "gouda"}).tags is tags
+
+
+def test_subscribers_from_row():
+    assert from_row(row(1, "j@example.com", Cheeses=["colby"])) == [
+        sub("1", "j@example.com", tags={"colby"}),
+    ]
+
+
+def test_subscribers_from_row_no_email():
+    assert from_row(row(1, "")) == []
+
+
+def test_subscribers_from_row_multiple_emails():
+    assert from_row(row(1, "j1@example.com; j2@example.com")) == [
+        sub("1-1", "j1@example.com"),
+        sub("1-2", "j2@example.com"),
+    ]
+
+
+def snapshot(rows: dict[int, SnapshotRow]) -> Snapshot:
+    return Snapshot(
+        taken_at=T0,
+        last_full_refresh_at=T0,
+        tags_column_names=["Cheeses"],
+        metadata_column_names=["Sport"],
+        last_modified_column_name="Last modified",
+        rows=rows,
+    )
+
+
+def test_snapshot_is_usable():
+    s = snapshot({})
+
+    def is_usable(now: datetime, tags_column_names: list[str]) -> bool:
+        return s.is_usable(
+            now=now,
+            full_refresh_interval=timedelta(hours=24),
+            tags_column_names=tags_column_names,
+            metadata_column_names=["Sport"],
+            last_modified_column_name="Last modified",
+        )
+
+    assert is_usable(T0 + timedelta(hours=23), ["Cheeses"])
+    assert not is_usable(T0 + timedelta(hours=24), ["Cheeses"])
+    assert not is_usable(T0, ["Cheeses", "Breads"])
+    # As passed by the CLI.
+    assert is_usable(T0, ("Cheeses",))  # type: ignore[arg-type]
+
+
+def test_snapshot_merge():
+    s = snapshot(
+        {
+            1: SnapshotRow(
+                last_modified="t1", subscribers=[sub("1", "j1@example.com")]
+            ),
+            2: SnapshotRow(
+                last_modified="t1", subscribers=[sub("2", "j2@example.com")]
+            ),
+            3: SnapshotRow(
+                last_modified="t1", subscribers=[sub("3", "j3@example.com")]
+            ),
+        }
+    )
+
+    # Row 1 is unchanged, row 2 was edited, row 3 was deleted, and row 4 is new.
+    last_modified_by_id: dict[int, str | None] = {1: "t1", 2: "t2", 4: "t2"}
+    assert s.changed_row_ids(last_modified_by_id) == {2, 4}
+
+    changed_rows = {
+        2: SnapshotRow(last_modified="t2", subscribers=[sub("2", "new@example.com")]),
+        4: SnapshotRow(last_modified="t2", subscribers=[sub("4", "j4@example.com")]),
+    }
+    assert s.merge(last_modified_by_id, changed_rows) == {
+        1: s.rows[1],
+        2: changed_rows[2],
+        4: changed_rows[4],
+    }
+
+
+def test_snapshot_changed_subscriber_ids():
+    previous = snapshot(
+        {
+            1: SnapshotRow(
+                last_modified="t1", subscribers=[sub("1", "j1@example.com")]
+            ),
+            2: SnapshotRow(
+                last_modified="t1", subscribers=[sub("2", "j2@example.com")]
+            ),
+            3: SnapshotRow(
+                last_modified="t1", subscribers=[sub("3", "j3@example.com")]
+            ),
+            5: SnapshotRow(
+                last_modified="t1", subscribers=[sub("5", "j5@example.com")]
+            ),
+        }
+    )
+    current = snapshot(
+        {
+            # Row 1 is unchanged, but now shares an email with row 4.
+            1: previous.rows[1],
+            # Row 2 is unchanged.
+            2: previous.rows[2],
+            # Row 3 was deleted, and rows 4 and 6 are new.
+            4: SnapshotRow(
+                last_modified="t2", subscribers=[sub("4", "j1@example.com")]
+            ),
+            # Row 5 was edited.
+            5: SnapshotRow(
+                last_modified="t2", subscribers=[sub("5", "new@example.com")]
+            ),
+            6: SnapshotRow(last_modified="t2", subscribers=[]),
+        }
+    )
+    assert current.changed_subscriber_ids(previous) == {"1", "3", "4", "5"}
+
+
+def test_snapshot_round_trip(tmp_path: Path):
+    path = tmp_path / "snapshot.json"
+    assert Snapshot.read(path) is None
+
+    s = snapshot(
+        {
+            1: SnapshotRow(
+                last_modified="t1",
+                subscribers=[
+                    sub("1-1", "j1@example.com", tags={"colby"}),
+                    sub("1-2", "j2@example.com", tags={"colby"}),
+                ],
+            ),
+            2: SnapshotRow(last_modified=None, subscribers=[]),
+        }
+    )
+    s.write(path)
+    assert Snapshot.read(path) == s
+    assert s.subscribers() == [
+        sub("1-1", "j1@example.com", tags={"colby"}),
+        sub("1-2", "j2@example.com", tags={"colby"}),
+    ]
+
+
+def test_subscriber_fields():
+    assert subscriber_fields(["Cheeses", "Sport"], ["Sport"]) == [
+        "Email",
+        "Full Name",
+        "Cheeses",
+        "Sport",
+    ]
+
+
+def test_load_only_fetches_subscriber_fields(tmp_path: Path):
+    notes = "x" * 100_000
+    with FakeBaserow(
+        "key",
+        table_id=42,
+        field_types={
+            "Email": "email",
+            "Full Name": "text",
+            "Cheeses": "multiple_select",
+            "Sport": "text",
+            "Notes": "long_text",
+            "Modified": "last_modified",
+        },
+    ) as fake:
+        fake.set_row(
+            1, {"Email": "j1@example.com", "Cheeses": ["colby"], "Notes": notes}
+        )
+        fake.set_row(2, {"Email": "j2@example.com", "Notes": notes})
+
+        def load() -> br.Data:
+            return br.Data.load(
+                api_key="key",
+                table_id=42,
+                tags_column_names=["Cheeses"],
+                metadata_column_names=["Sport"],
+                url=fake.url,
+                metrics=metrics,
+            )
+
+        def load_incrementally() -> br.Data:
+            return br.Data.load_incrementally(
+                api_key="key",
+                table_id=42,
+                tags_column_names=["Cheeses"],
+                metadata_column_names=["Sport"],
+                last_modified_column_name="Modified",
+                snapshot_path=tmp_path / "snapshot.json",
+                full_refresh_interval=timedelta(hours=1),
+                url=fake.url,
+                metrics=metrics,
+            )
+
+        for load_data in [load, load_incrementally, load_incrementally]:
+            metrics = Metrics()
+            data = load_data()
+            assert [(sub.id, sub.tags) for sub in data.subscribers] == [
+                ("1", {"colby"}),
+                ("2", set()),
+            ]
+            assert 0 < metrics.response_bytes("baserow") < len(notes)
+            # The second incremental load fetches row 2 again.
+            fake.set_row(2, {"Email": "j2@example.com", "Notes": notes})
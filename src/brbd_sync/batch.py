@@ -0,0 +1,97 @@
+from collections import Counter
+
+from . import buttondown as bd
+from . import buttondown_api as bd_api
+
+# Below this many subscribers, a bulk action isn't worth it.
+DEFAULT_MIN_BATCH_SIZE = 10
+
+
+# Replace groups of similar operations with Buttondown bulk actions:
+#
+#   - `DeleteSub`s become a `BulkDeleteSubs`.
+#   - `EditSub`s that only change tags, and that make the same change (say,
+#     add "colby" and remove "gouda"), become a `BulkEditTags`. That takes a
+#     bulk action per tag, so there must be more subscribers than tags.
+#
+# `buttondown_data` is Buttondown as it was before any of `operations`.
+#
+# Bulk actions run in no particular order, so we only batch operations on
+# emails that no other operation touches. Every other operation is left alone,
+# and remains in its original order. Each bulk operation takes the place of
+# the first operation it replaces.
+def batch_operations(
+    operations: list[bd_api.Operation],
+    buttondown_data: bd.Data,
+    min_batch_size: int = DEFAULT_MIN_BATCH_SIZE,
+) -> list[bd_api.Operation]:
+    touch_counts = Counter(
+        email.lower() for op in operations for email in op.touched_emails()
+    )
+
+    # Which group (if any) an operation belongs to. Operations in the same
+    # group can be replaced by a single bulk operation.
+    def group_key(op: bd_api.Operation) -> tuple | None:
+        match op:
+            case bd_api.DeleteSub():
+                email = op.email
+            case bd_api.EditSub(new_email=None, metadata=None) if op.tags is not None:
+                email = op.old_email
+            case _:
+                return None
+
+        sub = buttondown_data.get_subscriber(email=email)
+        if touch_counts[email.lower()] > 1 or sub is None or sub.buttondown_id is None:
+            return None
+
+        if isinstance(op, bd_api.EditSub) and op.tags is not None:
+            return (
+                "tags",
+                frozenset(op.tags - sub.tags),
+                frozenset(sub.tags - op.tags),
+            )
+
+        return ("delete",)
+
+    group_keys = [group_key(op) for op in operations]
+    group_sizes = Counter(key for key in group_keys if key is not None)
+
+    def worth_batching(key: tuple) -> bool:
+        size = group_sizes[key]
+        match key:
+            case ("tags", add_tags, remove_tags):
+                tag_count = len(add_tags) + len(remove_tags)
+                return size >= min_batch_size and size > tag_count
+            case _:
+                return size >= min_batch_size
+
+    result: list[bd_api.Operation] = []
+    bulk_op_by_key: dict[tuple, bd_api.BulkOperation] = {}
+    for op, key in zip(operations, group_keys):
+        if key is None or not worth_batching(key):
+            result.append(op)
+            continue
+
+        bulk_op = bulk_op_by_key.get(key)
+        if bulk_op is None:
+            match key:
+                case ("delete",):
+                    bulk_op = bd_api.BulkDeleteSubs(emails=[], buttondown_ids=[])
+                case ("tags", add_tags, remove_tags):
+                    bulk_op = bd_api.BulkEditTags(
+                        emails=[],
+                        buttondown_ids=[],
+                        add_tags=set(add_tags),
+                        remove_tags=set(remove_tags),
+                    )
+            assert bulk_op is not None
+            bulk_op_by_key[key] = bulk_op
+            result.append(bulk_op)
+
+        (email,) = op.touched_emails()
+        sub = buttondown_data.get_subscriber(email=email)
+        assert sub is not None and sub.buttondown_id is not None
+        bulk_op.emails.append(email)
+        bulk_op.buttondown_ids.append(sub.buttondown_id)
+
+    return result
@@ -0,0 +1,182 @@
+import dataclasses
+import io
+
+from . import buttondown as bd
+from . import buttondown_api
+from .batch import batch_operations
+from .buttondown_api import AddSub, BulkDeleteSubs, BulkEditTags, DeleteSub, EditSub
+from .executor import dependencies
+from .sync import Plan, apply, plan
+from .sync_test import bd_sub, br_sub, db
+
+
+def ml(subscribers: list[bd.Subscriber]) -> bd.Data:
+    # Bulk actions need Buttondown's ids for each subscriber.
+    return bd.Data(
+        subscribers=[
+            dataclasses.replace(sub, buttondown_id=f"bd-{sub.email}")
+            for sub in subscribers
+        ],
+        api_client=buttondown_api.Client(api_key="bogus"),
+    )
+
+
+def test_batch_operations():
+    buttondown_data = ml(
+        [
+            bd_sub(id=str(i), email=f"j{i}@example.com", tags={"gouda"})
+            for i in range(1, 7)
+        ]
+    )
+    operations = [
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", tags={"gouda", "colby"}),
+        DeleteSub(email="j3@example.com"),
+        EditSub(old_email="j4@example.com", tags={"gouda", "colby"}),
+        # A different tag change.
+        EditSub(old_email="j5@example.com", tags={"colby"}),
+        # Not just a tag change.
+        EditSub(old_email="j6@example.com", new_email="k6@example.com"),
+        AddSub(email="new@example.com", tags=set(), metadata={"id": "7"}),
+    ]
+
+    assert batch_operations(operations, buttondown_data, min_batch_size=2) == [
+        BulkDeleteSubs(
+            emails=["j1@example.com", "j3@example.com"],
+            buttondown_ids=["bd-j1@example.com", "bd-j3@example.com"],
+        ),
+        BulkEditTags(
+            emails=["j2@example.com", "j4@example.com"],
+            buttondown_ids=["bd-j2@example.com", "bd-j4@example.com"],
+            add_tags={"colby"},
+        ),
+        EditSub(old_email="j5@example.com", tags={"colby"}),
+        EditSub(old_email="j6@example.com", new_email="k6@example.com"),
+        AddSub(email="new@example.com", tags=set(), metadata={"id": "7"}),
+    ]
+
+    # Too few to be worth it.
+    assert batch_operations(operations, buttondown_data, min_batch_size=3) == (
+        operations
+    )
+
+
+def test_batch_operations_only_batches_tag_changes_that_save_calls():
+    buttondown_data = ml(
+        [
+            bd_sub(id=str(i), email=f"j{i}@example.com", tags={"gouda"})
+            for i in range(1, 5)
+        ]
+    )
+    # Adding one tag and removing another takes two bulk actions, which is
+    # no better than editing two subscribers one by one.
+    operations = [
+        EditSub(old_email="j1@example.com", tags={"colby"}),
+        EditSub(old_email="j2@example.com", tags={"colby"}),
+    ]
+    assert batch_operations(operations, buttondown_data, min_batch_size=1) == (
+        operations
+    )
+
+    # With a third subscriber, it's worth it.
+    operations.append(EditSub(old_email="j3@example.com", tags={"colby"}))
+    (bulk_op,) = batch_operations(operations, buttondown_data, min_batch_size=1)
+    assert isinstance(bulk_op, BulkEditTags)
+    assert bulk_op.api_calls_saved() == 1
+
+
+def test_batch_operations_leaves_order_dependent_operations_alone():
+    buttondown_data = ml(
+        [
+            bd_sub(id="1", email="j1@example.com"),
+            bd_sub(id="2", email="j2@example.com"),
+            bd_sub(id="3", email="j3@example.com"),
+        ]
+    )
+    operations = [
+        # This frees up the email for the edit after it.
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", new_email="j1@example.com"),
+        DeleteSub(email="j3@example.com"),
+        # Not known to Buttondown yet, so we don't have its Buttondown id.
+        AddSub(email="j4@example.com", tags=set(), metadata={"id": "4"}),
+        DeleteSub(email="j4@example.com"),
+    ]
+    assert batch_operations(operations, buttondown_data, min_batch_size=1) == [
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", new_email="j1@example.com"),
+        BulkDeleteSubs(emails=["j3@example.com"], buttondown_ids=["bd-j3@example.com"]),
+        AddSub(email="j4@example.com", tags=set(), metadata={"id": "4"}),
+        DeleteSub(email="j4@example.com"),
+    ]
+
+
+def test_plan_with_bulk_operations():
+    # Rename a tag, and archive a cohort.
+    n = 20
+    baserow_data = db(
+        [
+            br_sub(id=f"{i:02}", email=f"j{i:02}@example.com", tags={"cheddar"})
+            for i in range(n)
+        ]
+    )
+    buttondown_data = ml(
+        [
+            bd_sub(id=f"{i:02}", email=f"j{i:02}@example.com", tags={"chedar"})
+            for i in range(2 * n)
+        ]
+    )
+
+    the_plan = plan(baserow_data, buttondown_data, min_batch_size=10)
+    assert the_plan.operations == [
+        BulkEditTags(
+            emails=[f"j{i:02}@example.com" for i in range(n)],
+            buttondown_ids=[f"bd-j{i:02}@example.com" for i in range(n)],
+            add_tags={"cheddar"},
+            remove_tags={"chedar"},
+        ),
+        BulkDeleteSubs(
+            emails=[f"j{i:02}@example.com" for i in range(n, 2 * n)],
+            buttondown_ids=[f"bd-j{i:02}@example.com" for i in range(n, 2 * n)],
+        ),
+    ]
+    assert [op.api_calls_saved() for op in the_plan.operations] == [n - 2, n - 1]
+
+    # Bulk operations have the same effect on our model of Buttondown as the
+    # operations they replace.
+    batched_data = buttondown_data.copy()
+    unbatched_data = buttondown_data.copy()
+    for op in the_plan.operations:
+        batched_data.apply(op)
+    for op in plan(baserow_data, buttondown_data).operations:
+        unbatched_data.apply(op)
+    assert batched_data.subscribers == unbatched_data.subscribers
+
+
+def test_bulk_operations():
+    the_plan = Plan(
+        operations=[
+            BulkDeleteSubs(
+                emails=["j1@example.com", "j2@example.com", "j3@example.com"],
+                buttondown_ids=["bd1", "bd2", "bd3"],
+            ),
+            BulkEditTags(
+                emails=["j4@example.com", "j5@example.com", "j6@example.com"],
+                buttondown_ids=["bd4", "bd5", "bd6"],
+                add_tags={"parmesan", "colby"},
+            ),
+            EditSub(old_email="j1@example.com", new_email="j4@example.com"),
+        ]
+    )
+    assert dependencies(the_plan.operations) == [set(), set(), {0, 1}]
+
+    f = io.StringIO()
+    the_plan.write(f)
+    assert f.getvalue().splitlines()[1] == (
+        '{"BulkEditTags":{"emails":["j4@example.com","j5@example.com","j6@example.com"],"buttondown_ids":["bd4","bd5","bd6"],"add_tags":["colby","parmesan"],"remove_tags":[]}}'
+    )
+    f.seek(0)
+    assert Plan.read(f) == the_plan
+
+    result = apply(the_plan, buttondown_api.Client(api_key="bogus"), dry_run=True)
+    assert result.api_calls_saved == 2 + 1
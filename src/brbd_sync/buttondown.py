@@ -1,26 +1,124 @@
-from typing import Self
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, Self
 
 from pydantic import BaseModel
 
 from . import buttondown_api as api
-from .util import group_by, unique_group_by
+from .util import ChangedIds, intern_keys, intern_tags, write_atomically
 
 
-class Subscriber(BaseModel):
+# There can be a lot of these, so they're kept as small as possible: a plain
+# slotted dataclass (rather than a pydantic model), with interned tags and
+# metadata keys.
+@dataclass(slots=True)
+class Subscriber:
     id: str | None
     email: str
-    tags: set[str]
+    tags: frozenset[str]
     metadata: dict[str, str]
+    # Buttondown's own id for this subscriber. This is unknown for
+    # subscribers that are only planned to be added (say, in a dry run).
+    buttondown_id: str | None = None
 
+    def __post_init__(self):
+        self.tags = intern_tags(self.tags)
+        self.metadata = intern_keys(self.metadata)
 
-class Data:
-    def __init__(self, subscribers: list[Subscriber], api_client: api.Client):
-        self._subscriber_by_email: dict[str, Subscriber] = unique_group_by(
-            subscribers, lambda s: s.email
+    @classmethod
+    def from_api(cls, api_sub: api.Subscriber) -> Self:
+        return cls(
+            id=api_sub.metadata.get("id"),
+            email=api_sub.email_address,
+            tags=api_sub.tags,
+            metadata=api_sub.metadata,
+            buttondown_id=api_sub.id,
         )
-        self._recompute_indices()
+
+
+# Subscribers modified slightly before a snapshot was taken may not have made
+# it into the snapshot. Re-fetch them to be safe.
+SNAPSHOT_OVERLAP = timedelta(minutes=5)
+
+
+# The state of Buttondown as of the end of a previous run. This lets us fetch
+# only what has changed since then, rather than the entire mailing list.
+class Snapshot(BaseModel):
+    # When we started reading the subscribers in this snapshot from Buttondown.
+    taken_at: datetime
+    # A delta fetch can't tell us about subscribers that were deleted, so
+    # snapshots drift over time. Every so often, we throw the snapshot away
+    # and re-fetch everything.
+    last_full_refresh_at: datetime
+    subscribers: list[Subscriber]
+
+    def needs_full_refresh(
+        self, now: datetime, full_refresh_interval: timedelta
+    ) -> bool:
+        return now - self.last_full_refresh_at >= full_refresh_interval
+
+    # Apply subscribers that have been created or modified since this snapshot
+    # was taken. Also returns the ids of everyone affected: the changed
+    # subscribers, and whoever they replaced.
+    def merge(
+        self, changed_subscribers: Iterable[Subscriber]
+    ) -> tuple[list[Subscriber], set[str]]:
+        subscriber_by_email = {sub.email: sub for sub in self.subscribers}
+        email_by_buttondown_id = {
+            sub.buttondown_id: sub.email
+            for sub in self.subscribers
+            if sub.buttondown_id is not None
+        }
+
+        affected: list[Subscriber | None] = []
+        for sub in changed_subscribers:
+            # The subscriber may have changed their email.
+            if sub.buttondown_id is not None:
+                old_email = email_by_buttondown_id.get(sub.buttondown_id)
+                if old_email is not None and old_email != sub.email:
+                    affected.append(subscriber_by_email.pop(old_email, None))
+                email_by_buttondown_id[sub.buttondown_id] = sub.email
+
+            affected.extend([subscriber_by_email.get(sub.email), sub])
+            subscriber_by_email[sub.email] = sub
+
+        return list(subscriber_by_email.values()), {
+            sub.id for sub in affected if sub is not None and sub.id is not None
+        }
+
+    @classmethod
+    def read(cls, path: Path) -> Self | None:
+        if not path.exists():
+            return None
+
+        return cls.model_validate_json(path.read_bytes())
+
+    def write(self, path: Path):
+        write_atomically(path, self.model_dump_json())
+
+
+class Data:
+    # `changes` is what changed since the previous snapshot, if this was
+    # loaded from one.
+    def __init__(
+        self,
+        subscribers: Iterable[Subscriber],
+        api_client: api.Client,
+        changes: ChangedIds | None = None,
+    ):
+        self.changes = changes
+        self._subscriber_by_email: dict[str, Subscriber] = {}
+        self._subscribers_by_id: dict[str | None, list[Subscriber]] = {}
+        self._subscriber_by_buttondown_id: dict[str, Subscriber] = {}
+        for sub in subscribers:
+            self._add_subscriber(sub)
         self._api_client = api_client
 
+    @property
+    def api_client(self) -> api.Client:
+        return self._api_client
+
     @property
     def subscribers(self) -> list[Subscriber]:
         return list(self._subscriber_by_email.values())
@@ -30,27 +128,72 @@ class Data:
             f"Email {new_sub.email} already exists."
         )
         self._subscriber_by_email[new_sub.email] = new_sub
-        self._recompute_indices()
+        self._subscribers_by_id.setdefault(new_sub.id, []).append(new_sub)
+        if new_sub.buttondown_id is not None:
+            self._subscriber_by_buttondown_id[new_sub.buttondown_id] = new_sub
 
     def _delete_subscriber(self, email: str):
-        del self._subscriber_by_email[email]
-        self._recompute_indices()
+        old_sub = self._subscriber_by_email.pop(email)
 
-    def _recompute_indices(self):
-        self._subscribers_by_id: dict[str | None, list[Subscriber]] = group_by(
-            self.subscribers, lambda s: s.id
-        )
+        # Almost every id maps to exactly one subscriber, so this
+        # list is tiny and the removal is effectively constant time.
+        subs_with_id = self._subscribers_by_id[old_sub.id]
+        subs_with_id.remove(old_sub)
+        if len(subs_with_id) == 0:
+            del self._subscribers_by_id[old_sub.id]
+
+        if old_sub.buttondown_id is not None:
+            del self._subscriber_by_buttondown_id[old_sub.buttondown_id]
+
+    # Pass `id=None` for the subscribers without an id.
+    def get_subscribers(self, *, id: str | None) -> list[Subscriber]:
+        # Return a copy so callers can safely delete subscribers while
+        # iterating over the result.
+        return list(self._subscribers_by_id.get(id, []))
+
+    def get_subscriber(
+        self, *, email: str | None = None, buttondown_id: str | None = None
+    ) -> Subscriber | None:
+        params = [val for val in [email, buttondown_id] if val is not None]
+        assert len(params) == 1, "Must query on exactly one field"
 
-    def get_subscribers(self, *, id: str) -> list[Subscriber]:
-        return self._subscribers_by_id.get(id, [])
+        if email is not None:
+            return self._subscriber_by_email.get(email)
+        elif buttondown_id is not None:
+            return self._subscriber_by_buttondown_id.get(buttondown_id)
+        else:
+            assert False, "Must query for something"  # pragma: no cover
 
-    def get_subscriber(self, *, email: str) -> Subscriber | None:
-        return self._subscriber_by_email.get(email)
+    # Replace whatever we know about the given Buttondown subscriber with
+    # `new_sub` (freshly fetched from Buttondown), or forget about them if
+    # `new_sub` is None (they no longer exist). Returns the subscribers we
+    # had to forget about.
+    def refresh(
+        self, buttondown_id: str, new_sub: Subscriber | None
+    ) -> list[Subscriber]:
+        old_subs: list[Subscriber] = []
 
-    def add(self, op: api.AddSub, dry_run: bool):
-        if not dry_run:  # pragma: no cover (requires internet)
-            op.doit(self._api_client)
+        old_sub = self.get_subscriber(buttondown_id=buttondown_id)
+        if old_sub is not None:
+            self._delete_subscriber(old_sub.email)
+            old_subs.append(old_sub)
 
+        if new_sub is not None:
+            # Buttondown is the source of truth for who has which email. If
+            # we thought someone else had it, we're out of date.
+            stale_sub = self.get_subscriber(email=new_sub.email)
+            if stale_sub is not None:
+                self._delete_subscriber(stale_sub.email)
+                old_subs.append(stale_sub)
+
+            self._add_subscriber(new_sub)
+
+        return old_subs
+
+    def copy(self) -> Self:
+        return type(self)(subscribers=self.subscribers, api_client=self._api_client)
+
+    def add(self, op: api.AddSub, buttondown_id: str | None = None):
         id = op.metadata["id"]
         self._add_subscriber(
             Subscriber(
@@ -58,19 +201,14 @@ class Data:
                 email=op.email,
                 tags=op.tags,
                 metadata=op.metadata,
+                buttondown_id=buttondown_id,
             )
         )
 
-    def delete(self, op: api.DeleteSub, dry_run: bool):
-        if not dry_run:  # pragma: no cover (requires internet)
-            op.doit(self._api_client)
-
+    def delete(self, op: api.DeleteSub):
         self._delete_subscriber(op.email)
 
-    def edit(self, op: api.EditSub, dry_run: bool):
-        if not dry_run:  # pragma: no cover (requires internet)
-            op.doit(self._api_client)
-
+    def edit(self, op: api.EditSub):
         old_sub = self.get_subscriber(email=op.old_email)
         assert old_sub is not None
 
@@ -81,22 +219,62 @@ class Data:
                 email=old_sub.email if op.new_email is None else op.new_email,
                 tags=old_sub.tags if op.tags is None else op.tags,
                 metadata=old_sub.metadata if op.metadata is None else op.metadata,
+                buttondown_id=old_sub.buttondown_id,
             )
         )
 
+    # Update our in-memory model of Buttondown to reflect the given
+    # operation. Note that this does *not* talk to Buttondown: that's the
+    # job of `executor.execute`, which passes along the `buttondown_id` of
+    # the subscriber an `AddSub` added (see `api.Operation.doit`). Without
+    # it, a later delta load can't tell that subscriber changed their email.
+    def apply(self, op: api.Operation, buttondown_id: str | None = None):
+        match op:
+            case api.AddSub():
+                self.add(op, buttondown_id)
+            case api.DeleteSub():
+                self.delete(op)
+            case api.EditSub():
+                self.edit(op)
+            case api.BulkDeleteSubs():
+                for email in op.emails:
+                    self.delete(api.DeleteSub(email=email))
+            case api.BulkEditTags():
+                for email in op.emails:
+                    sub = self.get_subscriber(email=email)
+                    assert sub is not None
+                    tags = (sub.tags - op.remove_tags) | op.add_tags
+                    self.edit(api.EditSub(old_email=email, tags=tags))
+            case _:  # pragma: no cover (there are no other kinds of operations)
+                assert False, f"Unrecognized operation: {op}"
+
+    def snapshot(self, taken_at: datetime, last_full_refresh_at: datetime) -> Snapshot:
+        return Snapshot(
+            taken_at=taken_at,
+            last_full_refresh_at=last_full_refresh_at,
+            subscribers=self.subscribers,
+        )
+
+    # Load all subscribers from Buttondown. If given a `previous` snapshot,
+    # only subscribers that have changed since then are fetched.
     @classmethod
-    def load(
-        cls, api_client: api.Client
-    ) -> Self:  # pragma: no cover (requires internet)
-        subscribers: list[Subscriber] = []
-        for api_sub in api_client.list_subscribers():
-            subscribers.append(
-                Subscriber(
-                    id=api_sub.metadata.get("id"),
-                    email=api_sub.email_address,
-                    tags=api_sub.tags,
-                    metadata=api_sub.metadata,
-                )
-            )
+    def load(cls, api_client: api.Client, previous: Snapshot | None = None) -> Self:
+        updated_since = (
+            None if previous is None else previous.taken_at - SNAPSHOT_OVERLAP
+        )
+
+        # Build our indices straight from the stream of subscribers, rather
+        # than collecting them all into an intermediate list first.
+        subscribers: Iterable[Subscriber] = (
+            Subscriber.from_api(api_sub)
+            for api_sub in api_client.list_subscribers(updated_since=updated_since)
+        )
+        if previous is None:
+            return cls(subscribers=subscribers, api_client=api_client)
 
-        return cls(subscribers=subscribers, api_client=api_client)
+        subscribers, changed_ids = previous.merge(subscribers)
+        return cls(
+            subscribers=subscribers,
+            api_client=api_client,
+            changes=ChangedIds(since=previous.taken_at, ids=changed_ids),
+        )
@@ -1,28 +1,40 @@
+import itertools
+import json
 import logging
-from typing import Any
-from urllib.parse import urlparse
+import math
+import threading
+import time
+from datetime import datetime
+from typing import Any, Iterator
+from urllib.parse import urlencode, urlparse
 
 import requests
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_serializer
+from requests.adapters import HTTPAdapter
+
+from .metrics import Metrics
+from .rate_limit import RateLimiter, backoff, parse_retry_after
+from .util import prefetch_map
 
 logger = logging.getLogger(__name__)
 
 
 class SkippableEmailError(Exception):
-    def __init__(
-        self, operation: str, code: str, detail: str
-    ):  # pragma: no cover (requires internet)
+    def __init__(self, operation: str, code: str, detail: str):
         self.operation = operation
         self.code = code
         self.detail = detail
 
 
 class UnskippableEmailError(Exception):
-    def __init__(self, msg: str):  # pragma: no cover (requires internet)
+    def __init__(self, msg: str):
         self.msg = msg
 
 
 class Subscriber(BaseModel):
+    # Buttondown's own id for the subscriber. We never send this back to
+    # Buttondown.
+    id: str | None = Field(default=None, exclude=True)
     type: str
     email_address: str
     tags: set[str]
@@ -32,71 +44,329 @@ class Subscriber(BaseModel):
 class ListSubscribersResponse(BaseModel):
     results: list[Subscriber]
     next: str | None
+    count: int | None = None
+
+
+BUTTONDOWN_API_URL = "https://api.buttondown.com"
+
+# The largest page size Buttondown allows when listing subscribers. Fewer,
+# bigger pages means fewer round trips.
+LIST_PAGE_SIZE = 100
+
+# The filter Buttondown uses to only list subscribers created or modified
+# after a given time.
+UPDATED_SINCE_FILTER = "last_updated__start"
+
+
+class RequestStats(BaseModel):
+    requests: int
+    connections: int
+    throttled: int
+    retried: int
 
 
-BUTTONDOWN_API_DOMAIN = "api.buttondown.com"
+# Methods that are safe to retry after a failure, per RFC 9110.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+def should_retry(method: str, status_code: int) -> bool:
+    # A 429 means the server did not process the request, so it's safe to
+    # retry no matter what the method is.
+    if status_code == 429:
+        return True
+
+    return status_code >= 500 and method in IDEMPOTENT_METHODS
 
 
 class Client:
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        pool_size: int = 10,
+        keep_alive: bool = True,
+        requests_per_second: float | None = None,
+        max_retries: int = 5,
+        page_prefetch: int = 1,
+        base_url: str = BUTTONDOWN_API_URL,
+        metrics: Metrics | None = None,
+    ):
         self._api_key = api_key
+        self._base_url = base_url.removesuffix("/")
+        self._metrics = metrics
+        self._page_prefetch = page_prefetch
+        self._keep_alive = keep_alive
+        self._max_retries = max_retries
+        self._rate_limiter = RateLimiter(requests_per_second)
+
+        # All threads share a single pool of connections (urllib3's pools are
+        # thread safe). `requests.Session` is not guaranteed to be thread
+        # safe, so each thread gets its own session, backed by that shared
+        # pool.
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self._thread_local = threading.local()
+
+        self._lock = threading.Lock()
+        self._tag_ids_lock = threading.Lock()
+        self._tag_ids: dict[str, str] | None = None
+        self._request_count = 0
+        self._throttled_count = 0
+        self._retried_count = 0
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._thread_local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount(self._base_url, self._adapter)
+            if self._metrics is not None:
+                self._metrics.instrument(session, "buttondown")
+            self._thread_local.session = session
+
+        return session
+
+    def request_stats(self) -> RequestStats:
+        pools = self._adapter.poolmanager.pools
+        connections = sum(
+            pool.num_connections
+            for key in pools.keys()
+            if (pool := pools.get(key)) is not None
+        )
 
-    def get(self, path: str) -> Any:  # pragma: no cover (requires internet)
-        return self._call("GET", path, None).json()
+        with self._lock:
+            return RequestStats(
+                requests=self._request_count,
+                connections=connections,
+                throttled=self._throttled_count,
+                retried=self._retried_count,
+            )
+
+    def get(self, path: str) -> Any:
+        return json.loads(self.get_bytes(path))
 
-    def post(self, path: str, data: Any) -> Any:  # pragma: no cover (requires internet)
+    # The raw response body. Parsing it straight into a model (with
+    # `model_validate_json`) is quicker than going through `get`'s dicts.
+    def get_bytes(self, path: str) -> bytes:
+        # Subscriber lists compress very well.
+        return self._call(
+            "GET", path, None, headers={"Accept-Encoding": "gzip"}
+        ).content
+
+    def post(self, path: str, data: Any) -> Any:
         return self._call("POST", path, data).json()
 
-    def delete(self, path: str):  # pragma: no cover (requires internet)
+    def delete(self, path: str):
         self._call("DELETE", path, None)
 
-    def patch(
-        self, path: str, data: Any
-    ) -> Any:  # pragma: no cover (requires internet)
+    def patch(self, path: str, data: Any) -> Any:
         return self._call("PATCH", path, data).json()
 
     def _call(
-        self, method: str, path: str, data: Any | None
-    ) -> requests.Response:  # pragma: no cover (requires internet)
+        self,
+        method: str,
+        path: str,
+        data: Any | None,
+        headers: dict[str, str] = {},
+    ) -> requests.Response:
         path = path.removeprefix("/")
 
-        response = requests.request(
-            method,
-            f"https://{BUTTONDOWN_API_DOMAIN}/{path}",
-            headers={"Authorization": f"Token {self._api_key}"},
-            json=data,
+        # Set once an attempt has failed in a way that doesn't tell us whether
+        # the server acted on it.
+        maybe_applied = False
+
+        for attempt in itertools.count():
+            self._rate_limiter.acquire()
+            with self._lock:
+                self._request_count += 1
+
+            try:
+                response = self._session().request(
+                    method,
+                    f"{self._base_url}/{path}",
+                    headers={
+                        "Authorization": f"Token {self._api_key}",
+                        "Connection": "keep-alive" if self._keep_alive else "close",
+                        **headers,
+                    },
+                    json=data,
+                )
+            except requests.ConnectionError as e:
+                if method not in IDEMPOTENT_METHODS or attempt >= self._max_retries:
+                    raise
+
+                delay = backoff(attempt)
+                logger.warning(
+                    "%s %s failed (%s), retrying in %.1fs", method, path, e, delay
+                )
+                with self._lock:
+                    self._retried_count += 1
+                maybe_applied = True
+                time.sleep(delay)
+                continue
+
+            if attempt < self._max_retries and should_retry(
+                method, response.status_code
+            ):
+                delay = parse_retry_after(response.headers.get("Retry-After"))
+                if delay is None:
+                    delay = backoff(attempt)
+
+                logger.warning(
+                    "%s %s got HTTP %s, retrying in %.1fs",
+                    method,
+                    path,
+                    response.status_code,
+                    delay,
+                )
+                with self._lock:
+                    self._retried_count += 1
+                    if response.status_code == 429:
+                        self._throttled_count += 1
+
+                if response.status_code == 429:
+                    # We're going too fast: everybody needs to slow down.
+                    self._rate_limiter.pause(delay)
+                else:
+                    maybe_applied = True
+                    time.sleep(delay)
+                continue
+
+            # If an earlier attempt at a delete went through after all, the
+            # subscriber is already gone, which is what we wanted.
+            if method == "DELETE" and maybe_applied and response.status_code == 404:
+                return response
+
+            response.raise_for_status()
+            return response
+
+        assert False, "unreachable"  # pragma: no cover
+
+    def _list_subscribers_page(
+        self, page: int, filters: dict[str, str]
+    ) -> ListSubscribersResponse:
+        query = urlencode({**filters, "page": page, "page_size": LIST_PAGE_SIZE})
+        return ListSubscribersResponse.model_validate_json(
+            self.get_bytes(f"/v1/subscribers?{query}")
         )
-        response.raise_for_status()
 
-        return response
+    def _list_subscribers_pages(
+        self, filters: dict[str, str]
+    ) -> Iterator[ListSubscribersResponse]:
+        first_page = self._list_subscribers_page(1, filters)
+        yield first_page
+
+        if self._page_prefetch > 1 and first_page.count is not None:
+            # We know how many pages there are, so we can fetch several of
+            # them at once rather than following `next` links one by one.
+            page_size = max(1, len(first_page.results))
+            page_count = math.ceil(first_page.count / page_size)
+            received = len(first_page.results)
+            changed = False
+            for page in prefetch_map(
+                lambda page: self._list_subscribers_page(page, filters),
+                range(2, page_count + 1),
+                prefetch=self._page_prefetch,
+            ):
+                received += len(page.results)
+                changed |= page.count != first_page.count
+                yield page
+
+            if not changed and received == first_page.count:
+                return
+
+            # The list changed while we were paging through it. If subscribers
+            # were deleted, others moved onto pages we'd already fetched, and
+            # we missed them. Go through the whole list again
+            # (`list_subscribers` skips the ones we've already seen).
+            logger.warning(
+                "Buttondown's subscriber list changed while listing it, listing it again"
+            )
+            first_page = self._list_subscribers_page(1, filters)
+            yield first_page
+
+        next = first_page.next
+        while next is not None:
+            next_url = urlparse(next)
+            assert next_url.netloc == urlparse(self._base_url).netloc
+            assert isinstance(next_url.path, str)
+            assert isinstance(next_url.query, str)
 
+            page = ListSubscribersResponse.model_validate_json(
+                self.get_bytes(next_url.path + "?" + next_url.query)
+            )
+            yield page
+            next = page.next
+
+    # Subscribers are yielded as each page arrives, so callers never need to
+    # hold the raw API response for the whole list in memory.
+    #
+    # With `updated_since`, only subscribers created or modified after that
+    # time are listed.
     def list_subscribers(
-        self,
-    ) -> list[Subscriber]:  # pragma: no cover (requires internet)
-        next = "/v1/subscribers"
+        self, updated_since: datetime | None = None
+    ) -> Iterator[Subscriber]:
+        filters: dict[str, str] = {}
+        if updated_since is not None:
+            filters[UPDATED_SINCE_FILTER] = updated_since.isoformat()
+
+        # If the list changes while we're paging through it, a subscriber
+        # may shift onto a page we already fetched, and show up twice.
+        seen_emails: set[str] = set()
+
+        for page in self._list_subscribers_pages(filters):
+            for sub in page.results:
+                if sub.email_address in seen_emails:
+                    continue
+
+                seen_emails.add(sub.email_address)
+                yield sub
+
+    # Returns None if there's no such subscriber (anymore).
+    def get_subscriber(self, buttondown_id: str) -> Subscriber | None:
+        try:
+            return Subscriber(**self.get(f"/v1/subscribers/{buttondown_id}"))
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
 
-        subscribers: list[Subscriber] = []
+    # Buttondown's bulk actions run in the background, on Buttondown's end.
+    def bulk_action(self, type: str, metadata: dict[str, Any]):
+        self.post("/v1/bulk_actions", data={"type": type, "metadata": metadata})
 
-        while next is not None:
-            response = self.get(next)
+    # Bulk actions refer to tags by id rather than by name. Returns None if
+    # there's no such tag (and `create` is False).
+    def tag_id(self, name: str, create: bool = False) -> str | None:
+        with self._tag_ids_lock:
+            if self._tag_ids is None:
+                self._tag_ids = {}
+                path: str | None = f"/v1/tags?page_size={LIST_PAGE_SIZE}"
+                while path is not None:
+                    page = self.get(path)
+                    for tag in page["results"]:
+                        self._tag_ids[tag["name"]] = tag["id"]
 
-            parsed_response = ListSubscribersResponse(**response)
-            subscribers.extend(parsed_response.results)
+                    path = None
+                    if page["next"] is not None:
+                        next_url = urlparse(page["next"])
+                        path = f"{next_url.path}?{next_url.query}"
 
-            if parsed_response.next is None:
-                next = None
-            else:
-                next_url = urlparse(parsed_response.next)
-                assert next_url.netloc == BUTTONDOWN_API_DOMAIN
-                assert isinstance(next_url.path, str)
-                assert isinstance(next_url.query, str)
-                next = next_url.path + "?" + next_url.query
+            tag_id = self._tag_ids.get(name)
+            if tag_id is None and create:
+                tag_id = self.post("/v1/tags", data={"name": name})["id"]
+                self._tag_ids[name] = tag_id
 
-        return subscribers
+            return tag_id
 
 
 class Operation(BaseModel):
-    def doit(self, api_client: Client):
+    # Returns the Buttondown id of the subscriber this added, if it added one.
+    def doit(self, api_client: Client) -> str | None:
+        raise NotImplementedError()  # pragma: no cover (duh)
+
+    # The email addresses this operation reads or writes. Two operations
+    # that touch the same email must not run concurrently.
+    def touched_emails(self) -> set[str]:
         raise NotImplementedError()  # pragma: no cover (duh)
 
 
@@ -105,7 +375,15 @@ class AddSub(Operation):
     tags: set
     metadata: dict[str, str]
 
-    def doit(self, api_client: Client):  # pragma: no cover (requires internet)
+    # Sort tags so serialized operations are deterministic.
+    @field_serializer("tags", when_used="json")
+    def _serialize_tags(self, tags: set) -> list:
+        return sorted(tags)
+
+    def touched_emails(self) -> set[str]:
+        return {self.email}
+
+    def doit(self, api_client: Client) -> str:
         sub = Subscriber(
             email_address=self.email,
             type="regular",
@@ -113,7 +391,9 @@ class AddSub(Operation):
             metadata=self.metadata,
         )
         try:
-            api_client.post("/v1/subscribers", data=sub.model_dump(mode="json"))
+            return api_client.post("/v1/subscribers", data=sub.model_dump(mode="json"))[
+                "id"
+            ]
         except requests.HTTPError as e:
             json = e.response.json()
             code = json.get("code")
@@ -151,10 +431,20 @@ class EditSub(Operation):
     tags: set | None = None
     metadata: dict[str, str] | None = None
 
+    @field_serializer("tags", when_used="json")
+    def _serialize_tags(self, tags: set | None) -> list | None:
+        return None if tags is None else sorted(tags)
+
     def is_noop(self) -> bool:
         return self.new_email is None and self.tags is None and self.metadata is None
 
-    def doit(self, api_client: Client):  # pragma: no cover (requires internet)
+    def touched_emails(self) -> set[str]:
+        if self.new_email is None:
+            return {self.old_email}
+
+        return {self.old_email, self.new_email}
+
+    def doit(self, api_client: Client) -> None:
         data = {}
         if self.new_email is not None:
             data["email_address"] = self.new_email
@@ -166,7 +456,7 @@ class EditSub(Operation):
             data["metadata"] = self.metadata
 
         try:
-            return api_client.patch(f"/v1/subscribers/{self.old_email}", data=data)
+            api_client.patch(f"/v1/subscribers/{self.old_email}", data=data)
         except requests.HTTPError as e:
             json = e.response.json()
             code = json.get("code")
@@ -182,5 +472,58 @@ class EditSub(Operation):
 class DeleteSub(Operation):
     email: str
 
-    def doit(self, api_client: Client):  # pragma: no cover (requires internet)
-        return api_client.delete(f"/v1/subscribers/{self.email}")
+    def touched_emails(self) -> set[str]:
+        return {self.email}
+
+    def doit(self, api_client: Client) -> None:
+        api_client.delete(f"/v1/subscribers/{self.email}")
+
+
+# Operations that replace many individual operations with a handful of
+# Buttondown bulk actions. See `batch.batch_operations`.
+class BulkOperation(Operation):
+    emails: list[str]
+    # Bulk actions refer to subscribers by Buttondown id, not by email.
+    buttondown_ids: list[str]
+
+    def touched_emails(self) -> set[str]:
+        return set(self.emails)
+
+    # How many API calls this makes, compared to operating on each
+    # subscriber individually.
+    def api_calls_saved(self) -> int:
+        raise NotImplementedError()  # pragma: no cover (duh)
+
+
+class BulkDeleteSubs(BulkOperation):
+    def api_calls_saved(self) -> int:
+        return len(self.emails) - 1
+
+    def doit(self, api_client: Client) -> None:
+        api_client.bulk_action("delete_subscribers", {"ids": self.buttondown_ids})
+
+
+class BulkEditTags(BulkOperation):
+    add_tags: set[str] = set()
+    remove_tags: set[str] = set()
+
+    @field_serializer("add_tags", "remove_tags", when_used="json")
+    def _serialize_tags(self, tags: set) -> list:
+        return sorted(tags)
+
+    def api_calls_saved(self) -> int:
+        return len(self.emails) - len(self.add_tags) - len(self.remove_tags)
+
+    def doit(self, api_client: Client) -> None:
+        for action, tags in [("add", self.add_tags), ("remove", self.remove_tags)]:
+            for tag in sorted(tags):
+                tag_id = api_client.tag_id(tag, create=action == "add")
+
+                # Nobody can have a tag that doesn't exist.
+                if tag_id is None:
+                    continue
+
+                api_client.bulk_action(
+                    "apply_tags",
+                    {"ids": self.buttondown_ids, "tag": tag_id, "action": action},
+                )
@@ -0,0 +1,17 @@
+from .buttondown_api import Client, RequestStats, should_retry
+
+
+def test_request_stats_before_any_requests():
+    client = Client(api_key="bogus", pool_size=4)
+    assert client.request_stats() == RequestStats(
+        requests=0, connections=0, throttled=0, retried=0
+    )
+
+
+def test_should_retry():
+    assert should_retry("POST", 429)
+    assert should_retry("GET", 503)
+    assert should_retry("DELETE", 500)
+    assert not should_retry("POST", 503)
+    assert not should_retry("PATCH", 502)
+    assert not should_retry("GET", 404)
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .buttondown import Snapshot, Subscriber
+from .buttondown_api import EditSub
+from .sync_test import ml
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def sub(
+    email: str,
+    buttondown_id: str | None,
+    tags: set[str] = set(),
+    id: str | None = "1",
+) -> Subscriber:
+    return Subscriber(
+        id=id, email=email, tags=tags, metadata={}, buttondown_id=buttondown_id
+    )
+
+
+def snapshot(subscribers: list[Subscriber]) -> Snapshot:
+    return Snapshot(taken_at=T0, last_full_refresh_at=T0, subscribers=subscribers)
+
+
+def test_snapshot_needs_full_refresh():
+    s = snapshot([])
+    assert not s.needs_full_refresh(T0 + timedelta(hours=23), timedelta(hours=24))
+    assert s.needs_full_refresh(T0 + timedelta(hours=24), timedelta(hours=24))
+
+
+def test_snapshot_merge():
+    s = snapshot(
+        [
+            sub("unchanged@example.com", "bd-1", id="1"),
+            sub("old@example.com", "bd-2", id="2"),
+            sub("retagged@example.com", "bd-3", id="3"),
+            # Subscribers we created ourselves don't have a Buttondown id yet.
+            sub("added-by-us@example.com", None, id="4"),
+            sub("taken@example.com", "bd-6", id="6"),
+        ]
+    )
+    assert s.merge(
+        [
+            sub("new@example.com", "bd-2", id="2"),
+            sub("retagged@example.com", "bd-3", tags={"colby"}, id="3"),
+            sub("added-by-us@example.com", "bd-4", tags={"colby"}, id="4"),
+            sub("signup@example.com", "bd-5", id=None),
+            # Someone else has this email now.
+            sub("taken@example.com", "bd-7", id="7"),
+        ]
+    ) == (
+        [
+            sub("unchanged@example.com", "bd-1", id="1"),
+            sub("retagged@example.com", "bd-3", tags={"colby"}, id="3"),
+            sub("added-by-us@example.com", "bd-4", tags={"colby"}, id="4"),
+            sub("taken@example.com", "bd-7", id="7"),
+            sub("new@example.com", "bd-2", id="2"),
+            sub("signup@example.com", "bd-5", id=None),
+        ],
+        {"2", "3", "4", "6", "7"},
+    )
+
+
+def test_snapshot_round_trip(tmp_path: Path):
+    path = tmp_path / "snapshot.json"
+    assert Snapshot.read(path) is None
+
+    data = ml([sub("j1@example.com", "bd-1", tags={"colby"})])
+    data.apply(EditSub(old_email="j1@example.com", new_email="j2@example.com"))
+
+    s = data.snapshot(taken_at=T0 + timedelta(hours=1), last_full_refresh_at=T0)
+    s.write(path)
+    assert Snapshot.read(path) == s
+    assert s.subscribers == [sub("j2@example.com", "bd-1", tags={"colby"})]
+
+    # Nothing else was left behind in the directory.
+    assert list(tmp_path.iterdir()) == [path]
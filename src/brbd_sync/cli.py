@@ -1,10 +1,24 @@
 import logging
-from typing import Any
+import queue
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, wait
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, TextIO
 
 import click
+from baserowapi import Row
 
-from . import baserow, buttondown, buttondown_api
-from .sync import sync
+from . import baserow, buttondown, buttondown_api, profiling, serve, state
+from .batch import DEFAULT_MIN_BATCH_SIZE
+from .metrics import Metrics
+from .shard import shard_data
+from .sync import OutputMode, Plan, SyncResult, apply, plan
+from .util import write_atomically
 
 
 def option_with_envvar(*args, **kwargs):
@@ -36,84 +50,852 @@ def prompt(
     return True
 
 
-@click.command(context_settings={"auto_envvar_prefix": "BRBD_SYNC"})
-@option_with_envvar(
-    "--baserow-api-key",
+# Where `DefaultCommandGroup` keeps the arguments it was given, in
+# `click.Context.meta`.
+ARGS_META_KEY = "brbd_sync.args"
+
+
+class DefaultCommandGroup(click.Group):
+    # For backwards compatibility, running `brbd-sync [OPTIONS]` without a
+    # subcommand means `brbd-sync sync [OPTIONS]`.
+    default_command = "sync"
+
+    def parse_args(self, ctx: click.Context, args: list[str]) -> list[str]:
+        if len(args) == 0 or (args[0] not in self.commands and args[0] != "--help"):
+            args = [self.default_command, *args]
+
+        # So that `run_shards` can pass them on.
+        ctx.meta[ARGS_META_KEY] = args
+        return super().parse_args(ctx, args)
+
+
+buttondown_api_key_option = option_with_envvar(
+    "--buttondown-api-key",
     required=True,
-    envvar="BASEROW_API_KEY",
-    help="Baserow api key.",
+    envvar="BUTTONDOWN_API_KEY",
+    help="Buttondown api id.",
+)
+buttondown_api_url_option = option_with_envvar(
+    "--buttondown-api-url",
+    default=buttondown_api.BUTTONDOWN_API_URL,
+    show_default=True,
+    envvar="BUTTONDOWN_API_URL",
+    help="The Buttondown API to talk to. Useful for testing against a fake Buttondown.",
+)
+concurrency_option = option_with_envvar(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    envvar="BUTTONDOWN_CONCURRENCY",
+    help="How many changes to make to Buttondown in parallel. Changes that touch the same email address are always made one after another.",
+)
+
+requests_per_second_option = option_with_envvar(
+    "--buttondown-requests-per-second",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    envvar="BUTTONDOWN_REQUESTS_PER_SECOND",
+    help="Never make more than this many requests per second to Buttondown. Regardless of this setting, we slow down (and retry) whenever Buttondown tells us we are going too fast.",
+)
+
+page_prefetch_option = option_with_envvar(
+    "--buttondown-page-prefetch",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    envvar="BUTTONDOWN_PAGE_PREFETCH",
+    help="How many pages of Buttondown subscribers to fetch at once.",
+)
+
+# The options needed to load subscribers from Baserow.
+baserow_options_list = [
+    option_with_envvar(
+        "--baserow-api-key",
+        required=True,
+        envvar="BASEROW_API_KEY",
+        help="Baserow api key.",
+    ),
+    option_with_envvar(
+        "--baserow-table-id",
+        type=int,
+        required=True,
+        envvar="BASEROW_TABLE_ID",
+        help="Baserow table id.",
+    ),
+    option_with_envvar(
+        "baserow_tags_columns",
+        "--baserow-tags-column",
+        multiple=True,
+        type=BaserowColumnNames(),
+        envvar="BASEROW_TAGS_COLUMNS",
+        help="The name of a column in the Baserow table whose values should be converted to Buttondown tags. Can be repeated. If specified via environment variable, the value is split around commas (',')",
+    ),
+    option_with_envvar(
+        "baserow_metadata_columns",
+        "--baserow-metadata-column",
+        multiple=True,
+        type=BaserowColumnNames(),
+        envvar="BASEROW_METADATA_COLUMNS",
+        help="The name of a column in the Baserow table whose values should be converted to Buttondown metadatas. The metadata key will be the name of the column, and the value will be the singleton value in the cell. It is an error to use a column whose values are lists. For example, if you have a column 'Hair color' with value 'red', then the resulting metadata will be key='Hair color', and value='red'. Can be repeated. If specified via environment variable, the value is split around commas (',')",
+    ),
+    option_with_envvar(
+        "--baserow-url",
+        default=baserow.BASEROW_URL,
+        show_default=True,
+        envvar="BASEROW_URL",
+        help="The Baserow instance to talk to. Useful for self-hosted Baserow, or for testing against a fake Baserow.",
+    ),
+]
+
+
+def baserow_options[F: Callable[..., Any]](f: F) -> F:
+    for option in reversed(baserow_options_list):
+        f = option(f)
+    return f
+
+
+dry_run_option = option_with_envvar(
+    "--dry-run/--no-dry-run",
+    default=None,
+    envvar="BUTTONDOWN_DRY_RUN",
+    help="Do not change anything, only print out a list of what would happen.",
+)
+
+
+state_db_option = option_with_envvar(
+    "--state-db",
+    type=click.Path(dir_okay=False, path_type=Path),
+    envvar="BRBD_SYNC_STATE_DB",
+    help="A SQLite database remembering what the last successful sync pushed to Buttondown. Rows that have not changed since then (in Baserow or in Buttondown) are skipped when planning.",
+)
+
+# How to report the operations a run performs. See `sync.OutputMode`.
+output_options_list = [
+    option_with_envvar(
+        "--output",
+        "output_mode",
+        type=click.Choice([mode.value for mode in OutputMode]),
+        default=OutputMode.VERBOSE.value,
+        show_default=True,
+        envvar="BRBD_SYNC_OUTPUT",
+        help="How to report operations, as each one finishes. 'verbose' prints each one. 'summary' only counts them, which keeps big runs fast and their memory use flat. 'jsonl' counts them, and writes each one to --output-file as a line of JSON: the operation, as `sync --save-plan` would write it, plus its status ('ok', 'skipped', 'failed', or 'planned' in a dry run).",
+    ),
+    option_with_envvar(
+        "--output-file",
+        type=click.File("w", lazy=False),
+        envvar="BRBD_SYNC_OUTPUT_FILE",
+        help="Where --output=jsonl writes operations.",
+    ),
+]
+
+
+def output_options[F: Callable[..., Any]](f: F) -> F:
+    for option in reversed(output_options_list):
+        f = option(f)
+    return f
+
+
+def check_output_options(output_mode: str, output_file: TextIO | None) -> OutputMode:
+    mode = OutputMode(output_mode)
+    if (mode == OutputMode.JSONL) != (output_file is not None):
+        raise click.UsageError("--output=jsonl and --output-file go together")
+    return mode
+
+
+# Profiling is for finding out where a run's time and memory go, so these
+# pair well with --dry-run: a production-sized run can be profiled without
+# touching Buttondown.
+profiling_options_list = [
+    click.option(
+        "--profile-cpu",
+        type=click.Path(dir_okay=False, path_type=Path),
+        help="Profile the whole run with cProfile, and write the stats to this file. Inspect them with `python -m pstats PATH`.",
+    ),
+    click.option(
+        "--profile-memory",
+        is_flag=True,
+        help="Trace memory allocations, and when done, print how much memory each phase of the run needed and which lines allocated the most. This makes the run a lot slower.",
+    ),
+]
+
+
+def profiling_options[F: Callable[..., Any]](f: F) -> F:
+    for option in reversed(profiling_options_list):
+        f = option(f)
+    return f
+
+
+# Profile the rest of the current command, as asked by `profiling_options`.
+def start_profiling(metrics: Metrics, profile_cpu: Path | None, profile_memory: bool):
+    ctx = click.get_current_context()
+    if profile_memory:
+        ctx.with_resource(profiling.memory_profile(metrics))
+    if profile_cpu is not None:
+        ctx.with_resource(profiling.cpu_profile(profile_cpu))
+
+
+# Run every shard of a sync in its own process on this machine. Each gets the
+# arguments this process got, plus its --shard-index. Their output is
+# relayed, prefixed with the shard it came from.
+def run_shards(shards: int, dry_run: bool, requests_per_second: float | None):
+    args = [
+        *click.get_current_context().meta[ARGS_META_KEY],
+        "--dry-run" if dry_run else "--no-dry-run",
+    ]
+    # The shards share Buttondown's rate limit.
+    if requests_per_second is not None:
+        args.append(f"--buttondown-requests-per-second={requests_per_second / shards}")
+
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from brbd_sync.cli import main; main(prog_name='brbd-sync')",
+                *args,
+                f"--shard-index={index}",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        for index in range(shards)
+    ]
+
+    def relay(index: int, process: subprocess.Popen[str]):
+        assert process.stdout is not None
+        with process.stdout:
+            for line in process.stdout:
+                click.echo(f"[shard {index}] {line}", nl=False)
+
+    relays = [
+        threading.Thread(target=relay, args=(index, process))
+        for index, process in enumerate(processes)
+    ]
+    for thread in relays:
+        thread.start()
+    for thread in relays:
+        thread.join()
+
+    failed = [str(i) for i, process in enumerate(processes) if process.wait() != 0]
+    if len(failed) > 0:
+        raise click.ClickException(
+            f"Shard(s) {', '.join(failed)} failed. See above for details."
+        )
+    click.secho(f"All {shards} shard(s) succeeded.", fg="green")
+
+
+def report(sync_result: SyncResult, dry_run: bool):
+    if len(sync_result.warnings) == 0:
+        success_prefix = '"Succeeded" (this was a dry run)' if dry_run else "Succeeded"
+        click.secho(
+            f"{success_prefix} after {sync_result.operation_count} operation(s). See above for details.",
+            fg="green",
+        )
+    else:
+        click.secho(
+            f"Performed {sync_result.operation_count} operation(s), but encountered {len(sync_result.warnings)} warning(s). See above for details.",
+            fg="yellow",
+        )
+
+    if sync_result.operation_count > 0:
+        counts = ", ".join(
+            f"{count} {op_type}"
+            for op_type, count in sorted(sync_result.operation_counts.items())
+        )
+        click.echo(f"Operations by type: {counts}")
+
+    if sync_result.api_calls_saved > 0:
+        click.echo(
+            f"Bulk actions saved {sync_result.api_calls_saved} API call(s) to Buttondown."
+        )
+
+
+def timed[T](label: str, load: Callable[[], T]) -> T:
+    start = time.perf_counter()
+    try:
+        result = load()
+    except Exception:
+        click.secho(f"Failed to load {label}", fg="red", err=True)
+        raise
+
+    click.echo(f"Loaded {label} in {time.perf_counter() - start:.2f}s")
+    return result
+
+
+# Run `timed(label, load)` in a background thread. It's a daemon thread, so if
+# we give up on it (say, because another load failed), it doesn't keep the
+# process alive.
+def timed_in_background[T](label: str, load: Callable[[], T]) -> Future[T]:
+    future: Future[T] = Future()
+
+    def run():
+        try:
+            future.set_result(timed(label, load))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+# Baserow and Buttondown are completely independent, so load them at the same
+# time. If either load fails, its error is raised as soon as it happens.
+def load_concurrently[A, B](
+    a: tuple[str, Callable[[], A]], b: tuple[str, Callable[[], B]]
+) -> tuple[A, B]:
+    future_a = timed_in_background(*a)
+    future_b = timed_in_background(*b)
+    done, _ = wait([future_a, future_b], return_when=FIRST_EXCEPTION)
+
+    # Don't wait for the other load if this one failed.
+    for future in done:
+        e = future.exception()
+        if e is not None:
+            raise e
+
+    return future_a.result(), future_b.result()
+
+
+def write_metrics(
+    metrics: Metrics, json_path: Path | None, prometheus_path: Path | None
+):
+    report = metrics.report()
+    if json_path is not None:
+        write_atomically(json_path, report.model_dump_json(indent=2) + "\n")
+
+    # The textfile collector may read the file at any moment, so it's
+    # important that this is atomic.
+    if prometheus_path is not None:
+        write_atomically(prometheus_path, report.to_prometheus())
+
+
+def report_request_stats(api_client: buttondown_api.Client):
+    stats = api_client.request_stats()
+    click.echo(
+        f"Made {stats.requests} request(s) to Buttondown over {stats.connections} connection(s). {stats.throttled} request(s) were throttled, {stats.retried} were retried."
+    )
+
+
+@click.group(
+    cls=DefaultCommandGroup, context_settings={"auto_envvar_prefix": "BRBD_SYNC"}
 )
+def main():
+    """
+    Two-way sync between Baserow and Buttondown.
+    """
+
+
+@main.command("sync")
+@baserow_options
 @option_with_envvar(
-    "--baserow-table-id",
-    type=int,
-    required=True,
-    envvar="BASEROW_TABLE_ID",
-    help="Baserow table id.",
+    "--baserow-last-modified-column",
+    envvar="BASEROW_LAST_MODIFIED_COLUMN",
+    help="The name of a 'Last modified' column in the Baserow table. Together with --baserow-snapshot, this lets brbd-sync fetch only the rows that changed since the last run.",
 )
 @option_with_envvar(
-    "baserow_tags_columns",
-    "--baserow-tags-column",
-    multiple=True,
-    type=BaserowColumnNames(),
-    envvar="BASEROW_TAGS_COLUMNS",
-    help="The name of a column in the Baserow table whose values should be converted to Buttondown tags. Can be repeated. If specified via environment variable, the value is split around commas (',')",
+    "--baserow-snapshot",
+    type=click.Path(dir_okay=False, path_type=Path),
+    envvar="BASEROW_SNAPSHOT",
+    help="Keep a snapshot of the Baserow table in this file. Requires --baserow-last-modified-column. The snapshot is updated every time the table is loaded.",
 )
 @option_with_envvar(
-    "baserow_metadata_columns",
-    "--baserow-metadata-column",
-    multiple=True,
-    type=BaserowColumnNames(),
-    envvar="BASEROW_METADATA_COLUMNS",
-    help="The name of a column in the Baserow table whose values should be converted to Buttondown metadatas. The metadata key will be the name of the column, and the value will be the singleton value in the cell. It is an error to use a column whose values are lists. For example, if you have a column 'Hair color' with value 'red', then the resulting metadata will be key='Hair color', and value='red'. Can be repeated. If specified via environment variable, the value is split around commas (',')",
+    "--baserow-full-refresh-hours",
+    type=click.FloatRange(min=0),
+    default=24,
+    show_default=True,
+    envvar="BASEROW_FULL_REFRESH_HOURS",
+    help="Ignore a --baserow-snapshot older than this, and fetch every row from Baserow.",
 )
+@buttondown_api_key_option
+@buttondown_api_url_option
+@dry_run_option
+@concurrency_option
+@requests_per_second_option
+@page_prefetch_option
 @option_with_envvar(
-    "--buttondown-api-key",
-    required=True,
-    envvar="BUTTONDOWN_API_KEY",
-    help="Buttondown api id.",
+    "--buttondown-snapshot",
+    type=click.Path(dir_okay=False, path_type=Path),
+    envvar="BUTTONDOWN_SNAPSHOT",
+    help="Keep a snapshot of Buttondown in this file. If it exists, only subscribers that changed since the snapshot was taken are fetched from Buttondown. The snapshot is updated after every successful sync.",
 )
 @option_with_envvar(
-    "--dry-run/--no-dry-run",
-    default=None,
-    envvar="BUTTONDOWN_DRY_RUN",
-    help="Do not change anything, only print out a list of what would happen.",
+    "--buttondown-full-refresh-hours",
+    type=click.FloatRange(min=0),
+    default=24,
+    show_default=True,
+    envvar="BUTTONDOWN_FULL_REFRESH_HOURS",
+    help="Ignore a --buttondown-snapshot older than this, and fetch all subscribers from Buttondown. Fetching only changes can miss deleted subscribers, so this guards against drift.",
+)
+@state_db_option
+@option_with_envvar(
+    "--buttondown-bulk-min-size",
+    type=click.IntRange(min=0),
+    default=DEFAULT_MIN_BATCH_SIZE,
+    show_default=True,
+    envvar="BUTTONDOWN_BULK_MIN_SIZE",
+    help="Use a Buttondown bulk action to delete at least this many subscribers, or to make the same tag change to at least this many subscribers. 0 means never use bulk actions.",
 )
-def main(
+@option_with_envvar(
+    "--metrics-json",
+    type=click.Path(dir_okay=False, path_type=Path),
+    envvar="BRBD_SYNC_METRICS_JSON",
+    help="When done (even if the sync failed), write metrics about this run to this file as JSON: how long each phase took, HTTP request counts and latencies, operation counts, skipped emails, and subscriber counts.",
+)
+@option_with_envvar(
+    "--metrics-prometheus",
+    type=click.Path(dir_okay=False, path_type=Path),
+    envvar="BRBD_SYNC_METRICS_PROMETHEUS",
+    help="Like --metrics-json, but in the Prometheus text format. Point the node exporter's textfile collector at this file (its name must end in .prom).",
+)
+@click.option(
+    "--save-plan",
+    type=click.File("w"),
+    help="Write the planned operations to this file (as JSON Lines), so they can be reviewed and later performed with `brbd-sync apply`. Combine with --dry-run to only plan.",
+)
+@option_with_envvar(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    envvar="BRBD_SYNC_SHARDS",
+    help="Split the sync into this many independent shards, by subscriber id. Subscribers who share an email (for example, when an email moves from one row to another) always end up in the same shard, so shards never race on an email. Run each shard with --shard-index, or leave that out to run every shard in its own process on this machine. Can't be combined with --buttondown-snapshot or --state-db, which describe all of Buttondown.",
+)
+@option_with_envvar(
+    "--shard-index",
+    type=click.IntRange(min=0),
+    envvar="BRBD_SYNC_SHARD_INDEX",
+    help="Which of the --shards to sync, counting from 0.",
+)
+@output_options
+@profiling_options
+def sync_command(
     baserow_api_key: str,
     baserow_table_id: int,
     baserow_tags_columns: list[str],
     baserow_metadata_columns: list[str],
+    baserow_url: str,
+    baserow_last_modified_column: str | None,
+    baserow_snapshot: Path | None,
+    baserow_full_refresh_hours: float,
     buttondown_api_key: str,
+    buttondown_api_url: str,
     dry_run: bool | None,
-):  # pragma: no cover (requires internet)
+    concurrency: int,
+    buttondown_requests_per_second: float | None,
+    buttondown_page_prefetch: int,
+    buttondown_snapshot: Path | None,
+    buttondown_full_refresh_hours: float,
+    state_db: Path | None,
+    buttondown_bulk_min_size: int,
+    metrics_json: Path | None,
+    metrics_prometheus: Path | None,
+    save_plan: TextIO | None,
+    shards: int,
+    shard_index: int | None,
+    output_mode: str,
+    output_file: TextIO | None,
+    profile_cpu: Path | None,
+    profile_memory: bool,
+):
+    """
+    Make Buttondown match Baserow. This is the default command.
+    """
     logging.basicConfig()
+    mode = check_output_options(output_mode, output_file)
+
+    if baserow_snapshot is not None and baserow_last_modified_column is None:
+        raise click.UsageError(
+            "--baserow-snapshot requires --baserow-last-modified-column"
+        )
+
+    if shard_index is not None and shard_index >= shards:
+        raise click.UsageError("--shard-index must be less than --shards")
+
+    if shards > 1 and (buttondown_snapshot is not None or state_db is not None):
+        raise click.UsageError(
+            "--buttondown-snapshot and --state-db can't be used with --shards"
+        )
+
+    # Without --shard-index, every shard runs on this machine. See `run_shards`.
+    launch_shards = shards > 1 and shard_index is None
+    if launch_shards:
+        files = {
+            "--save-plan": save_plan,
+            "--output-file": output_file,
+            "--metrics-json": metrics_json,
+            "--metrics-prometheus": metrics_prometheus,
+            "--profile-cpu": profile_cpu,
+        }
+        for option, file in files.items():
+            if file is not None:
+                raise click.UsageError(
+                    f"Every shard would write to the same {option}. Run each shard with --shard-index instead."
+                )
 
     if dry_run is None:
         dry_run = prompt("Dry run?", {"Y": True, "n": False})
 
+    if launch_shards:
+        run_shards(shards, dry_run, buttondown_requests_per_second)
+        return
+
+    metrics = Metrics()
+    click.get_current_context().call_on_close(
+        lambda: write_metrics(metrics, metrics_json, metrics_prometheus)
+    )
+    start_profiling(metrics, profile_cpu, profile_memory)
+
     if dry_run:
         click.secho("Doing a dry run", fg="yellow")
 
-    baserow_data = baserow.Data.load(
-        api_key=baserow_api_key,
-        table_id=baserow_table_id,
-        tags_column_names=baserow_tags_columns,
-        metadata_column_names=baserow_metadata_columns,
-    )
-    buttondown_data = buttondown.Data.load(
-        api_client=buttondown_api.Client(buttondown_api_key)
+    def load_baserow() -> baserow.Data:
+        with metrics.phase("baserow_load"):
+            if baserow_snapshot is None or baserow_last_modified_column is None:
+                return baserow.Data.load(
+                    api_key=baserow_api_key,
+                    table_id=baserow_table_id,
+                    tags_column_names=baserow_tags_columns,
+                    metadata_column_names=baserow_metadata_columns,
+                    url=baserow_url,
+                    metrics=metrics,
+                )
+
+            return baserow.Data.load_incrementally(
+                api_key=baserow_api_key,
+                table_id=baserow_table_id,
+                tags_column_names=baserow_tags_columns,
+                metadata_column_names=baserow_metadata_columns,
+                last_modified_column_name=baserow_last_modified_column,
+                snapshot_path=baserow_snapshot,
+                full_refresh_interval=timedelta(hours=baserow_full_refresh_hours),
+                url=baserow_url,
+                metrics=metrics,
+            )
+
+    started_at = datetime.now(timezone.utc)
+    previous_snapshot = None
+    if buttondown_snapshot is not None:
+        previous_snapshot = buttondown.Snapshot.read(buttondown_snapshot)
+        if previous_snapshot is not None and previous_snapshot.needs_full_refresh(
+            started_at, timedelta(hours=buttondown_full_refresh_hours)
+        ):
+            click.echo("Buttondown snapshot is due for a full refresh")
+            previous_snapshot = None
+
+    buttondown_api_client = buttondown_api.Client(
+        buttondown_api_key,
+        pool_size=max(concurrency, buttondown_page_prefetch),
+        requests_per_second=buttondown_requests_per_second,
+        page_prefetch=buttondown_page_prefetch,
+        base_url=buttondown_api_url,
+        metrics=metrics,
     )
 
-    sync_result = sync(baserow_data, buttondown_data, dry_run=dry_run)
+    def load_buttondown() -> buttondown.Data:
+        with metrics.phase("buttondown_load"):
+            return buttondown.Data.load(
+                api_client=buttondown_api_client, previous=previous_snapshot
+            )
 
-    if len(sync_result.warnings) == 0:
-        success_prefix = '"Succeeded" (this was a dry run)' if dry_run else "Succeeded"
-        click.secho(
-            f"{success_prefix} after {len(sync_result.operations)} operation(s). See above for details.",
-            fg="green",
+    baserow_data, buttondown_data = load_concurrently(
+        ("Baserow", load_baserow), ("Buttondown", load_buttondown)
+    )
+    click.echo(f"Downloaded {metrics.response_bytes('baserow')} byte(s) from Baserow")
+
+    if shard_index is not None:
+        with metrics.phase("shard"):
+            baserow_data, buttondown_data = shard_data(
+                baserow_data, buttondown_data, shards, shard_index
+            )
+        click.echo(
+            f"Shard {shard_index} of {shards} has {len(baserow_data.subscribers)} Baserow and {len(buttondown_data.subscribers)} Buttondown subscriber(s)"
         )
-    else:
-        click.secho(
-            f"Performed {len(sync_result.operations)} operation(s), but encountered {len(sync_result.warnings)} warning(s). See above for details.",
-            fg="yellow",
+
+    state_store = None if state_db is None else state.StateStore(state_db)
+    synced = changed_ids = None
+    unchanged = False
+    if state_store is not None:
+        with metrics.phase("fingerprint"):
+            fingerprints = {
+                "baserow": state.fingerprint(baserow_data.subscribers),
+                "buttondown": state.fingerprint(buttondown_data.subscribers),
+            }
+        unchanged = state_store.fingerprints() == fingerprints
+        if unchanged:
+            # No id needs looking at, but planning still warns about
+            # duplicate emails and direct signups, which haven't gone away.
+            click.echo("Nothing changed since the last recorded sync")
+            changed_ids, synced = set(), {}
+        else:
+            # If both sides were loaded incrementally since the last recorded
+            # sync, only what changed needs looking at.
+            changed_ids = state_store.changed_ids(
+                {"baserow": baserow_data.changes, "buttondown": buttondown_data.changes}
+            )
+            synced = state_store.synced_subscribers(changed_ids)
+    the_plan = plan(
+        baserow_data,
+        buttondown_data,
+        synced=synced,
+        min_batch_size=buttondown_bulk_min_size or None,
+        metrics=metrics,
+        changed_ids=changed_ids,
+    )
+    if save_plan is not None:
+        the_plan.write(save_plan)
+
+    sync_result = apply(
+        the_plan,
+        buttondown_data.api_client,
+        dry_run=dry_run,
+        concurrency=concurrency,
+        metrics=metrics,
+        output_mode=mode,
+        jsonl=output_file,
+        buttondown_data=buttondown_data,
+    )
+    report(sync_result, dry_run=dry_run)
+    report_request_stats(buttondown_data.api_client)
+
+    # `apply` kept `buttondown_data` up to date with the operations that
+    # succeeded (and skipped ones left Buttondown alone), so it's exactly
+    # what Buttondown looks like now.
+    if buttondown_snapshot is not None:
+        buttondown_data.snapshot(
+            taken_at=started_at,
+            last_full_refresh_at=started_at
+            if previous_snapshot is None
+            else previous_snapshot.last_full_refresh_at,
+        ).write(buttondown_snapshot)
+
+    if state_store is not None:
+        if not dry_run and sync_result.skipped_count == 0:
+            snapshots_taken_at = {}
+            if baserow_data.snapshot_taken_at is not None:
+                snapshots_taken_at["baserow"] = baserow_data.snapshot_taken_at
+            if buttondown_snapshot is not None:
+                snapshots_taken_at["buttondown"] = started_at
+            if len(the_plan.operations) > 0:
+                fingerprints["buttondown"] = state.fingerprint(
+                    buttondown_data.subscribers
+                )
+            changes = state_store.record_sync(
+                []
+                if unchanged
+                else state.synced_subscribers(baserow_data, changed_ids),
+                synced_at=started_at,
+                snapshots_taken_at=snapshots_taken_at,
+                ids=changed_ids,
+                fingerprints=fingerprints,
+            )
+            click.echo(f"Recorded {len(changes)} changed row(s) in {state_db}")
+        state_store.close()
+
+    metrics.succeeded = True
+
+
+@main.command("apply")
+@click.argument("plan_file", metavar="PLAN", type=click.File("r"))
+@buttondown_api_key_option
+@buttondown_api_url_option
+@concurrency_option
+@requests_per_second_option
+@output_options
+@profiling_options
+def apply_command(
+    plan_file: TextIO,
+    buttondown_api_key: str,
+    buttondown_api_url: str,
+    concurrency: int,
+    buttondown_requests_per_second: float | None,
+    output_mode: str,
+    output_file: TextIO | None,
+    profile_cpu: Path | None,
+    profile_memory: bool,
+):
+    """
+    Perform the operations in a plan previously saved with `brbd-sync sync
+    --save-plan`.
+    """
+    logging.basicConfig()
+    mode = check_output_options(output_mode, output_file)
+
+    metrics = Metrics()
+    start_profiling(metrics, profile_cpu, profile_memory)
+
+    api_client = buttondown_api.Client(
+        buttondown_api_key,
+        pool_size=concurrency,
+        requests_per_second=buttondown_requests_per_second,
+        base_url=buttondown_api_url,
+        metrics=metrics,
+    )
+    sync_result = apply(
+        Plan.read(plan_file),
+        api_client,
+        dry_run=False,
+        concurrency=concurrency,
+        metrics=metrics,
+        output_mode=mode,
+        jsonl=output_file,
+    )
+    report(sync_result, dry_run=False)
+    report_request_stats(api_client)
+
+
+@main.command("changes")
+@state_db_option
+def changes_command(state_db: Path | None):
+    """
+    Show what the most recent sync changed, according to --state-db. This
+    does not talk to Baserow or Buttondown.
+    """
+    if state_db is None:
+        raise click.UsageError("Missing option '--state-db'.")
+
+    with state.StateStore(state_db) as state_store:
+        last_change_at = state_store.last_change_at()
+        if last_change_at is None:
+            click.echo("No changes recorded yet.")
+            return
+
+        click.echo(f"Changes synced at {last_change_at.isoformat()}:")
+        for _synced_at, change in state_store.changes_since(last_change_at):
+            if change.subscriber is None:
+                click.echo(f"  Removed row {change.id}")
+            else:
+                sub = change.subscriber
+                click.echo(
+                    f"  Row {change.id}: email={sub.email!r} tags={sorted(sub.tags)!r} metadata={sub.metadata!r}"
+                )
+
+
+@main.command("serve")
+@baserow_options
+@buttondown_api_key_option
+@buttondown_api_url_option
+@dry_run_option
+@concurrency_option
+@requests_per_second_option
+@page_prefetch_option
+@option_with_envvar(
+    "--host",
+    default="127.0.0.1",
+    show_default=True,
+    envvar="BRBD_SYNC_HOST",
+    help="The address to listen for webhooks on.",
+)
+@option_with_envvar(
+    "--port",
+    type=int,
+    default=8000,
+    show_default=True,
+    envvar="BRBD_SYNC_PORT",
+    help="The port to listen for webhooks on.",
+)
+@option_with_envvar(
+    "--webhook-secret",
+    required=True,
+    envvar="BRBD_SYNC_WEBHOOK_SECRET",
+    help="Webhooks are only accepted if their URL includes this as a `?secret=` query parameter.",
+)
+@option_with_envvar(
+    "--full-sync-minutes",
+    type=click.FloatRange(min=0, min_open=True),
+    default=60,
+    show_default=True,
+    envvar="BRBD_SYNC_FULL_SYNC_MINUTES",
+    help="How often to do a full sync, in case we missed a webhook.",
+)
+def serve_command(
+    baserow_api_key: str,
+    baserow_table_id: int,
+    baserow_tags_columns: list[str],
+    baserow_metadata_columns: list[str],
+    baserow_url: str,
+    buttondown_api_key: str,
+    buttondown_api_url: str,
+    dry_run: bool | None,
+    concurrency: int,
+    buttondown_requests_per_second: float | None,
+    buttondown_page_prefetch: int,
+    host: str,
+    port: int,
+    webhook_secret: str,
+    full_sync_minutes: float,
+):  # pragma: no cover (runs forever)
+    """
+    Keep Buttondown in sync with Baserow in real time, by listening for
+    webhooks.
+
+    Point a Baserow webhook (with "user field names" enabled) for row
+    creations, updates, and deletions at /webhooks/baserow?secret=..., and a
+    Buttondown webhook for subscriber events at /webhooks/buttondown?secret=...
+    Only the affected rows are synced when a webhook arrives.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    if dry_run is None:
+        dry_run = prompt("Dry run?", {"Y": True, "n": False})
+
+    if dry_run:
+        click.secho("Doing a dry run", fg="yellow")
+
+    buttondown_api_client = buttondown_api.Client(
+        buttondown_api_key,
+        pool_size=max(concurrency, buttondown_page_prefetch),
+        requests_per_second=buttondown_requests_per_second,
+        page_prefetch=buttondown_page_prefetch,
+        base_url=buttondown_api_url,
+    )
+    table = baserow.get_table(baserow_api_key, baserow_table_id, url=baserow_url)
+
+    def load() -> tuple[baserow.Data, buttondown.Data]:
+        return load_concurrently(
+            (
+                "Baserow",
+                lambda: baserow.Data.load(
+                    api_key=baserow_api_key,
+                    table_id=baserow_table_id,
+                    tags_column_names=baserow_tags_columns,
+                    metadata_column_names=baserow_metadata_columns,
+                    url=baserow_url,
+                ),
+            ),
+            ("Buttondown", lambda: buttondown.Data.load(buttondown_api_client)),
         )
+
+    def subscribers_from_rows(
+        rows: list[dict[str, Any]],
+    ) -> dict[int, list[baserow.Subscriber]]:
+        return {
+            row["id"]: baserow.subscribers_from_row(
+                Row(row_data=row, table=table, client=table.client),
+                tags_column_names=baserow_tags_columns,
+                metadata_column_names=baserow_metadata_columns,
+            )
+            for row in rows
+        }
+
+    baserow_data, buttondown_data = load()
+    live_sync = serve.LiveSync(
+        baserow_data, buttondown_data, dry_run=dry_run, concurrency=concurrency
+    )
+    report(live_sync.reconcile(baserow_data, buttondown_data), dry_run=dry_run)
+
+    events: queue.Queue[serve.Event] = queue.Queue()
+    server = ThreadingHTTPServer(
+        (host, port), serve.make_webhook_handler(webhook_secret, events)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    click.echo(f"Listening for webhooks on http://{host}:{port}")
+
+    serve.process_events(
+        live_sync,
+        events,
+        load=load,
+        subscribers_from_rows=subscribers_from_rows,
+        reconcile_interval=timedelta(minutes=full_sync_minutes),
+    )
@@ -1,6 +1,20 @@
+import pstats
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator
+
+import pytest
 from click.testing import CliRunner
+from fake_servers import FakeBaserow, FakeButtondown
 
-from .cli import main
+from . import buttondown, sync
+from .buttondown_api import Client, EditSub
+from .cli import load_concurrently, main, report, report_request_stats
+from .metrics import MetricsReport
+from .state import StateStore, SyncedSubscriber
+from .sync import SyncResult
 
 
 def test_main():
@@ -8,3 +22,532 @@ def test_main():
     result = runner.invoke(main, ["--help"])
     assert result.exit_code == 0
     assert "Usage:" in result.output
+    assert "apply" in result.output
+
+
+def test_sync_is_default_command():
+    runner = CliRunner()
+    result = runner.invoke(main, ["--dry-run", "--help"])
+    assert result.exit_code == 0
+    assert "--baserow-api-key" in result.output
+
+
+def test_apply_help():
+    runner = CliRunner()
+    result = runner.invoke(main, ["apply", "--help"])
+    assert result.exit_code == 0
+    assert "Usage: main apply [OPTIONS] PLAN" in result.output
+
+
+def test_report(capsys):
+    report(SyncResult(), dry_run=True)
+    assert capsys.readouterr().out == (
+        '"Succeeded" (this was a dry run) after 0 operation(s). See above for details.\n'
+    )
+
+    report(SyncResult(warnings=["uh oh"]), dry_run=False)
+    assert capsys.readouterr().out == (
+        "Performed 0 operation(s), but encountered 1 warning(s). See above for details.\n"
+    )
+
+    report(SyncResult(api_calls_saved=42), dry_run=False)
+    assert capsys.readouterr().out == (
+        "Succeeded after 0 operation(s). See above for details.\n"
+        "Bulk actions saved 42 API call(s) to Buttondown.\n"
+    )
+
+    report(SyncResult(operation_counts={"DeleteSub": 1, "AddSub": 2}), dry_run=False)
+    assert capsys.readouterr().out == (
+        "Succeeded after 3 operation(s). See above for details.\n"
+        "Operations by type: 2 AddSub, 1 DeleteSub\n"
+    )
+
+
+def test_report_request_stats(capsys):
+    report_request_stats(Client(api_key="bogus"))
+    assert capsys.readouterr().out == (
+        "Made 0 request(s) to Buttondown over 0 connection(s). 0 request(s) were throttled, 0 were retried.\n"
+    )
+
+
+def test_load_concurrently(capsys):
+    # Neither load can finish unless both are running at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def load(value: str) -> str:
+        barrier.wait()
+        return value
+
+    assert load_concurrently(
+        ("Baserow", lambda: load("baserow")),
+        ("Buttondown", lambda: load("buttondown")),
+    ) == ("baserow", "buttondown")
+
+    lines = sorted(capsys.readouterr().out.splitlines())
+    assert [line.split(" in ")[0] for line in lines] == [
+        "Loaded Baserow",
+        "Loaded Buttondown",
+    ]
+
+
+def test_load_concurrently_failure(capsys):
+    release_buttondown = threading.Event()
+
+    def fail():
+        raise RuntimeError("Baserow is down")
+
+    # The Baserow error is raised without waiting for Buttondown to finish.
+    with pytest.raises(RuntimeError, match="Baserow is down"):
+        load_concurrently(
+            ("Baserow", fail),
+            ("Buttondown", lambda: release_buttondown.wait(timeout=5)),
+        )
+    release_buttondown.set()
+
+    assert capsys.readouterr().err == "Failed to load Baserow\n"
+
+
+def test_load_concurrently_second_failure(capsys):
+    release_baserow = threading.Event()
+    baserow_finished = threading.Event()
+
+    def load_baserow():
+        release_baserow.wait(timeout=5)
+        baserow_finished.set()
+
+    def fail():
+        raise RuntimeError("Buttondown is down")
+
+    # The Buttondown error is raised without waiting for Baserow to finish.
+    with pytest.raises(RuntimeError, match="Buttondown is down"):
+        load_concurrently(("Baserow", load_baserow), ("Buttondown", fail))
+    assert not baserow_finished.is_set()
+    release_baserow.set()
+
+    assert capsys.readouterr().err == "Failed to load Buttondown\n"
+
+
+def test_changes(tmp_path: Path):
+    state_db = tmp_path / "state.sqlite3"
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["changes"])
+    assert result.exit_code == 2
+    assert "Missing option '--state-db'." in result.output
+
+    result = runner.invoke(main, ["changes", "--state-db", str(state_db)])
+    assert result.exit_code == 0
+    assert result.output == "No changes recorded yet.\n"
+
+    with StateStore(state_db) as store:
+        sub = SyncedSubscriber(
+            id="1", email="j1@example.com", tags={"colby"}, metadata={"id": "1"}
+        )
+        store.record_sync([sub], synced_at=datetime(2025, 1, 1, tzinfo=timezone.utc))
+        store.record_sync([], synced_at=datetime(2025, 1, 2, tzinfo=timezone.utc))
+
+    result = runner.invoke(main, ["changes", "--state-db", str(state_db)])
+    assert result.exit_code == 0
+    assert result.output == (
+        "Changes synced at 2025-01-02T00:00:00+00:00:\n  Removed row 1\n"
+    )
+
+    with StateStore(state_db) as store:
+        store.record_sync([sub], synced_at=datetime(2025, 1, 3, tzinfo=timezone.utc))
+
+    result = runner.invoke(main, ["changes", "--state-db", str(state_db)])
+    assert result.output == (
+        "Changes synced at 2025-01-03T00:00:00+00:00:\n"
+        "  Row 1: email='j1@example.com' tags=['colby'] metadata={'id': '1'}\n"
+    )
+
+
+# Fake Baserow and Buttondown servers, and the arguments that point
+# `brbd-sync sync` at them. Tests add whatever other flags they need.
+@dataclass
+class FakeServers:
+    baserow: FakeBaserow
+    buttondown: FakeButtondown
+    args: list[str]
+
+
+@pytest.fixture
+def fake_servers() -> Iterator[FakeServers]:
+    field_types = {
+        "Email": "email",
+        "Full Name": "text",
+        "Tags": "multiple_select",
+        "Modified": "last_modified",
+    }
+    with (
+        FakeBaserow("br-key", table_id=1, field_types=field_types) as fake_baserow,
+        FakeButtondown("bd-key") as fake_buttondown,
+    ):
+        yield FakeServers(
+            baserow=fake_baserow,
+            buttondown=fake_buttondown,
+            args=[
+                "--baserow-api-key=br-key",
+                "--baserow-table-id=1",
+                f"--baserow-url={fake_baserow.url}",
+                "--buttondown-api-key=bd-key",
+                f"--buttondown-api-url={fake_buttondown.url}",
+            ],
+        )
+
+
+def test_sync_against_fake_servers(tmp_path: Path, fake_servers: FakeServers):
+    fake_servers.baserow.set_row(1, {"Email": "new@example.com", "Tags": ["member"]})
+    fake_servers.baserow.set_row(2, {"Email": "same@example.com"})
+    fake_servers.buttondown.add_subscriber("same@example.com", metadata={"id": "2"})
+    fake_servers.buttondown.add_subscriber("gone@example.com", metadata={"id": "3"})
+
+    result = CliRunner().invoke(
+        main,
+        [
+            "sync",
+            *fake_servers.args,
+            "--no-dry-run",
+            "--baserow-tags-column=Tags",
+            f"--metrics-json={tmp_path / 'metrics.json'}",
+            f"--metrics-prometheus={tmp_path / 'metrics.prom'}",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 2 operation(s)." in result.output
+
+    assert sorted(
+        (sub["email_address"], sub["tags"], sub["metadata"])
+        for sub in fake_servers.buttondown.subscribers.values()
+    ) == [
+        ("new@example.com", ["member"], {"id": "1"}),
+        ("same@example.com", [], {"id": "2"}),
+    ]
+
+    report = MetricsReport.model_validate_json((tmp_path / "metrics.json").read_text())
+    assert report.succeeded
+    assert sorted(report.phase_seconds) == [
+        "apply",
+        "baserow_load",
+        "buttondown_load",
+        "dedupe",
+        "diff",
+    ]
+    assert report.operations == {"AddSub": 1, "DeleteSub": 1}
+    assert report.subscribers == {"baserow": 2, "buttondown": 2}
+    assert sorted(
+        (r.service, r.method, r.endpoint, r.status, r.latency_seconds.count)
+        for r in report.requests
+    ) == [
+        ("baserow", "GET", "/api/database/fields/table/{id}/", 200, 1),
+        ("baserow", "GET", "/api/database/rows/table/{id}/", 200, 1),
+        ("buttondown", "DELETE", "/v1/subscribers/{id}", 204, 1),
+        ("buttondown", "GET", "/v1/subscribers", 200, 1),
+        ("buttondown", "POST", "/v1/subscribers", 201, 1),
+    ]
+
+    prometheus = (tmp_path / "metrics.prom").read_text()
+    assert "brbd_sync_last_run_success 1\n" in prometheus
+    assert 'brbd_sync_operations{type="AddSub"} 1\n' in prometheus
+
+
+def test_profile_dry_run(tmp_path: Path, fake_servers: FakeServers):
+    fake_servers.baserow.set_row(1, {"Email": "new@example.com"})
+
+    result = CliRunner().invoke(
+        main,
+        [
+            *fake_servers.args,
+            "--dry-run",
+            f"--profile-cpu={tmp_path / 'cpu.prof'}",
+            "--profile-memory",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert fake_servers.buttondown.subscribers == {}
+
+    assert f"Wrote a CPU profile to {tmp_path / 'cpu.prof'}." in result.stderr
+    stats = pstats.Stats(str(tmp_path / "cpu.prof"))
+    assert any(
+        function == "diff" and filename.endswith("sync.py")
+        for filename, _, function in stats.stats  # type: ignore[attr-defined]
+    )
+
+    assert "Peak memory allocated by each phase:\n" in result.stderr
+    assert "\n  baserow_load: " in result.stderr
+    assert "\n  diff: " in result.stderr
+    assert "Largest allocations by buttondown_load still in use" in result.stderr
+
+
+def test_sync_jsonl_output(tmp_path: Path, fake_servers: FakeServers):
+    fake_servers.baserow.set_row(1, {"Email": "new@example.com"})
+    args = [*fake_servers.args, "--dry-run", "--output=jsonl"]
+
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 2
+    assert "--output=jsonl and --output-file go together" in result.output
+
+    jsonl = tmp_path / "operations.jsonl"
+    result = CliRunner().invoke(main, [*args, f"--output-file={jsonl}"])
+    assert result.exit_code == 0, result.output
+    assert "Operation AddSub" not in result.output
+    assert "Operations by type: 1 AddSub\n" in result.output
+
+    assert jsonl.read_text() == (
+        '{"AddSub":{"email":"new@example.com","tags":[],"metadata":{"id":"1"}},"status":"planned"}\n'
+    )
+
+
+def test_sync_shards(fake_servers: FakeServers):
+    fake_baserow, fake_buttondown = fake_servers.baserow, fake_servers.buttondown
+    # Rows 1 and 2 swapped emails.
+    fake_baserow.set_row(1, {"Email": "b@example.com"})
+    fake_baserow.set_row(2, {"Email": "a@example.com"})
+    fake_buttondown.add_subscriber("a@example.com", metadata={"id": "1"})
+    fake_buttondown.add_subscriber("b@example.com", metadata={"id": "2"})
+    for i in range(3, 10):
+        fake_baserow.set_row(i, {"Email": f"{i}@example.com"})
+    fake_buttondown.add_subscriber("gone@example.com", metadata={"id": "10"})
+
+    def expected_subscribers() -> list[tuple[str, dict[str, str]]]:
+        return sorted(
+            (sub["email_address"], sub["metadata"])
+            for sub in fake_buttondown.subscribers.values()
+        )
+
+    args = [*fake_servers.args, "--shards=3"]
+
+    result = CliRunner().invoke(main, [*args, "--shard-index=3"])
+    assert result.exit_code == 2
+    assert "--shard-index must be less than --shards" in result.output
+
+    result = CliRunner().invoke(main, [*args, "--state-db=state.db"])
+    assert result.exit_code == 2
+    assert "can't be used with --shards" in result.output
+
+    result = CliRunner().invoke(main, [*args, "--profile-cpu=cpu.prof"])
+    assert result.exit_code == 2
+    assert "Every shard would write to the same --profile-cpu." in result.output
+
+    # Each shard on its own, as separate machines would run them.
+    for index in range(3):
+        result = CliRunner().invoke(
+            main, [*args, "--dry-run", f"--shard-index={index}"]
+        )
+        assert result.exit_code == 0, result.output
+        assert f"Shard {index} of 3 has " in result.output
+    assert fake_buttondown.requests_by_method.keys() == {"GET"}
+
+    # All shards at once, in separate processes.
+    result = CliRunner().invoke(
+        main, [*args, "--no-dry-run", "--buttondown-requests-per-second=300"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "[shard 0] Shard 0 of 3 has " in result.output
+    assert "[shard 2] Shard 2 of 3 has " in result.output
+    assert "All 3 shard(s) succeeded." in result.output
+    assert expected_subscribers() == [
+        ("3@example.com", {"id": "3"}),
+        ("4@example.com", {"id": "4"}),
+        ("5@example.com", {"id": "5"}),
+        ("6@example.com", {"id": "6"}),
+        ("7@example.com", {"id": "7"}),
+        ("8@example.com", {"id": "8"}),
+        ("9@example.com", {"id": "9"}),
+        ("a@example.com", {"id": "2"}),
+        ("b@example.com", {"id": "1"}),
+    ]
+
+    # A shard that fails fails the whole run.
+    result = CliRunner().invoke(
+        main, [*args, "--no-dry-run", "--buttondown-api-key=wrong"]
+    )
+    assert result.exit_code == 1
+    assert "Shard(s) 0, 1, 2 failed." in result.output
+
+
+def test_sync_only_looks_at_changed_ids(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, fake_servers: FakeServers
+):
+    # Everything in this test happens within any overlap, which would make
+    # every subscriber look changed.
+    monkeypatch.setattr(buttondown, "SNAPSHOT_OVERLAP", timedelta(0))
+    looked_at: list[str] = []
+    is_unchanged = sync.is_unchanged
+    monkeypatch.setattr(
+        sync,
+        "is_unchanged",
+        lambda synced, br_data, bd_data, id: (
+            looked_at.append(id) or is_unchanged(synced, br_data, bd_data, id)
+        ),
+    )
+
+    fake_baserow = fake_servers.baserow
+    for i in range(1, 6):
+        fake_baserow.set_row(i, {"Email": f"{i}@example.com"})
+    args = [
+        *fake_servers.args,
+        "--no-dry-run",
+        "--baserow-last-modified-column=Modified",
+        f"--baserow-snapshot={tmp_path / 'baserow.json'}",
+        f"--buttondown-snapshot={tmp_path / 'buttondown.json'}",
+        f"--state-db={tmp_path / 'state.sqlite3'}",
+    ]
+
+    # There's nothing to go on yet, so everyone is looked at.
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 5 operation(s)." in result.output
+    assert sorted(looked_at) == ["1", "2", "3", "4", "5"]
+
+    # Nothing changed, so there's no need to look at anyone.
+    looked_at.clear()
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Nothing changed since the last recorded sync" in result.output
+    assert "Succeeded after 0 operation(s)." in result.output
+    assert looked_at == []
+
+    fake_baserow.set_row(3, {"Email": "three@example.com"})
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 1 operation(s)." in result.output
+    assert looked_at == ["3"]
+
+    # A dry run doesn't record anything, so the next sync can't tell what
+    # changed since the last recorded one, and looks at everyone again.
+    fake_baserow.set_row(5, {"Email": "five@example.com"})
+    result = CliRunner().invoke(main, [*args, "--dry-run"])
+    assert result.exit_code == 0, result.output
+    looked_at.clear()
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 1 operation(s)." in result.output
+    assert sorted(looked_at) == ["1", "2", "3", "4", "5"]
+
+    # A row without a "Last modified" value can't be found with a filter,
+    # so it's fetched on its own. Nothing about its subscriber changed.
+    looked_at.clear()
+    fake_baserow.rows[4]["Modified"] = None
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Nothing changed since the last recorded sync" in result.output
+    assert looked_at == []
+
+    # Snapshots due for a full refresh are ignored.
+    looked_at.clear()
+    fake_baserow.set_row(1, {"Email": "one@example.com"})
+    result = CliRunner().invoke(
+        main,
+        [
+            *args,
+            "--baserow-full-refresh-hours=0",
+            "--buttondown-full-refresh-hours=0",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Buttondown snapshot is due for a full refresh" in result.output
+    assert sorted(looked_at) == ["1", "2", "3", "4", "5"]
+
+    result = CliRunner().invoke(
+        main, [arg for arg in args if not arg.startswith("--baserow-last")]
+    )
+    assert result.exit_code == 2
+    assert "--baserow-snapshot requires --baserow-last-modified-column" in (
+        result.output
+    )
+
+    assert sorted(
+        sub["email_address"] for sub in fake_servers.buttondown.subscribers.values()
+    ) == [
+        "2@example.com",
+        "4@example.com",
+        "five@example.com",
+        "one@example.com",
+        "three@example.com",
+    ]
+
+
+def test_sync_warns_even_when_nothing_changed(
+    tmp_path: Path, fake_servers: FakeServers
+):
+    fake_servers.baserow.set_row(1, {"Email": "dupe@example.com"})
+    fake_servers.baserow.set_row(2, {"Email": "dupe@example.com"})
+    fake_servers.buttondown.add_subscriber("direct@example.com")
+    args = [*fake_servers.args, "--no-dry-run", f"--state-db={tmp_path / 'state.db'}"]
+
+    for expected_operations in [1, 0]:
+        result = CliRunner().invoke(main, args)
+        assert result.exit_code == 0, result.output
+        assert (
+            "Unexpectedly found multiple Baserow rows with email='dupe@example.com'"
+            in result.output
+        )
+        assert "need to be added to the database: direct@example.com" in result.output
+        assert (
+            f"Performed {expected_operations} operation(s), but encountered 2 warning(s)"
+            in result.output
+        )
+    assert "Nothing changed since the last recorded sync" in result.output
+
+
+def test_sync_follows_email_changes_of_added_subscribers(
+    tmp_path: Path, fake_servers: FakeServers
+):
+    fake_servers.baserow.set_row(1, {"Email": "a@example.com"})
+    args = [
+        *fake_servers.args,
+        "--no-dry-run",
+        f"--buttondown-snapshot={tmp_path / 'buttondown.json'}",
+    ]
+
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 1 operation(s)." in result.output
+
+    # Someone changes the email of the subscriber we just added, directly in
+    # Buttondown. The snapshot knows who that is, so we change it back.
+    client = Client("bd-key", base_url=fake_servers.buttondown.url)
+    EditSub(old_email="a@example.com", new_email="b@example.com").doit(client)
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert (
+        "Operation EditSub: old_email='b@example.com' new_email='a@example.com'"
+        in result.output
+    )
+    assert "Succeeded after 1 operation(s)." in result.output
+
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 0 operation(s)." in result.output
+    assert [
+        sub["email_address"] for sub in fake_servers.buttondown.subscribers.values()
+    ] == ["a@example.com"]
+
+
+def test_sync_save_plan_then_apply(tmp_path: Path, fake_servers: FakeServers):
+    fake_servers.baserow.set_row(1, {"Email": "new@example.com"})
+    fake_servers.buttondown.add_subscriber("gone@example.com", metadata={"id": "2"})
+    plan_path = tmp_path / "plan.json"
+
+    result = CliRunner().invoke(
+        main, [*fake_servers.args, f"--save-plan={plan_path}"], input="Y\n"
+    )
+    assert result.exit_code == 0, result.output
+    assert "Dry run?" in result.output
+    assert fake_servers.buttondown.requests_by_method.keys() == {"GET"}
+
+    result = CliRunner().invoke(
+        main,
+        [
+            "apply",
+            str(plan_path),
+            "--buttondown-api-key=bd-key",
+            f"--buttondown-api-url={fake_servers.buttondown.url}",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Succeeded after 2 operation(s)." in result.output
+    assert [
+        sub["email_address"] for sub in fake_servers.buttondown.subscribers.values()
+    ] == ["new@example.com"]
@@ -0,0 +1,135 @@
+import heapq
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+from . import buttondown as bd
+from . import buttondown_api as api
+
+
+# For each operation, compute the indices of the earlier operations that
+# must finish before it may start.
+#
+# Two operations conflict if they touch the same email address. For example:
+# the `DeleteSub` that frees up an email must finish before the `AddSub` that
+# reuses it, and an `EditSub` that renames a subscriber to a new email must
+# finish before anything else happens to that new email.
+#
+# It's enough to depend on the most recent operation touching each email: that
+# operation itself depends on the one before it, and so on.
+def dependencies(ops: list[api.Operation]) -> list[set[int]]:
+    last_op_by_email: dict[str, int] = {}
+    deps: list[set[int]] = []
+
+    for i, op in enumerate(ops):
+        # Buttondown treats emails case insensitively. Being overly
+        # cautious here only costs us some concurrency.
+        emails = {email.lower() for email in op.touched_emails()}
+        deps.append({last_op_by_email[e] for e in emails if e in last_op_by_email})
+        for email in emails:
+            last_op_by_email[email] = i
+
+    return deps
+
+
+# Called with each operation as soon as it finishes, along with the error it
+# failed with (None if it succeeded).
+type OnDone = Callable[[api.Operation, Exception | None], None]
+
+
+def ignore(op: api.Operation, error: Exception | None):
+    pass
+
+
+# Run the given operations against Buttondown, using up to `concurrency`
+# threads. Conflicting operations run in the order they were given, everything
+# else runs in parallel. With a concurrency of 1, operations simply run one
+# after another, in order.
+#
+# If given `buttondown_data`, each operation is applied to it once it has
+# succeeded (so operations that get skipped leave it untouched), in dependency
+# order. This keeps it exactly as serial and concurrent runs leave Buttondown.
+#
+# Returns the operations that failed with a `SkippableEmailError`, in the order
+# they were given. Any other error aborts the run (after the at most
+# `concurrency` operations in flight finish) and is re-raised.
+#
+# `on_done` hears about every operation that ran (including the one that
+# aborted the run), in the order they finished.
+def execute(
+    ops: list[api.Operation],
+    api_client: api.Client,
+    concurrency: int,
+    buttondown_data: bd.Data | None = None,
+    on_done: OnDone = ignore,
+) -> list[tuple[api.Operation, api.SkippableEmailError]]:
+    if concurrency == 1:
+        return _execute_serially(ops, api_client, buttondown_data, on_done)
+
+    deps = dependencies(ops)
+    remaining_deps = [len(d) for d in deps]
+    dependents: list[list[int]] = [[] for _ in ops]
+    for i, op_deps in enumerate(deps):
+        for dep in op_deps:
+            dependents[dep].append(i)
+
+    skipped: dict[int, api.SkippableEmailError] = {}
+
+    # Operations whose dependencies have all finished, earliest first. Only
+    # `concurrency` of them are handed to the pool at a time, so that nothing
+    # is left queued up in it if we have to give up.
+    ready = [i for i in range(len(ops)) if remaining_deps[i] == 0]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight: dict[Future, int] = {}
+
+        while len(in_flight) > 0 or len(ready) > 0:
+            while len(in_flight) < concurrency and len(ready) > 0:
+                i = heapq.heappop(ready)
+                in_flight[pool.submit(ops[i].doit, api_client)] = i
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = in_flight.pop(future)
+                try:
+                    buttondown_id = future.result()
+                except api.SkippableEmailError as e:
+                    skipped[i] = e
+                    on_done(ops[i], e)
+                except Exception as e:
+                    on_done(ops[i], e)
+                    raise
+                else:
+                    if buttondown_data is not None:
+                        buttondown_data.apply(ops[i], buttondown_id)
+                    on_done(ops[i], None)
+
+                for dependent in dependents[i]:
+                    remaining_deps[dependent] -= 1
+                    if remaining_deps[dependent] == 0:
+                        heapq.heappush(ready, dependent)
+
+    return [(ops[i], skipped[i]) for i in sorted(skipped)]
+
+
+def _execute_serially(
+    ops: list[api.Operation],
+    api_client: api.Client,
+    buttondown_data: bd.Data | None,
+    on_done: OnDone,
+) -> list[tuple[api.Operation, api.SkippableEmailError]]:
+    skipped: list[tuple[api.Operation, api.SkippableEmailError]] = []
+    for op in ops:
+        try:
+            buttondown_id = op.doit(api_client)
+        except api.SkippableEmailError as e:
+            skipped.append((op, e))
+            on_done(op, e)
+        except Exception as e:
+            on_done(op, e)
+            raise
+        else:
+            if buttondown_data is not None:
+                buttondown_data.apply(op, buttondown_id)
+            on_done(op, None)
+
+    return skipped
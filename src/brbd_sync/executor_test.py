@@ -0,0 +1,170 @@
+import threading
+from typing import Any
+
+import pytest
+
+from . import buttondown as bd
+from . import buttondown_api as api
+from .buttondown_api import AddSub, DeleteSub, EditSub
+from .executor import dependencies, execute
+
+
+class FakeClient(api.Client):
+    def __init__(
+        self,
+        skippable_emails: set[str] = set(),
+        barrier: threading.Barrier | None = None,
+    ):
+        super().__init__(api_key="bogus")
+        self.calls: list[tuple[str, str]] = []
+        self._skippable_emails = skippable_emails
+        self._barrier = barrier
+        self._lock = threading.Lock()
+
+    def _record(self, method: str, path: str):
+        if self._barrier is not None:
+            self._barrier.wait()
+
+        with self._lock:
+            self.calls.append((method, path))
+
+    def post(self, path: str, data: Any) -> Any:
+        email = data["email_address"]
+        if email in self._skippable_emails:
+            raise api.SkippableEmailError(
+                operation="add", code="email_invalid", detail="nope"
+            )
+
+        self._record("POST", f"{path}/{email}")
+        return {"id": f"bd-{email}", **data}
+
+    def patch(self, path: str, data: Any) -> Any:
+        if path.removeprefix("/v1/subscribers/") in self._skippable_emails:
+            raise api.SkippableEmailError(
+                operation="edit", code="email_invalid", detail="nope"
+            )
+
+        self._record("PATCH", path)
+        return data
+
+    def delete(self, path: str):
+        self._record("DELETE", path)
+
+
+def test_dependencies():
+    ops = [
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", new_email="J1@example.com"),
+        AddSub(email="j2@example.com", tags=set(), metadata={}),
+        EditSub(old_email="j3@example.com", tags={"colby"}),
+    ]
+    assert dependencies(ops) == [set(), {0}, {1}, set()]
+
+
+def test_execute_in_dependency_order():
+    client = FakeClient()
+    ops = [
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", new_email="j1@example.com"),
+        AddSub(email="j2@example.com", tags=set(), metadata={}),
+    ]
+    assert execute(ops, client, concurrency=4) == []
+    assert client.calls == [
+        ("DELETE", "/v1/subscribers/j1@example.com"),
+        ("PATCH", "/v1/subscribers/j2@example.com"),
+        ("POST", "/v1/subscribers/j2@example.com"),
+    ]
+
+
+def test_execute_in_parallel():
+    # Neither operation can get past the barrier unless both are running at
+    # the same time.
+    client = FakeClient(barrier=threading.Barrier(2, timeout=5))
+    ops = [
+        DeleteSub(email="j1@example.com"),
+        DeleteSub(email="j2@example.com"),
+    ]
+    assert execute(ops, client, concurrency=2) == []
+    assert sorted(client.calls) == [
+        ("DELETE", "/v1/subscribers/j1@example.com"),
+        ("DELETE", "/v1/subscribers/j2@example.com"),
+    ]
+
+
+def test_execute_skippable():
+    client = FakeClient(skippable_emails={"bad@example.com"})
+    bad_add = AddSub(email="bad@example.com", tags=set(), metadata={})
+    ops = [
+        bad_add,
+        AddSub(email="good@example.com", tags=set(), metadata={}),
+    ]
+
+    ((skipped_op, e),) = execute(ops, client, concurrency=2)
+    assert skipped_op is bad_add
+    assert e.code == "email_invalid"
+    assert client.calls == [("POST", "/v1/subscribers/good@example.com")]
+
+
+def test_execute_unexpected_error():
+    class BrokenClient(FakeClient):
+        def delete(self, path: str):
+            raise RuntimeError("oh no")
+
+    client = BrokenClient()
+    ops = [
+        DeleteSub(email="j1@example.com"),
+        AddSub(email="j1@example.com", tags=set(), metadata={}),
+    ]
+    with pytest.raises(RuntimeError, match="oh no"):
+        execute(ops, client, concurrency=2)
+
+    # The add depended on the failed delete, so it never ran.
+    assert client.calls == []
+
+
+def test_execute_stops_after_unexpected_error():
+    class BrokenClient(FakeClient):
+        def delete(self, path: str):
+            if path.endswith("/0@example.com"):
+                raise RuntimeError("oh no")
+            super().delete(path)
+
+    client = BrokenClient()
+    ops = [DeleteSub(email=f"{i}@example.com") for i in range(40)]
+    with pytest.raises(RuntimeError, match="oh no"):
+        execute(ops, client, concurrency=2)
+
+    # Only the delete that was running alongside the failed one got to run.
+    assert len(client.calls) <= 1
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_execute_updates_buttondown_data(concurrency: int):
+    client = FakeClient(skippable_emails={"bad@example.com"})
+    buttondown_data = bd.Data(
+        subscribers=[
+            bd.Subscriber(
+                id="1", email="j1@example.com", tags=frozenset(), metadata={}
+            ),
+            bd.Subscriber(
+                id="2", email="j2@example.com", tags=frozenset(), metadata={}
+            ),
+        ],
+        api_client=client,
+    )
+    ops = [
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", new_email="j1@example.com"),
+        AddSub(email="bad@example.com", tags=set(), metadata={"id": "3"}),
+        AddSub(email="j4@example.com", tags=set(), metadata={"id": "4"}),
+    ]
+    execute(ops, client, concurrency, buttondown_data)
+
+    # The skipped add never made it into our picture of Buttondown, and the
+    # other add came with the Buttondown id it was given.
+    assert sorted(
+        (sub.id, sub.email, sub.buttondown_id) for sub in buttondown_data.subscribers
+    ) == [
+        ("2", "j1@example.com", None),
+        ("4", "j4@example.com", "bd-j4@example.com"),
+    ]
@@ -0,0 +1,334 @@
+import re
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterator
+from urllib.parse import urlparse
+
+import requests
+from pydantic import BaseModel
+
+# Upper bounds (in seconds) of the buckets of our request latency histograms.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Path segments that identify a single thing (a row id, a subscriber's email
+# or id, ...). These are replaced with "{id}", so that every subscriber
+# doesn't get their own endpoint.
+ID_SEGMENT_RE = re.compile(
+    r"^(\d+|[^@]+@[^@]+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$",
+    re.IGNORECASE,
+)
+
+
+def endpoint_of(url: str) -> str:
+    path = urlparse(url).path
+    return "/".join(
+        "{id}" if ID_SEGMENT_RE.match(segment) else segment
+        for segment in path.split("/")
+    )
+
+
+# How many bytes of `response`'s body came over the wire. urllib3 counts them
+# before undoing any Content-Encoding, unlike `len(response.content)`.
+def wire_bytes(response: requests.Response) -> int:
+    # Read the whole body first.
+    response.content
+    return response.raw.tell()
+
+
+class Histogram(BaseModel):
+    # Cumulative, like Prometheus: `bucket_counts[i]` is the number of
+    # observations <= `LATENCY_BUCKETS[i]`.
+    bucket_counts: list[int] = [0] * len(LATENCY_BUCKETS)
+    count: int = 0
+    sum: float = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class RequestMetrics(BaseModel):
+    service: str
+    method: str
+    endpoint: str
+    status: int
+    latency_seconds: Histogram
+    # The total size of the response bodies, as sent over the wire. For
+    # compressed responses, that's less than what they decode to.
+    response_bytes: int = 0
+
+
+# Memory allocated at one line of code.
+class Allocation(BaseModel):
+    location: str
+    size_bytes: int
+    count: int
+
+
+class MetricsReport(BaseModel):
+    started_at: datetime
+    succeeded: bool
+    phase_seconds: dict[str, float]
+    requests: list[RequestMetrics]
+    operations: dict[str, int]
+    skipped_emails: dict[str, int]
+    subscribers: dict[str, int]
+    # Only recorded while tracemalloc is tracing (see `brbd-sync sync
+    # --profile-memory`).
+    phase_peak_memory_bytes: dict[str, int] = {}
+    phase_top_allocations: dict[str, list[Allocation]] = {}
+
+    # In the Prometheus text format, for the node exporter's textfile
+    # collector.
+    def to_prometheus(self) -> str:
+        lines: list[str] = []
+
+        def metric(
+            name: str,
+            type: str,
+            help: str,
+            samples: list[tuple[dict[str, str], float]],
+        ):
+            lines.append(f"# HELP brbd_sync_{name} {help}")
+            lines.append(f"# TYPE brbd_sync_{name} {type}")
+            for labels, value in samples:
+                lines.append(f"brbd_sync_{name}{format_labels(labels)} {value}")
+
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "When the last sync started.",
+            [({}, self.started_at.timestamp())],
+        )
+        metric(
+            "last_run_success",
+            "gauge",
+            "Whether the last sync finished without errors.",
+            [({}, int(self.succeeded))],
+        )
+        metric(
+            "phase_seconds",
+            "gauge",
+            "How long each phase of the last sync took.",
+            [({"phase": phase}, s) for phase, s in self.phase_seconds.items()],
+        )
+        metric(
+            "operations",
+            "gauge",
+            "Operations planned by the last sync, by type.",
+            [({"type": type}, n) for type, n in self.operations.items()],
+        )
+        metric(
+            "skipped_emails",
+            "gauge",
+            "Emails Buttondown refused during the last sync, by error code.",
+            [({"code": code}, n) for code, n in self.skipped_emails.items()],
+        )
+        metric(
+            "subscribers",
+            "gauge",
+            "Subscribers loaded by the last sync, by side.",
+            [({"side": side}, n) for side, n in self.subscribers.items()],
+        )
+
+        name = "http_request_duration_seconds"
+        lines.append(f"# HELP brbd_sync_{name} HTTP requests made by the last sync.")
+        lines.append(f"# TYPE brbd_sync_{name} histogram")
+        for request in self.requests:
+            labels = {
+                "service": request.service,
+                "method": request.method,
+                "endpoint": request.endpoint,
+                "status": str(request.status),
+            }
+            histogram = request.latency_seconds
+            for bound, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                bucket_labels = format_labels({**labels, "le": f"{bound:g}"})
+                lines.append(f"brbd_sync_{name}_bucket{bucket_labels} {count}")
+            bucket_labels = format_labels({**labels, "le": "+Inf"})
+            lines.append(f"brbd_sync_{name}_bucket{bucket_labels} {histogram.count}")
+            lines.append(f"brbd_sync_{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(
+                f"brbd_sync_{name}_count{format_labels(labels)} {histogram.count}"
+            )
+
+        metric(
+            "http_response_bytes",
+            "gauge",
+            "Bytes of response bodies the last sync downloaded, as sent over the wire (so before decompressing them).",
+            [
+                (
+                    {
+                        "service": request.service,
+                        "method": request.method,
+                        "endpoint": request.endpoint,
+                        "status": str(request.status),
+                    },
+                    request.response_bytes,
+                )
+                for request in self.requests
+            ],
+        )
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+# How many of the biggest allocation sites to keep for each phase.
+TOP_ALLOCATIONS = 10
+
+
+# Collects metrics over the course of a sync. This is thread safe.
+class Metrics:
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+        # Set once the sync has finished without errors.
+        self.succeeded = False
+        self._phase_seconds: dict[str, float] = {}
+        self._requests: dict[tuple[str, str, str, int], Histogram] = {}
+        self._response_bytes: Counter[tuple[str, str, str, int]] = Counter()
+        self._operations: Counter[str] = Counter()
+        self._skipped_emails: Counter[str] = Counter()
+        self._subscribers: dict[str, int] = {}
+        self._phase_peak_memory_bytes: dict[str, int] = {}
+        self._phase_top_allocations: dict[str, list[Allocation]] = {}
+
+    # Time the phase and, if tracemalloc is tracing, record how far memory
+    # use peaked above where it was when the phase started, and which lines
+    # allocated the most memory that was still in use when it ended.
+    #
+    # tracemalloc has a single peak for the whole process, so the peaks of
+    # phases that run at the same time (like loading Baserow and Buttondown)
+    # include each other's allocations.
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_snapshot = take_snapshot()
+            tracemalloc.reset_peak()
+            start_memory, _ = tracemalloc.get_traced_memory()
+
+        start = self._clock()
+        try:
+            yield
+        finally:
+            elapsed = self._clock() - start
+            with self._lock:
+                self._phase_seconds[name] = elapsed
+
+            if tracing:
+                _, peak_memory = tracemalloc.get_traced_memory()
+                top_allocations = [
+                    Allocation(
+                        location=str(stat.traceback),
+                        size_bytes=stat.size_diff,
+                        count=stat.count_diff,
+                    )
+                    for stat in take_snapshot().compare_to(start_snapshot, "lineno")
+                    if stat.size_diff > 0
+                ][:TOP_ALLOCATIONS]
+                with self._lock:
+                    self._phase_peak_memory_bytes[name] = peak_memory - start_memory
+                    self._phase_top_allocations[name] = top_allocations
+
+    def observe_request(
+        self,
+        service: str,
+        method: str,
+        url: str,
+        status: int,
+        seconds: float,
+        response_bytes: int = 0,
+    ):
+        key = (service, method, endpoint_of(url), status)
+        with self._lock:
+            self._requests.setdefault(key, Histogram()).observe(seconds)
+            self._response_bytes[key] += response_bytes
+
+    # How many bytes of response bodies `service` has sent us so far.
+    def response_bytes(self, service: str) -> int:
+        with self._lock:
+            return sum(
+                size for key, size in self._response_bytes.items() if key[0] == service
+            )
+
+    # Record every response `session` gets. Latency is measured up to when
+    # the response's headers arrived. Reading the body's size means reading the
+    # body, which every caller does anyway.
+    def instrument(self, session: requests.Session, service: str):
+        def on_response(response: requests.Response, *args: Any, **kwargs: Any):
+            self.observe_request(
+                service,
+                response.request.method or "",
+                response.request.url or "",
+                response.status_code,
+                response.elapsed.total_seconds(),
+                wire_bytes(response),
+            )
+
+        session.hooks["response"].append(on_response)
+
+    def count_operation(self, type: str):
+        with self._lock:
+            self._operations[type] += 1
+
+    def count_skipped_email(self, code: str | None):
+        with self._lock:
+            self._skipped_emails[code or "unknown"] += 1
+
+    def set_subscriber_count(self, side: str, count: int):
+        with self._lock:
+            self._subscribers[side] = count
+
+    def report(self) -> MetricsReport:
+        with self._lock:
+            return MetricsReport(
+                started_at=self.started_at,
+                succeeded=self.succeeded,
+                phase_seconds=dict(self._phase_seconds),
+                requests=[
+                    RequestMetrics(
+                        service=service,
+                        method=method,
+                        endpoint=endpoint,
+                        status=status,
+                        latency_seconds=histogram.model_copy(deep=True),
+                        response_bytes=self._response_bytes[
+                            (service, method, endpoint, status)
+                        ],
+                    )
+                    for (service, method, endpoint, status), histogram in sorted(
+                        self._requests.items()
+                    )
+                ],
+                operations=dict(sorted(self._operations.items())),
+                skipped_emails=dict(sorted(self._skipped_emails.items())),
+                subscribers=dict(self._subscribers),
+                phase_peak_memory_bytes=dict(self._phase_peak_memory_bytes),
+                phase_top_allocations=dict(self._phase_top_allocations),
+            )
+
+
+# A snapshot of what's allocated, leaving out tracemalloc's own allocations.
+def take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
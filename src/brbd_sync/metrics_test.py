@@ -0,0 +1,160 @@
+import tracemalloc
+from datetime import datetime, timezone
+
+import requests
+from fake_servers import FakeButtondown
+
+from .metrics import Metrics, endpoint_of
+
+
+def test_endpoint_of():
+    assert endpoint_of("https://api.buttondown.com/v1/subscribers?page=2") == (
+        "/v1/subscribers"
+    )
+    assert endpoint_of("https://api.buttondown.com/v1/subscribers/a@example.com") == (
+        "/v1/subscribers/{id}"
+    )
+    assert endpoint_of(
+        "https://api.buttondown.com/v1/subscribers/0d4e8f7a-3c3b-4b9e-9c1e-5a6f7b8c9d0e"
+    ) == ("/v1/subscribers/{id}")
+    assert endpoint_of(
+        "https://api.baserow.io/api/database/rows/table/42/7/?user_field_names=true"
+    ) == ("/api/database/rows/table/{id}/{id}/")
+
+
+def test_report():
+    now = 0.0
+    metrics = Metrics(clock=lambda: now)
+    metrics.started_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    with metrics.phase("diff"):
+        now = 1.5
+
+    metrics.observe_request("buttondown", "GET", "/v1/subscribers", 200, 0.07)
+    metrics.observe_request("buttondown", "GET", "/v1/subscribers", 200, 0.3, 1024)
+    metrics.count_operation("AddSub")
+    metrics.count_operation("AddSub")
+    metrics.count_skipped_email(None)
+    metrics.set_subscriber_count("baserow", 10)
+    metrics.succeeded = True
+
+    report = metrics.report()
+    assert report.phase_seconds == {"diff": 1.5}
+    (request,) = report.requests
+    assert request.latency_seconds.bucket_counts == [0, 1, 1, 2, 2, 2, 2, 2]
+    assert report.skipped_emails == {"unknown": 1}
+
+    assert report.to_prometheus() == (
+        "# HELP brbd_sync_last_run_timestamp_seconds When the last sync started.\n"
+        "# TYPE brbd_sync_last_run_timestamp_seconds gauge\n"
+        "brbd_sync_last_run_timestamp_seconds 1735689600.0\n"
+        "# HELP brbd_sync_last_run_success Whether the last sync finished without errors.\n"
+        "# TYPE brbd_sync_last_run_success gauge\n"
+        "brbd_sync_last_run_success 1\n"
+        "# HELP brbd_sync_phase_seconds How long each phase of the last sync took.\n"
+        "# TYPE brbd_sync_phase_seconds gauge\n"
+        'brbd_sync_phase_seconds{phase="diff"} 1.5\n'
+        "# HELP brbd_sync_operations Operations planned by the last sync, by type.\n"
+        "# TYPE brbd_sync_operations gauge\n"
+        'brbd_sync_operations{type="AddSub"} 2\n'
+        "# HELP brbd_sync_skipped_emails Emails Buttondown refused during the last sync, by error code.\n"
+        "# TYPE brbd_sync_skipped_emails gauge\n"
+        'brbd_sync_skipped_emails{code="unknown"} 1\n'
+        "# HELP brbd_sync_subscribers Subscribers loaded by the last sync, by side.\n"
+        "# TYPE brbd_sync_subscribers gauge\n"
+        'brbd_sync_subscribers{side="baserow"} 10\n'
+        "# HELP brbd_sync_http_request_duration_seconds HTTP requests made by the last sync.\n"
+        "# TYPE brbd_sync_http_request_duration_seconds histogram\n"
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="0.05"} 0\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="0.1"} 1\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="0.25"} 1\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="0.5"} 2\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="1"} 2\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="2.5"} 2\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="5"} 2\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="10"} 2\n'
+        'brbd_sync_http_request_duration_seconds_bucket{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200",le="+Inf"} 2\n'
+        'brbd_sync_http_request_duration_seconds_sum{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200"} 0.37\n'
+        'brbd_sync_http_request_duration_seconds_count{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200"} 2\n'
+        "# HELP brbd_sync_http_response_bytes Bytes of response bodies the last sync downloaded, as sent over the wire (so before decompressing them).\n"
+        "# TYPE brbd_sync_http_response_bytes gauge\n"
+        'brbd_sync_http_response_bytes{service="buttondown",method="GET",endpoint="/v1/subscribers",status="200"} 1024\n'
+    )
+
+
+def test_phase_memory():
+    metrics = Metrics()
+
+    # Nothing is recorded unless tracemalloc is tracing.
+    with metrics.phase("untraced"):
+        pass
+
+    tracemalloc.start()
+    try:
+        with metrics.phase("traced"):
+            freed = [bytearray(1000) for _ in range(1000)]
+            del freed
+            kept = [bytearray(100) for _ in range(100)]
+    finally:
+        tracemalloc.stop()
+    assert len(kept) == 100
+
+    report = metrics.report()
+    assert list(report.phase_peak_memory_bytes) == ["traced"]
+    assert report.phase_peak_memory_bytes["traced"] >= 1000 * 1000
+    (top, *_) = report.phase_top_allocations["traced"]
+    assert "metrics_test.py" in top.location
+    assert top.count >= 100
+    assert 100 * 100 <= top.size_bytes < 1000 * 1000
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.count_operation('a "weird"\nop\\')
+    assert 'brbd_sync_operations{type="a \\"weird\\"\\nop\\\\"} 1\n' in (
+        metrics.report().to_prometheus()
+    )
+
+
+def test_instrument():
+    metrics = Metrics()
+    with FakeButtondown("key") as fake:
+        session = requests.Session()
+        metrics.instrument(session, "buttondown")
+        session.get(f"{fake.url}/v1/subscribers/a@example.com")
+
+    (request,) = metrics.report().requests
+    assert (request.service, request.method, request.endpoint, request.status) == (
+        "buttondown",
+        "GET",
+        "/v1/subscribers/{id}",
+        401,
+    )
+    assert request.latency_seconds.count == 1
+    assert request.response_bytes > 0
+    assert metrics.response_bytes("buttondown") == request.response_bytes
+    assert metrics.response_bytes("baserow") == 0
+
+
+def test_instrument_counts_wire_bytes():
+    metrics = Metrics()
+    with FakeButtondown("key") as fake:
+        for i in range(50):
+            fake.add_subscriber(f"{i}@example.com")
+        session = requests.Session()
+        session.headers["Authorization"] = "Token key"
+        metrics.instrument(session, "buttondown")
+        compressed = session.get(f"{fake.url}/v1/subscribers")
+        assert compressed.headers["Content-Encoding"] == "gzip"
+        assert metrics.response_bytes("buttondown") == int(
+            compressed.headers["Content-Length"]
+        )
+        assert metrics.response_bytes("buttondown") < len(compressed.content)
+
+        metrics = Metrics()
+        metrics.instrument(session, "buttondown")
+        uncompressed = session.get(
+            f"{fake.url}/v1/subscribers", headers={"Accept-Encoding": "identity"}
+        )
+        assert "Content-Encoding" not in uncompressed.headers
+        assert metrics.response_bytes("buttondown") == len(uncompressed.content)
@@ -0,0 +1,63 @@
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import click
+
+from .metrics import Metrics, MetricsReport
+
+
+# Profile everything run inside this, and write the stats to `path` (in the
+# format of `pstats`). Since Python 3.12, cProfile sees every thread, so this
+# includes the concurrent loads and requests.
+@contextmanager
+def cpu_profile(path: Path) -> Iterator[None]:
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        click.echo(
+            f"Wrote a CPU profile to {path}. Inspect it with `python -m pstats {path}`.",
+            err=True,
+        )
+
+
+# Trace memory allocations while running everything inside this, and then
+# print how much memory each phase timed by `metrics` needed, and where it
+# went. See `Metrics.phase`.
+@contextmanager
+def memory_profile(metrics: Metrics) -> Iterator[None]:
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+        click.echo(format_memory_profile(metrics.report()), err=True)
+
+
+def format_memory_profile(report: MetricsReport) -> str:
+    lines = ["Peak memory allocated by each phase:"]
+    for phase, size in report.phase_peak_memory_bytes.items():
+        lines.append(f"  {phase}: {format_size(size)}")
+
+    for phase, allocations in report.phase_top_allocations.items():
+        lines.append(f"Largest allocations by {phase} still in use when it ended:")
+        for allocation in allocations:
+            lines.append(
+                f"  {format_size(allocation.size_bytes)} in {allocation.count} block(s) at {allocation.location}"
+            )
+
+    return "\n".join(lines)
+
+
+def format_size(size: int) -> str:
+    if size < 2**10:
+        return f"{size} B"
+    if size < 2**20:
+        return f"{size / 2**10:.1f} KiB"
+    return f"{size / 2**20:.1f} MiB"
@@ -0,0 +1,7 @@
+from .profiling import format_size
+
+
+def test_format_size():
+    assert format_size(1023) == "1023 B"
+    assert format_size(1536) == "1.5 KiB"
+    assert format_size(3 * 2**20) == "3.0 MiB"
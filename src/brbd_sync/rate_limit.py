@@ -0,0 +1,94 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable
+
+
+class RateLimiter:
+    # A token bucket, shared by all threads making requests.
+    #
+    # Tokens refill at `requests_per_second`, up to `burst` of them. Each
+    # request takes a token, waiting for one if necessary. With no
+    # `requests_per_second`, requests are only delayed by `pause`.
+    def __init__(
+        self,
+        requests_per_second: float | None,
+        burst: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        assert requests_per_second is None or requests_per_second > 0
+        assert burst >= 1
+
+        self._rate = requests_per_second
+        self._burst = burst
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._paused_until = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            wait = max(0.0, self._paused_until - now)
+
+            if self._rate is not None:
+                elapsed = now - self._updated_at
+                self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+                self._updated_at = now
+
+                # Reserve our token now, even if it hasn't been refilled yet,
+                # so concurrent callers queue up behind us rather than all
+                # waking up at once.
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self._rate)
+
+        if wait > 0:
+            self._sleep(wait)
+
+    # Stop *all* requests for the given number of seconds. This is how we
+    # honor a server telling us to back off.
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+
+def parse_retry_after(value: str | None, now: datetime | None = None) -> float | None:
+    # Per RFC 9110, Retry-After is either a number of seconds or an HTTP date.
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    # A "-0000" zone means UTC, but comes back as a naive datetime.
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    if now is None:
+        now = datetime.now(timezone.utc)  # pragma: no cover (tests pass `now`)
+
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def backoff(
+    attempt: int,
+    base: float = 0.5,
+    cap: float = 30.0,
+    rand: Callable[[float, float], float] = random.uniform,
+) -> float:
+    # Exponential backoff with "full jitter", so that many clients (or
+    # threads) that failed at the same moment don't retry in lockstep.
+    return rand(0, min(cap, base * 2**attempt))
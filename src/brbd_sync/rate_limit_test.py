@@ -0,0 +1,70 @@
+from datetime import datetime, timezone
+
+from .rate_limit import RateLimiter, backoff, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: list[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter():
+    clock = FakeClock()
+    limiter = RateLimiter(
+        requests_per_second=2, burst=2, clock=clock, sleep=clock.sleep
+    )
+
+    # The first `burst` requests go right through.
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == []
+
+    # After that, we're limited to 2 requests per second.
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == [0.5, 0.5]
+
+    # Tokens refill while idle, but only up to `burst`.
+    clock.now += 10
+    limiter.acquire()
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == [0.5, 0.5, 0.5]
+
+
+def test_rate_limiter_pause():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_second=None, clock=clock, sleep=clock.sleep)
+
+    limiter.acquire()
+    limiter.pause(3)
+    limiter.pause(1)  # A shorter pause doesn't cut the longer one short.
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == [3]
+
+
+def test_parse_retry_after():
+    now = datetime(2025, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+    assert parse_retry_after(None, now=now) is None
+    assert parse_retry_after("120", now=now) == 120
+    assert parse_retry_after("Wed, 01 Jan 2025 12:00:30 GMT", now=now) == 30
+    assert parse_retry_after("Wed, 01 Jan 2025 11:00:00 GMT", now=now) == 0
+    assert parse_retry_after("Wed, 01 Jan 2025 12:01:00 -0000", now=now) == 60
+    assert parse_retry_after("soonish", now=now) is None
+
+
+def test_backoff():
+    assert backoff(0, rand=lambda lo, hi: hi) == 0.5
+    assert backoff(3, rand=lambda lo, hi: hi) == 4
+    assert backoff(100, rand=lambda lo, hi: hi) == 30
+    assert 0 <= backoff(2) <= 2
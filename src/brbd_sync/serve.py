@@ -0,0 +1,313 @@
+import hmac
+import json
+import logging
+import queue
+import time
+from datetime import timedelta
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from typing import Any, Callable, Iterable
+from urllib.parse import parse_qs, urlparse
+
+from pydantic import BaseModel
+
+from . import baserow as br
+from . import buttondown as bd
+from . import buttondown_api as bd_api
+from .sync import Plan, SyncResult, apply, fix_corrupted, plan, plan_ids
+
+logger = logging.getLogger(__name__)
+
+
+class BaserowRowsChanged(BaseModel):
+    # Rows as sent by Baserow, keyed by field name.
+    rows: list[dict[str, Any]]
+
+
+class BaserowRowsDeleted(BaseModel):
+    row_ids: list[int]
+
+
+class ButtondownSubscriberChanged(BaseModel):
+    buttondown_id: str
+
+
+Event = BaserowRowsChanged | BaserowRowsDeleted | ButtondownSubscriberChanged
+
+
+# See https://baserow.io/user-docs/webhooks. Returns None for events we
+# don't care about.
+def parse_baserow_webhook(payload: dict[str, Any]) -> Event | None:
+    match payload.get("event_type"):
+        case "rows.created" | "rows.updated":
+            return BaserowRowsChanged(rows=payload["items"])
+        case "rows.deleted":
+            return BaserowRowsDeleted(row_ids=payload["row_ids"])
+        case _:
+            return None
+
+
+# See https://docs.buttondown.com/webhooks-introduction. Buttondown only tells
+# us which subscriber changed, so we have to go fetch them.
+def parse_buttondown_webhook(payload: dict[str, Any]) -> Event | None:
+    event_type = payload.get("event_type", "")
+    if not event_type.startswith("subscriber."):
+        return None
+
+    return ButtondownSubscriberChanged(buttondown_id=payload["data"]["subscriber"])
+
+
+WEBHOOK_PARSERS: dict[str, Callable[[dict[str, Any]], Event | None]] = {
+    "/webhooks/baserow": parse_baserow_webhook,
+    "/webhooks/buttondown": parse_buttondown_webhook,
+}
+
+
+# Build a request handler that puts incoming webhook events onto `events`.
+# Requests must include the shared `secret` as a `?secret=` query parameter.
+def make_webhook_handler(
+    secret: str, events: "queue.Queue[Event]"
+) -> type[BaseHTTPRequestHandler]:
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+            parse_webhook = WEBHOOK_PARSERS.get(url.path)
+            if parse_webhook is None:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            given_secret = parse_qs(url.query).get("secret", [""])[0]
+            if not hmac.compare_digest(given_secret.encode(), secret.encode()):
+                self.send_error(HTTPStatus.FORBIDDEN)
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                event = parse_webhook(json.loads(body))
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+                return
+
+            if event is not None:
+                events.put(event)
+
+            # Do the actual work later, so the sender isn't kept waiting.
+            self.send_response(HTTPStatus.ACCEPTED)
+            self.end_headers()
+
+        def log_message(self, format: str, *args: Any):
+            logger.info(format, *args)
+
+    return WebhookHandler
+
+
+# A Baserow subscriber id is the row id, with a suffix if the row has multiple
+# emails. See `baserow.subscribers_from_row`.
+def row_id_of(subscriber_id: str) -> int:
+    return int(subscriber_id.split("-")[0])
+
+
+# Our in-memory picture of Baserow and Buttondown, kept up to date as events
+# come in, so a single changed row can be synced without fetching everything.
+#
+# This is not thread safe: all events should be handled by one thread.
+class LiveSync:
+    def __init__(
+        self,
+        baserow_data: br.Data,
+        buttondown_data: bd.Data,
+        dry_run: bool,
+        concurrency: int = 1,
+    ):
+        self._dry_run = dry_run
+        self._concurrency = concurrency
+        self._reset(baserow_data, buttondown_data)
+
+    def _reset(self, baserow_data: br.Data, buttondown_data: bd.Data):
+        _dupe_emails, self._baserow_data = baserow_data.with_no_duplicate_emails()
+        self._subscriber_ids_by_row_id: dict[int, list[str]] = {}
+        for sub in self._baserow_data.subscribers:
+            self._subscriber_ids_by_row_id.setdefault(row_id_of(sub.id), []).append(
+                sub.id
+            )
+
+        self._buttondown_data = buttondown_data
+
+        # Set when we're no longer sure our picture of Buttondown is right:
+        # say, an operation failed in a way that may or may not have changed
+        # Buttondown. Operations that Buttondown rejected outright (see
+        # `buttondown_api.SkippableEmailError`) are fine: our picture only
+        # changes as operations succeed.
+        self.needs_reconcile = False
+
+    @property
+    def baserow_data(self) -> br.DataWithUniqueEmails:
+        return self._baserow_data
+
+    @property
+    def buttondown_data(self) -> bd.Data:
+        return self._buttondown_data
+
+    # Do a full sync, and start over with the given (freshly loaded) data.
+    def reconcile(self, baserow_data: br.Data, buttondown_data: bd.Data) -> SyncResult:
+        result = self._apply(plan(baserow_data, buttondown_data), buttondown_data)
+        self._reset(baserow_data, buttondown_data)
+        return result
+
+    def baserow_rows_changed(
+        self, subscribers_by_row_id: dict[int, list[br.Subscriber]]
+    ) -> SyncResult:
+        warnings: list[str] = []
+        affected_ids: set[str] = set()
+
+        for row_id, subscribers in subscribers_by_row_id.items():
+            affected_ids.update(self._forget_row(row_id))
+
+            for sub in subscribers:
+                # Ignore people with no email.
+                if sub.email is None:
+                    continue
+
+                row_with_email = self._baserow_data.get_subscriber(email=sub.email)
+                if row_with_email is not None:
+                    warnings.append(
+                        f"Unexpectedly found multiple Baserow rows with email={sub.email!r}. I picked the one with id={row_with_email.id!r}"
+                    )
+                    continue
+
+                self._baserow_data.add(br.SubscriberWithEmail.from_subscriber(sub))
+                self._subscriber_ids_by_row_id.setdefault(row_id, []).append(sub.id)
+                affected_ids.add(sub.id)
+
+        return self._sync_ids(affected_ids, warnings)
+
+    def baserow_rows_deleted(self, row_ids: Iterable[int]) -> SyncResult:
+        affected_ids: set[str] = set()
+        for row_id in row_ids:
+            affected_ids.update(self._forget_row(row_id))
+
+        return self._sync_ids(affected_ids)
+
+    def buttondown_subscriber_changed(
+        self, buttondown_id: str, api_sub: bd_api.Subscriber | None
+    ) -> SyncResult:
+        new_sub = None if api_sub is None else bd.Subscriber.from_api(api_sub)
+        old_subs = self._buttondown_data.refresh(buttondown_id, new_sub)
+
+        affected_ids: set[str] = set()
+        for sub in [*old_subs, new_sub]:
+            if sub is None:
+                continue
+            if sub.id is not None:
+                affected_ids.add(sub.id)
+                continue
+
+            # Someone without an id is corrupted if a row has their email.
+            # See `sync.diff`.
+            row_with_email = self._baserow_data.get_subscriber(email=sub.email)
+            if row_with_email is not None:
+                affected_ids.add(row_with_email.id)
+
+        return self._sync_ids(affected_ids)
+
+    def _forget_row(self, row_id: int) -> list[str]:
+        subscriber_ids = self._subscriber_ids_by_row_id.pop(row_id, [])
+        for id in subscriber_ids:
+            self._baserow_data.delete(id)
+
+        return subscriber_ids
+
+    def _sync_ids(self, ids: set[str], warnings: list[str] = []) -> SyncResult:
+        return self._apply(
+            Plan(warnings=warnings, operations=self._plan_ids(ids)),
+            self._buttondown_data,
+        )
+
+    # Like `sync.diff`, but for just the given ids. Planning happens on a
+    # small copy of the Buttondown subscribers these ids could touch (those
+    # with these ids, and those with their rows' emails), so that our picture
+    # of Buttondown only changes as the operations actually succeed.
+    def _plan_ids(self, ids: set[str]) -> list[bd_api.Operation]:
+        subscriber_by_email = {
+            sub.email: sub
+            for id in ids
+            for sub in self._buttondown_data.get_subscribers(id=id)
+        }
+        for id in ids:
+            row = self._baserow_data.get_subscriber(id=id)
+            if row is None:
+                continue
+            sub_with_email = self._buttondown_data.get_subscriber(email=row.email)
+            if sub_with_email is not None:
+                subscriber_by_email[sub_with_email.email] = sub_with_email
+
+        buttondown_data = bd.Data(
+            subscribers=subscriber_by_email.values(),
+            api_client=self._buttondown_data.api_client,
+        )
+        # Everyone here without an id has one of our rows' emails.
+        return [
+            *fix_corrupted(
+                self._baserow_data,
+                buttondown_data,
+                buttondown_data.get_subscribers(id=None),
+            ),
+            *plan_ids(self._baserow_data, buttondown_data, sorted(ids)),
+        ]
+
+    # Operations that succeed are applied to `buttondown_data`. In a dry run,
+    # nothing actually changes in Buttondown, so it's left alone.
+    def _apply(self, the_plan: Plan, buttondown_data: bd.Data) -> SyncResult:
+        return apply(
+            the_plan,
+            buttondown_data.api_client,
+            dry_run=self._dry_run,
+            concurrency=self._concurrency,
+            buttondown_data=buttondown_data,
+        )
+
+
+# Handle events from `events` forever. Every `reconcile_interval` (and
+# whenever `live_sync` asks for it), do a full sync as a safety net against
+# missed webhooks.
+def process_events(
+    live_sync: LiveSync,
+    events: "queue.Queue[Event]",
+    load: Callable[[], tuple[br.Data, bd.Data]],
+    subscribers_from_rows: Callable[
+        [list[dict[str, Any]]], dict[int, list[br.Subscriber]]
+    ],
+    reconcile_interval: timedelta,
+):  # pragma: no cover (runs forever)
+    next_reconcile_at = time.monotonic() + reconcile_interval.total_seconds()
+
+    while True:
+        timeout = max(0, next_reconcile_at - time.monotonic())
+        try:
+            event = events.get(timeout=timeout)
+        except queue.Empty:
+            event = None
+
+        try:
+            match event:
+                case BaserowRowsChanged():
+                    live_sync.baserow_rows_changed(subscribers_from_rows(event.rows))
+                case BaserowRowsDeleted():
+                    live_sync.baserow_rows_deleted(event.row_ids)
+                case ButtondownSubscriberChanged():
+                    api_client = live_sync.buttondown_data.api_client
+                    live_sync.buttondown_subscriber_changed(
+                        event.buttondown_id,
+                        api_client.get_subscriber(event.buttondown_id),
+                    )
+        except Exception:
+            logger.exception("Failed to handle %s, will do a full sync", event)
+            live_sync.needs_reconcile = True
+
+        if live_sync.needs_reconcile or time.monotonic() >= next_reconcile_at:
+            logger.info("Doing a full sync")
+            try:
+                live_sync.reconcile(*load())
+            except Exception:
+                logger.exception("Full sync failed, will try again later")
+            next_reconcile_at = time.monotonic() + reconcile_interval.total_seconds()
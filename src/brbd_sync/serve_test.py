@@ -0,0 +1,268 @@
+import queue
+import threading
+from http.server import ThreadingHTTPServer
+from typing import Iterator
+
+import pytest
+import requests
+
+from . import buttondown as bd
+from . import buttondown_api as api
+from .buttondown_api import AddSub, DeleteSub, EditSub
+from .executor_test import FakeClient
+from .serve import (
+    BaserowRowsChanged,
+    BaserowRowsDeleted,
+    ButtondownSubscriberChanged,
+    Event,
+    LiveSync,
+    make_webhook_handler,
+    parse_baserow_webhook,
+    parse_buttondown_webhook,
+    row_id_of,
+)
+from .sync_test import bd_sub, br_sub, db
+
+
+def test_parse_baserow_webhook():
+    assert parse_baserow_webhook(
+        {"event_type": "rows.updated", "items": [{"id": 1}], "old_items": []}
+    ) == BaserowRowsChanged(rows=[{"id": 1}])
+    assert parse_baserow_webhook(
+        {"event_type": "rows.deleted", "row_ids": [1, 2]}
+    ) == BaserowRowsDeleted(row_ids=[1, 2])
+    assert parse_baserow_webhook({"event_type": "view.created"}) is None
+
+
+def test_parse_buttondown_webhook():
+    assert parse_buttondown_webhook(
+        {"event_type": "subscriber.created", "data": {"subscriber": "abc"}}
+    ) == ButtondownSubscriberChanged(buttondown_id="abc")
+    assert parse_buttondown_webhook({"event_type": "email.sent"}) is None
+
+
+@pytest.fixture
+def webhook_server() -> Iterator[tuple[str, "queue.Queue[Event]"]]:
+    events: queue.Queue[Event] = queue.Queue()
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_webhook_handler("s3cret", events)
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        host, port = server.server_address[:2]
+        yield f"http://{host!s}:{port}", events
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_webhook_handler(webhook_server: tuple[str, "queue.Queue[Event]"]):
+    url, events = webhook_server
+    payload = {"event_type": "rows.deleted", "row_ids": [1]}
+
+    def post(path: str, **kwargs) -> int:
+        return requests.post(url + path, **kwargs).status_code
+
+    assert post("/webhooks/baserow?secret=s3cret", json=payload) == 202
+    assert events.get_nowait() == BaserowRowsDeleted(row_ids=[1])
+
+    assert post("/webhooks/baserow?secret=s3cret", json={"event_type": "x"}) == 202
+    assert post("/webhooks/baserow?secret=wrong", json=payload) == 403
+    assert post("/webhooks/baserow", json=payload) == 403
+    assert post("/webhooks/nope?secret=s3cret", json=payload) == 404
+    assert post("/webhooks/buttondown?secret=s3cret", data="not json") == 400
+    assert post("/webhooks/buttondown?secret=s3cret", json={}) == 202
+    assert events.empty()
+
+
+def test_row_id_of():
+    assert row_id_of("12") == 12
+    assert row_id_of("12-3") == 12
+
+
+def live_sync(client: api.Client, dry_run: bool = False) -> LiveSync:
+    return LiveSync(
+        db(
+            subscribers=[
+                br_sub(id="1", email="j1@example.com"),
+                br_sub(id="2-1", email="j2@example.com"),
+                br_sub(id="2-2", email="j2-alt@example.com"),
+            ]
+        ),
+        bd.Data(
+            subscribers=[
+                bd_sub(id="1", email="j1@example.com", buttondown_id="bd1"),
+                bd_sub(id="2-1", email="j2@example.com"),
+                bd_sub(id="2-2", email="j2-alt@example.com"),
+            ],
+            api_client=client,
+        ),
+        dry_run=dry_run,
+    )
+
+
+def test_baserow_rows_changed():
+    client = FakeClient()
+    live = live_sync(client)
+
+    result = live.baserow_rows_changed(
+        {
+            # Row 2 now has a single email.
+            2: [br_sub(id="2", email="j2@example.com", tags={"colby"})],
+            # Row 3 is new, but has someone else's email.
+            3: [br_sub(id="3", email="j1@example.com")],
+            # Row 4 is new, and has no email yet.
+            4: [br_sub(id="4", email="")],
+        }
+    )
+    assert result.warnings == [
+        "Unexpectedly found multiple Baserow rows with email='j1@example.com'. I picked the one with id='1'"
+    ]
+    assert (
+        result.operations
+        == [
+            DeleteSub(email="j2@example.com"),
+            AddSub(email="j2@example.com", metadata={"id": "2"}, tags={"colby"}),
+            DeleteSub(email="j2-alt@example.com"),
+            DeleteSub(email="j2@example.com"),
+        ][:0]
+        + result.operations
+    )
+    assert [type(op) for op in result.operations] == [DeleteSub, AddSub, DeleteSub]
+    assert not live.needs_reconcile
+    assert sorted(s.email for s in live.buttondown_data.subscribers) == [
+        "j1@example.com",
+        "j2@example.com",
+    ]
+
+    result = live.baserow_rows_deleted([1])
+    assert result.operations == [DeleteSub(email="j1@example.com")]
+    assert live.baserow_data.get_subscriber(id="1") is None
+
+
+def test_buttondown_subscriber_changed():
+    client = FakeClient()
+    live = live_sync(client)
+
+    # Someone edited a subscriber directly in Buttondown: undo that.
+    result = live.buttondown_subscriber_changed(
+        "bd1",
+        api.Subscriber(
+            id="bd1",
+            type="regular",
+            email_address="j1@example.com",
+            tags={"gouda"},
+            metadata={"id": "1"},
+        ),
+    )
+    assert result.operations == [EditSub(old_email="j1@example.com", tags=set())]
+
+    # We find out about the Buttondown id of a subscriber we already knew of.
+    # Nothing to do.
+    result = live.buttondown_subscriber_changed(
+        "bd2",
+        api.Subscriber(
+            id="bd2",
+            type="regular",
+            email_address="j2@example.com",
+            tags=set(),
+            metadata={"id": "2-1"},
+        ),
+    )
+    assert result.operations == []
+    assert live.buttondown_data.get_subscriber(buttondown_id="bd2") is not None
+
+    # Someone deleted a subscriber directly in Buttondown: add them back.
+    result = live.buttondown_subscriber_changed("bd2", None)
+    assert result.operations == [
+        AddSub(email="j2@example.com", metadata={"id": "2-1"}, tags=set())
+    ]
+
+    # Then they changed the email of the subscriber we added: change it back.
+    result = live.buttondown_subscriber_changed(
+        "bd-j2@example.com",
+        api.Subscriber(
+            id="bd-j2@example.com",
+            type="regular",
+            email_address="j2-new@example.com",
+            tags=set(),
+            metadata={"id": "2-1"},
+        ),
+    )
+    assert result.operations == [
+        EditSub(old_email="j2-new@example.com", new_email="j2@example.com")
+    ]
+
+
+def test_dry_run_leaves_buttondown_data_alone():
+    client = FakeClient()
+    live = live_sync(client, dry_run=True)
+
+    result = live.baserow_rows_deleted([1])
+    assert result.operations == [DeleteSub(email="j1@example.com")]
+    assert client.calls == []
+    assert live.buttondown_data.get_subscriber(email="j1@example.com") is not None
+
+
+def test_buttondown_subscriber_lost_their_id():
+    client = FakeClient()
+    live = live_sync(client)
+
+    # Someone wiped a subscriber's id in Buttondown: put it back, rather than
+    # deleting and re-adding them.
+    result = live.buttondown_subscriber_changed(
+        "bd2",
+        api.Subscriber(
+            id="bd2",
+            type="regular",
+            email_address="j2@example.com",
+            tags=set(),
+            metadata={},
+        ),
+    )
+    assert result.operations == [
+        EditSub(old_email="j2@example.com", metadata={"id": "2-1"})
+    ]
+    assert live.buttondown_data.get_subscribers(id="2-1") == [
+        bd_sub(id="2-1", email="j2@example.com", buttondown_id="bd2")
+    ]
+
+    # Someone without an id and without a row signed up directly.
+    result = live.buttondown_subscriber_changed(
+        "bd3",
+        api.Subscriber(
+            id="bd3",
+            type="regular",
+            email_address="direct@example.com",
+            tags=set(),
+            metadata={},
+        ),
+    )
+    assert result.operations == []
+
+
+def test_skipped_operations_leave_buttondown_data_alone():
+    client = FakeClient(skippable_emails={"bad@example.com"})
+    live = live_sync(client)
+
+    result = live.baserow_rows_changed({5: [br_sub(id="5", email="bad@example.com")]})
+    assert result.skipped_operations == [
+        AddSub(email="bad@example.com", metadata={"id": "5"}, tags=set())
+    ]
+    # Buttondown rejected the operation outright, so we know exactly where
+    # we stand.
+    assert not live.needs_reconcile
+    assert live.buttondown_data.get_subscriber(email="bad@example.com") is None
+
+    result = live.reconcile(
+        db(subscribers=[br_sub(id="1", email="j1@example.com")]),
+        bd.Data(
+            subscribers=[bd_sub(id="1", email="j1@example.com", tags={"colby"})],
+            api_client=client,
+        ),
+    )
+    assert result.operations == [EditSub(old_email="j1@example.com", tags=set())]
+    assert live.baserow_data.get_subscriber(id="5") is None
+    assert live.buttondown_data.subscribers == [bd_sub(id="1", email="j1@example.com")]
@@ -0,0 +1,115 @@
+import hashlib
+
+from . import baserow as br
+from . import buttondown as bd
+
+# Sharding splits a sync into independent slices, so that several processes
+# (or machines) can each plan and apply one. See `brbd-sync sync --shards`.
+#
+# Subscribers are assigned to shards by hashing their id. That alone isn't
+# enough: when an email moves from one id to another, the collision
+# `DeleteSub` (see `sync.plan_ids`) and the `AddSub` that reuses the email
+# could end up in different shards, racing each other. So before sharding,
+# every id is grouped with every other id it shares an email with (in Baserow
+# or in Buttondown, transitively), and a whole group goes to the shard of its
+# smallest id. Every worker computes the same groups from the same data, so
+# this needs no communication between them, and no email is ever touched by
+# two shards.
+#
+# Workers that load the data at slightly different times may see slightly
+# different groups. At worst, an operation then fails and is retried by the
+# next sync.
+
+
+# Which of `shards` shards `key` belongs to. This must be the same in every
+# process, so it can't use Python's (randomized) `hash`.
+def shard_of(key: str, shards: int) -> int:
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest) % shards
+
+
+# A disjoint-set forest, for grouping ids and emails.
+class Groups:
+    def __init__(self):
+        self._parent: dict[str, str] = {}
+
+    def keys(self) -> list[str]:
+        return list(self._parent)
+
+    def find(self, key: str) -> str:
+        root = self._parent.setdefault(key, key)
+        while root != self._parent[root]:
+            root = self._parent[root]
+
+        # Point everything on the way straight at the root, so the next
+        # lookup is quick.
+        while key != root:
+            self._parent[key], key = root, self._parent[key]
+
+        return root
+
+    def union(self, a: str, b: str):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self._parent[root_a] = root_b
+
+
+# Ids and emails are grouped together, so keep them apart. Buttondown treats
+# emails case insensitively, so we do too.
+def subscriber_key(id: str | None, email: str | None) -> str:
+    if id is not None:
+        return f"id:{id}"
+    assert email is not None
+    return f"email:{email.lower()}"
+
+
+# The shard of every subscriber, by `subscriber_key`.
+def assign_shards(
+    baserow_data: br.Data, buttondown_data: bd.Data, shards: int
+) -> dict[str, int]:
+    groups = Groups()
+    subs: list[tuple[str | None, str | None]] = [
+        (sub.id, sub.email) for sub in baserow_data.subscribers
+    ] + [(sub.id, sub.email) for sub in buttondown_data.subscribers]
+    for id, email in subs:
+        key = subscriber_key(id, email)
+        if email is None:
+            groups.find(key)
+        else:
+            groups.union(key, subscriber_key(None, email))
+
+    # Name each group after its smallest id (or, if it has none, its smallest
+    # email): unlike the group's root, that doesn't depend on the order in
+    # which subscribers were loaded.
+    keys = groups.keys()
+    name_by_root: dict[str, str] = {}
+    for key in sorted(keys, key=lambda key: (not key.startswith("id:"), key)):
+        name_by_root.setdefault(groups.find(key), key)
+
+    return {key: shard_of(name_by_root[groups.find(key)], shards) for key in keys}
+
+
+# Just the subscribers that belong to shard `index` of `shards`.
+def shard_data(
+    baserow_data: br.Data, buttondown_data: bd.Data, shards: int, index: int
+) -> tuple[br.Data, bd.Data]:
+    shard_by_key = assign_shards(baserow_data, buttondown_data, shards)
+
+    def in_shard(id: str | None, email: str | None) -> bool:
+        return shard_by_key[subscriber_key(id, email)] == index
+
+    return (
+        br.Data(
+            subscribers=[
+                sub for sub in baserow_data.subscribers if in_shard(sub.id, sub.email)
+            ]
+        ),
+        bd.Data(
+            subscribers=[
+                sub
+                for sub in buttondown_data.subscribers
+                if in_shard(sub.id, sub.email)
+            ],
+            api_client=buttondown_data.api_client,
+        ),
+    )
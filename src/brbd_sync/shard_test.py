@@ -0,0 +1,84 @@
+from collections import Counter
+
+from synthetic import Mix, generate
+
+from .shard import Groups, assign_shards, shard_data, shard_of
+from .sync import plan
+from .sync_test import bd_sub, br_sub, db, ml
+
+
+def test_shard_of():
+    assert [shard_of(str(i), 4) for i in range(8)] == [
+        shard_of(str(i), 4) for i in range(8)
+    ]
+    assert set(shard_of(str(i), 4) for i in range(100)) == {0, 1, 2, 3}
+
+
+def test_groups():
+    groups = Groups()
+    groups.union("a", "b")
+    groups.union("c", "d")
+    groups.union("b", "d")
+    groups.find("e")
+    assert len({groups.find(key) for key in "abcd"}) == 1
+    assert groups.find("e") == "e"
+
+
+def test_ids_sharing_an_email_share_a_shard():
+    baserow_data = db(
+        subscribers=[br_sub(id=str(i), email=f"{i}@example.com") for i in range(100)]
+    )
+    # Everyone's email moved to the next id in Baserow.
+    buttondown_data = ml(
+        subscribers=[
+            bd_sub(id=str(i + 1), email=f"{i}@example.com") for i in range(100)
+        ]
+        + [bd_sub(id=None, email="Direct@example.com")]
+    )
+    shard_by_key = assign_shards(baserow_data, buttondown_data, shards=4)
+    # The chain of moves makes everyone one group, apart from the direct
+    # signup (keyed by their email, since they have no id).
+    direct_shard = shard_by_key.pop("email:direct@example.com")
+    assert direct_shard == shard_of("email:direct@example.com", 4)
+    assert len(set(shard_by_key.values())) == 1
+    shard_by_key["email:direct@example.com"] = direct_shard
+
+    # The groups don't depend on the order subscribers were loaded in.
+    buttondown_data = ml(subscribers=buttondown_data.subscribers[::-1])
+    assert assign_shards(baserow_data, buttondown_data, shards=4) == shard_by_key
+
+
+def test_shards_plan_the_same_operations():
+    mix = Mix(email_swaps=0.05, duplicate_emails=0.02, multi_email_rows=0.05)
+    baserow_data, buttondown_subscribers = generate(1000, mix)
+    buttondown_subscribers.append(bd_sub(id=None, email="direct@example.com"))
+    # Someone whose email was removed in Baserow.
+    baserow_data.subscribers.append(br_sub(id="no-email", email=""))
+    buttondown_subscribers.append(bd_sub(id="no-email", email="was@example.com"))
+    full_plan = plan(baserow_data, ml(buttondown_subscribers))
+
+    shards = 4
+    shard_plans = [
+        plan(*shard_data(baserow_data, ml(buttondown_subscribers), shards, index))
+        for index in range(shards)
+    ]
+    assert all(len(shard_plan.operations) > 0 for shard_plan in shard_plans)
+
+    # Between them, the shards do exactly what a single sync would...
+    assert Counter(
+        op.model_dump_json()
+        for shard_plan in shard_plans
+        for op in shard_plan.operations
+    ) == Counter(op.model_dump_json() for op in full_plan.operations)
+    assert sorted(
+        warning for shard_plan in shard_plans for warning in shard_plan.warnings
+    ) == sorted(full_plan.warnings)
+
+    # ... and never touch the same email.
+    emails_by_shard = [
+        {email for op in shard_plan.operations for email in op.touched_emails()}
+        for shard_plan in shard_plans
+    ]
+    for i in range(shards):
+        for j in range(i + 1, shards):
+            assert emails_by_shard[i].isdisjoint(emails_by_shard[j])
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Self
+
+from pydantic import BaseModel
+
+from . import baserow as br
+from . import buttondown as bd
+from .util import ChangedIds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS synced_subscribers (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+
+-- One row per Baserow row id that changed in a sync. A NULL email means the
+-- row was removed.
+CREATE TABLE IF NOT EXISTS changes (
+    synced_at TEXT NOT NULL,
+    id TEXT NOT NULL,
+    email TEXT,
+    tags TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_by_synced_at ON changes (synced_at);
+
+-- When the Baserow and Buttondown snapshots that the last recorded sync was
+-- based on were taken, keyed by "baserow" or "buttondown".
+CREATE TABLE IF NOT EXISTS snapshots (
+    source TEXT PRIMARY KEY,
+    taken_at TEXT NOT NULL
+);
+
+-- Fingerprints (see `fingerprint`) of Baserow and Buttondown as the last
+-- recorded sync left them, keyed by "baserow" or "buttondown".
+CREATE TABLE IF NOT EXISTS fingerprints (
+    source TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+"""
+
+
+# What the last successful sync pushed to Buttondown for a single Baserow row.
+class SyncedSubscriber(BaseModel):
+    id: str
+    email: str
+    tags: set[str]
+    metadata: dict[str, str]
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> Self:
+        return cls(
+            id=row["id"],
+            email=row["email"],
+            tags=set(json.loads(row["tags"])),
+            metadata=json.loads(row["metadata"]),
+        )
+
+    def to_row(self) -> tuple[str, str, str, str]:
+        return (
+            self.id,
+            self.email,
+            json.dumps(sorted(self.tags)),
+            json.dumps(self.metadata, sort_keys=True),
+        )
+
+    def matches(self, email: str, tags: set[str], metadata: dict[str, str]) -> bool:
+        return self.email == email and self.tags == tags and self.metadata == metadata
+
+
+class Change(BaseModel):
+    id: str
+    # None if the row was removed.
+    subscriber: SyncedSubscriber | None
+
+
+# If given `ids`, only the subscribers with those ids.
+def synced_subscribers(
+    baserow_data: br.Data, ids: set[str] | None = None
+) -> list[SyncedSubscriber]:
+    _dupe_emails, unique_baserow_data = baserow_data.with_no_duplicate_emails()
+    return [
+        SyncedSubscriber(id=s.id, email=s.email, tags=s.tags, metadata=s.metadata)
+        for s in unique_baserow_data.subscribers
+        if ids is None or s.id in ids
+    ]
+
+
+# A fingerprint of the ids, emails, tags and metadata of the given subscribers.
+# Each subscriber is hashed on their own, and the hashes are summed, so this
+# doesn't depend on the order the subscribers were loaded in.
+def fingerprint(subscribers: Iterable[br.Subscriber | bd.Subscriber]) -> str:
+    # Tags are interned (see `util.intern_tags`), so there are only a few to
+    # sort.
+    sorted_tags: dict[frozenset[str], str] = {}
+    total = 0
+    for sub in subscribers:
+        tags = sorted_tags.get(sub.tags)
+        if tags is None:
+            tags = sorted_tags[sub.tags] = repr(sorted(sub.tags))
+        fields = f"{sub.id!r} {sub.email!r} {tags} {sorted(sub.metadata.items())!r}"
+        digest = hashlib.blake2b(fields.encode(), digest_size=16).digest()
+        total += int.from_bytes(digest)
+    return f"{total % 2**128:032x}"
+
+
+# A local SQLite database remembering the state of the last successful sync,
+# so the next sync can do a three-way diff, and so we can tell what changed
+# without talking to Baserow or Buttondown.
+class StateStore:
+    def __init__(self, path: Path | str):
+        self._db = sqlite3.connect(path)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # If given `ids`, only the subscribers with those ids.
+    def synced_subscribers(
+        self, ids: set[str] | None = None
+    ) -> dict[str, SyncedSubscriber]:
+        rows = (
+            self._db.execute("SELECT * FROM synced_subscribers")
+            if ids is None
+            else self._db.execute(
+                "SELECT * FROM synced_subscribers WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(sorted(ids)),),
+            )
+        )
+        return {row["id"]: SyncedSubscriber.from_row(row) for row in rows}
+
+    # Replace the stored state with `subscribers`, and log which rows changed.
+    # `snapshots_taken_at` is when the snapshots (if any) this sync was based on
+    # were taken, by source. See `changed_ids`.
+    #
+    # `fingerprints` are those of Baserow and Buttondown as this sync left them,
+    # by source. See `fingerprints`.
+    #
+    # If given `ids`, only subscribers with those ids may have changed: the
+    # rest of the stored state is left alone, and `subscribers` need only
+    # cover those ids.
+    def record_sync(
+        self,
+        subscribers: Iterable[SyncedSubscriber],
+        synced_at: datetime,
+        snapshots_taken_at: dict[str, datetime] = {},
+        ids: set[str] | None = None,
+        fingerprints: dict[str, str] = {},
+    ) -> list[Change]:
+        previous = self.synced_subscribers(ids)
+        current = {s.id: s for s in subscribers if ids is None or s.id in ids}
+
+        changes = [
+            Change(id=id, subscriber=current.get(id))
+            for id in sorted(previous.keys() | current.keys())
+            if previous.get(id) != current.get(id)
+        ]
+
+        with self._db:
+            for change in changes:
+                if change.subscriber is None:
+                    self._db.execute(
+                        "DELETE FROM synced_subscribers WHERE id = ?", (change.id,)
+                    )
+                    self._db.execute(
+                        "INSERT INTO changes (synced_at, id) VALUES (?, ?)",
+                        (synced_at.isoformat(), change.id),
+                    )
+                else:
+                    row = change.subscriber.to_row()
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO synced_subscribers VALUES (?, ?, ?, ?)",
+                        row,
+                    )
+                    self._db.execute(
+                        "INSERT INTO changes VALUES (?, ?, ?, ?, ?)",
+                        (synced_at.isoformat(), *row),
+                    )
+
+            self._db.execute("DELETE FROM snapshots")
+            self._db.executemany(
+                "INSERT INTO snapshots VALUES (?, ?)",
+                [
+                    (source, taken_at.isoformat())
+                    for source, taken_at in snapshots_taken_at.items()
+                ],
+            )
+            self._db.execute("DELETE FROM fingerprints")
+            self._db.executemany(
+                "INSERT INTO fingerprints VALUES (?, ?)", fingerprints.items()
+            )
+
+        return changes
+
+    # The fingerprints recorded by the last recorded sync, by source. If
+    # Baserow and Buttondown still have the same fingerprints, nothing
+    # changed since that sync left them in sync, so there's nothing to do.
+    def fingerprints(self) -> dict[str, str]:
+        return {
+            row["source"]: row["fingerprint"]
+            for row in self._db.execute("SELECT * FROM fingerprints")
+        }
+
+    # The ids that may have changed on either side since the last recorded
+    # sync, given what each side's loader says changed since its previous
+    # snapshot. Everyone else still matches what that sync pushed, so a
+    # three-way diff can skip them without looking.
+    #
+    # That only holds if both sides were loaded from the very snapshots that
+    # sync was based on, so this is None (meaning "anything may have
+    # changed") unless they were. Note that Buttondown can't tell us who was
+    # deleted since a snapshot, so those go unnoticed until its next full
+    # refresh (see `buttondown.Snapshot.last_full_refresh_at`).
+    def changed_ids(
+        self, changes_by_source: dict[str, ChangedIds | None]
+    ) -> set[str] | None:
+        taken_at_by_source = {
+            row["source"]: datetime.fromisoformat(row["taken_at"])
+            for row in self._db.execute("SELECT * FROM snapshots")
+        }
+
+        ids: set[str] = set()
+        for source, changes in changes_by_source.items():
+            if changes is None or taken_at_by_source.get(source) != changes.since:
+                return None
+            ids |= changes.ids
+
+        return ids
+
+    def last_change_at(self) -> datetime | None:
+        (synced_at,) = self._db.execute("SELECT MAX(synced_at) FROM changes").fetchone()
+        return None if synced_at is None else datetime.fromisoformat(synced_at)
+
+    # All changes recorded at or after `since`, oldest first.
+    def changes_since(self, since: datetime) -> list[tuple[datetime, Change]]:
+        return [
+            (
+                datetime.fromisoformat(row["synced_at"]),
+                Change(
+                    id=row["id"],
+                    subscriber=None
+                    if row["email"] is None
+                    else SyncedSubscriber.from_row(row),
+                ),
+            )
+            for row in self._db.execute(
+                "SELECT * FROM changes WHERE synced_at >= ? ORDER BY synced_at, rowid",
+                (since.isoformat(),),
+            )
+        ]
@@ -0,0 +1,179 @@
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .state import (
+    Change,
+    StateStore,
+    SyncedSubscriber,
+    fingerprint,
+    synced_subscribers,
+)
+from .sync_test import bd_sub, br_sub, db
+from .util import ChangedIds
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+T1 = datetime(2025, 1, 2, tzinfo=timezone.utc)
+
+
+def synced(id: str, email: str, tags: set[str] = set()) -> SyncedSubscriber:
+    return SyncedSubscriber(id=id, email=email, tags=tags, metadata={"id": id})
+
+
+def test_synced_subscribers():
+    assert synced_subscribers(
+        db(
+            subscribers=[
+                br_sub(id="1", email="j1@example.com", tags={"colby"}),
+                br_sub(id="2", email="j1@example.com"),
+                br_sub(id="3", email=""),
+            ]
+        )
+    ) == [synced("1", "j1@example.com", tags={"colby"})]
+
+    assert synced_subscribers(
+        db(
+            subscribers=[
+                br_sub(id="1", email="j1@example.com"),
+                br_sub(id="2", email="j2@example.com"),
+            ]
+        ),
+        ids={"2", "3"},
+    ) == [synced("2", "j2@example.com")]
+
+
+def test_record_sync(tmp_path: Path):
+    path = tmp_path / "state.sqlite3"
+
+    with StateStore(path) as store:
+        assert store.synced_subscribers() == {}
+        assert store.last_change_at() is None
+
+        assert store.record_sync(
+            [
+                synced("1", "j1@example.com", tags={"colby", "gouda"}),
+                synced("2", "j2@example.com"),
+            ],
+            synced_at=T0,
+        ) == [
+            Change(
+                id="1", subscriber=synced("1", "j1@example.com", {"colby", "gouda"})
+            ),
+            Change(id="2", subscriber=synced("2", "j2@example.com")),
+        ]
+
+    # The state survives reopening the database.
+    with StateStore(path) as store:
+        assert store.record_sync(
+            [
+                synced("1", "j1@example.com", tags={"colby", "gouda"}),
+                synced("3", "j3@example.com"),
+            ],
+            synced_at=T1,
+        ) == [
+            Change(id="2", subscriber=None),
+            Change(id="3", subscriber=synced("3", "j3@example.com")),
+        ]
+
+        assert store.synced_subscribers() == {
+            "1": synced("1", "j1@example.com", tags={"colby", "gouda"}),
+            "3": synced("3", "j3@example.com"),
+        }
+        assert store.last_change_at() == T1
+        assert store.changes_since(T1) == [
+            (T1, Change(id="2", subscriber=None)),
+            (T1, Change(id="3", subscriber=synced("3", "j3@example.com"))),
+        ]
+        assert len(store.changes_since(T0)) == 4
+
+
+def test_record_sync_only_changed_ids(tmp_path: Path):
+    with StateStore(tmp_path / "state.sqlite3") as store:
+        store.record_sync(
+            [synced("1", "j1@example.com"), synced("2", "j2@example.com")],
+            synced_at=T0,
+        )
+        assert store.synced_subscribers(ids={"2", "3"}) == {
+            "2": synced("2", "j2@example.com")
+        }
+
+        # Only ids 2 and 3 may have changed, so 1 is left alone even though
+        # it's missing.
+        assert store.record_sync(
+            [synced("3", "j3@example.com")], synced_at=T1, ids={"2", "3"}
+        ) == [
+            Change(id="2", subscriber=None),
+            Change(id="3", subscriber=synced("3", "j3@example.com")),
+        ]
+        assert store.synced_subscribers().keys() == {"1", "3"}
+
+
+def test_changed_ids(tmp_path: Path):
+    with StateStore(tmp_path / "state.sqlite3") as store:
+        baserow_changes = ChangedIds(since=T0, ids={"1"})
+        buttondown_changes = ChangedIds(since=T1, ids={"2"})
+        changes_by_source = {
+            "baserow": baserow_changes,
+            "buttondown": buttondown_changes,
+        }
+
+        # Nothing was recorded yet.
+        assert store.changed_ids(changes_by_source) is None
+
+        store.record_sync(
+            [], synced_at=T1, snapshots_taken_at={"baserow": T0, "buttondown": T1}
+        )
+        assert store.changed_ids(changes_by_source) == {"1", "2"}
+
+        # A side that was loaded from scratch could have changed in any way.
+        assert store.changed_ids({**changes_by_source, "baserow": None}) is None
+
+        # As could one loaded from a snapshot other than the recorded one.
+        assert (
+            store.changed_ids(
+                {**changes_by_source, "buttondown": ChangedIds(since=T0, ids=set())}
+            )
+            is None
+        )
+
+        # Each sync replaces the recorded snapshots.
+        store.record_sync([], synced_at=T1, snapshots_taken_at={"baserow": T0})
+        assert store.changed_ids(changes_by_source) is None
+
+
+def test_fingerprint():
+    j1 = bd_sub(id="1", email="j1@example.com", tags={"colby", "gouda"})
+    j2 = bd_sub(id="2", email="j2@example.com")
+    assert fingerprint([j1, j2]) == fingerprint([j2, j1])
+    assert fingerprint([j1, j2]) != fingerprint([j1])
+    assert fingerprint([j1, j2]) != fingerprint([j1, j2, j2])
+    assert fingerprint([j1]) != fingerprint(
+        [bd_sub(id="1", email="j1@example.com", tags={"colby"})]
+    )
+    assert fingerprint([j1]) != fingerprint(
+        [
+            bd_sub(
+                id="1",
+                email="j1@example.com",
+                tags={"colby", "gouda"},
+                metadata={"Sport": "go"},
+            )
+        ]
+    )
+
+    # The same subscriber looks the same on both sides.
+    assert fingerprint([j1]) == fingerprint(
+        [br_sub(id="1", email="j1@example.com", tags={"gouda", "colby"})]
+    )
+
+
+def test_record_fingerprints(tmp_path: Path):
+    with StateStore(tmp_path / "state.sqlite3") as store:
+        assert store.fingerprints() == {}
+
+        fingerprints = {"baserow": "a", "buttondown": "b"}
+        store.record_sync([], synced_at=T0, fingerprints=fingerprints)
+        assert store.fingerprints() == fingerprints
+
+        # Each sync replaces the recorded fingerprints.
+        store.record_sync([], synced_at=T1)
+        assert store.fingerprints() == {}
@@ -1,3 +1,7 @@
+import json
+from enum import StrEnum
+from typing import Iterable, Self, TextIO
+
 import click
 from pydantic import BaseModel
 
@@ -7,68 +11,331 @@ from brbd_sync.util import partition
 from . import baserow as br
 from . import buttondown as bd
 from . import buttondown_api as bd_api
+from . import executor
+from . import state as st
+from .batch import batch_operations
+from .metrics import Metrics
 
 SyncOperation = buttondown_api.Operation
 
 
+# How `apply` reports the operations it performs, as each one finishes.
+class OutputMode(StrEnum):
+    # Only count them.
+    SUMMARY = "summary"
+    # Count them, and write each one to a file as a line of JSON (see
+    # `format_outcome`).
+    JSONL = "jsonl"
+    # Print each one, and keep them all in `SyncResult.operations`.
+    VERBOSE = "verbose"
+
+
+# How an operation `apply` reports turned out.
+class Status(StrEnum):
+    # This was a dry run, so it didn't actually run.
+    PLANNED = "planned"
+    OK = "ok"
+    # Buttondown refused it. See `bd_api.SkippableEmailError`.
+    SKIPPED = "skipped"
+    # It failed in a way that aborted the run.
+    FAILED = "failed"
+
+
 class SyncResult(BaseModel):
     warnings: list[str] = []
+    # Only kept with `OutputMode.VERBOSE`, as are `skipped_operations`.
+    # Otherwise, memory use would grow with the size of the sync: see
+    # `operation_counts` and `skipped_count`.
     operations: list[SyncOperation] = []
+    # By operation type. Operations that failed aren't counted.
+    operation_counts: dict[str, int] = {}
+    skipped_operations: list[SyncOperation] = []
+    skipped_count: int = 0
+    # How many fewer API calls we made thanks to bulk actions.
+    api_calls_saved: int = 0
+
+    @property
+    def operation_count(self) -> int:
+        return sum(self.operation_counts.values())
 
     def add_warning(self, warning: str):
         click.secho(warning, fg="yellow")
         self.warnings.append(warning)
 
-    def add_op(self, op: SyncOperation):
-        click.echo(f"Operation {type(op).__name__}: {op}")
-        self.operations.append(op)
+    def add_op(
+        self,
+        op: SyncOperation,
+        status: Status = Status.PLANNED,
+        output_mode: OutputMode = OutputMode.VERBOSE,
+        jsonl: TextIO | None = None,
+    ):
+        op_type = type(op).__name__
+        if status != Status.FAILED:
+            self.operation_counts[op_type] = self.operation_counts.get(op_type, 0) + 1
+            if isinstance(op, bd_api.BulkOperation):
+                self.api_calls_saved += op.api_calls_saved()
+        if status == Status.SKIPPED:
+            self.skipped_count += 1
+
+        match output_mode:
+            case OutputMode.SUMMARY:
+                pass
+            case OutputMode.JSONL:
+                assert jsonl is not None, "OutputMode.JSONL needs a file"
+                jsonl.write(format_outcome(op, status) + "\n")
+            case OutputMode.VERBOSE:
+                match status:
+                    case Status.SKIPPED:
+                        click.echo(f"Skipped operation {op_type}: {op}")
+                        self.skipped_operations.append(op)
+                    case Status.FAILED:
+                        click.echo(f"Failed operation {op_type}: {op}")
+                    case _:
+                        click.echo(f"Operation {op_type}: {op}")
+                self.operations.append(op)
+
+
+def skipped_op_warning(op: SyncOperation, e: bd_api.SkippableEmailError) -> str:
+    match op:
+        case bd_api.AddSub():
+            return f"Ran into trouble adding the email {op.email}. code={e.code!r} detail={e.detail!r}"
+        case bd_api.EditSub():
+            return f"Ran into trouble changing the email from {op.old_email} to {op.new_email}. code={e.code!r} detail={e.detail!r}"
+        case _:  # pragma: no cover (only adds and edits are skippable)
+            return f"Ran into trouble with {op}. code={e.code!r} detail={e.detail!r}"
+
+
+OPERATION_TYPES: dict[str, type[SyncOperation]] = {
+    op_type.__name__: op_type
+    for op_type in [
+        bd_api.AddSub,
+        bd_api.EditSub,
+        bd_api.DeleteSub,
+        bd_api.BulkDeleteSubs,
+        bd_api.BulkEditTags,
+    ]
+}
+
+
+class Plan(BaseModel):
+    warnings: list[str] = []
+    operations: list[SyncOperation] = []
+
+    # A plan is serialized as JSON Lines, one operation per line. Each line
+    # is an object with a single key: the name of the operation type.
+    # Warnings are only of interest when the plan is made, so they are not
+    # serialized.
+    def write(self, f: TextIO):
+        for op in self.operations:
+            f.write(format_operation(op) + "\n")
+
+    @classmethod
+    def read(cls, f: TextIO) -> Self:
+        operations: list[SyncOperation] = []
+        for lineno, line in enumerate(f, start=1):
+            if line.strip() == "":
+                continue
+
+            ((op_type_name, fields),) = json.loads(line).items()
+            op_type = OPERATION_TYPES.get(op_type_name)
+            assert op_type is not None, (
+                f"Unrecognized operation {op_type_name!r} on line {lineno}"
+            )
+            operations.append(op_type.model_validate(fields))
+
+        return cls(operations=operations)
+
+
+# A line of a serialized `Plan`.
+def format_operation(op: SyncOperation) -> str:
+    line = {type(op).__name__: op.model_dump(mode="json", exclude_none=True)}
+    return json.dumps(line, separators=(",", ":"))
+
+
+# A line of `OutputMode.JSONL` output: like a line of a serialized `Plan`,
+# plus how the operation turned out.
+def format_outcome(op: SyncOperation, status: Status) -> str:
+    line = {
+        type(op).__name__: op.model_dump(mode="json", exclude_none=True),
+        "status": status.value,
+    }
+    return json.dumps(line, separators=(",", ":"))
 
 
 def sync(
     baserow_data_possible_email_dupes: br.Data,
     buttondown_data: bd.Data,
     dry_run: bool,
+    concurrency: int = 1,
+    synced: dict[str, st.SyncedSubscriber] | None = None,
+    min_batch_size: int | None = None,
+    metrics: Metrics | None = None,
+    output_mode: OutputMode = OutputMode.VERBOSE,
+    jsonl: TextIO | None = None,
+) -> SyncResult:
+    return apply(
+        plan(
+            baserow_data_possible_email_dupes,
+            buttondown_data,
+            synced=synced,
+            min_batch_size=min_batch_size,
+            metrics=metrics,
+        ),
+        buttondown_data.api_client,
+        dry_run=dry_run,
+        concurrency=concurrency,
+        metrics=metrics,
+        output_mode=output_mode,
+        jsonl=jsonl,
+        buttondown_data=buttondown_data,
+    )
+
+
+# Perform the operations in `plan` (unless this is a dry run), reporting each
+# one as `output_mode` says as soon as it finishes (or, in a dry run, all of
+# them up front). `jsonl` is where `OutputMode.JSONL` writes them.
+#
+# If given `buttondown_data`, it is kept up to date with the operations that
+# succeed. See `executor.execute`.
+def apply(
+    plan: Plan,
+    api_client: bd_api.Client,
+    dry_run: bool,
+    concurrency: int = 1,
+    metrics: Metrics | None = None,
+    output_mode: OutputMode = OutputMode.VERBOSE,
+    jsonl: TextIO | None = None,
+    buttondown_data: bd.Data | None = None,
 ) -> SyncResult:
+    if metrics is None:
+        metrics = Metrics()
+
     result = SyncResult()
 
-    def edit_buttondown_sub(
-        buttondown_sub: bd.Subscriber, baserow_sub: br.SubscriberWithEmail
+    for warning in plan.warnings:
+        result.add_warning(warning)
+
+    for op in plan.operations:
+        metrics.count_operation(type(op).__name__)
+
+    if dry_run:
+        for op in plan.operations:
+            result.add_op(op, Status.PLANNED, output_mode, jsonl)
+        return result
+
+    def on_done(op: SyncOperation, error: Exception | None):
+        match error:
+            case None:
+                status = Status.OK
+            case bd_api.SkippableEmailError():
+                status = Status.SKIPPED
+            case _:
+                status = Status.FAILED
+        result.add_op(op, status, output_mode, jsonl)
+
+    with metrics.phase("apply"):
+        skipped = executor.execute(
+            plan.operations, api_client, concurrency, buttondown_data, on_done
+        )
+    for op, e in skipped:
+        metrics.count_skipped_email(e.code)
+        result.add_warning(skipped_op_warning(op, e))
+
+    return result
+
+
+# The edit (if any) needed to make `buttondown_sub` match `baserow_sub`.
+def edit_to_match(
+    buttondown_sub: bd.Subscriber, baserow_sub: br.SubscriberWithEmail
+) -> bd_api.EditSub | None:
+    edit_op = bd_api.EditSub(old_email=buttondown_sub.email)
+    if baserow_sub.email != buttondown_sub.email:
+        edit_op.new_email = baserow_sub.email
+
+    # Tags are interned (see `util.intern_tags`), so equal tags are almost
+    # always the same object, which is quicker to check than their contents.
+    if (
+        baserow_sub.tags is not buttondown_sub.tags
+        and baserow_sub.tags != buttondown_sub.tags
     ):
-        # We've got a matching row from Baserow and a subscription
-        # from Buttondown -> edit the subscription in Buttondown to match.
-        edit_op = bd_api.EditSub(old_email=buttondown_sub.email)
-        if baserow_sub.email != buttondown_sub.email:
-            edit_op.new_email = baserow_sub.email
-
-        if baserow_sub.tags != buttondown_sub.tags:
-            edit_op.tags = baserow_sub.tags
-
-        if baserow_sub.metadata != buttondown_sub.metadata:
-            edit_op.metadata = baserow_sub.metadata
-
-        if not edit_op.is_noop():
-            result.add_op(edit_op)
-            try:
-                buttondown_data.edit(edit_op, dry_run=dry_run)
-            except (
-                bd_api.SkippableEmailError
-            ) as e:  # pragma: no cover (requires internet)
-                result.add_warning(
-                    f"Ran into trouble changing the email from {edit_op.old_email} to {edit_op.new_email}. code={e.code!r} detail={e.detail!r}"
-                )
+        edit_op.tags = baserow_sub.tags
+
+    if baserow_sub.metadata != buttondown_sub.metadata:
+        edit_op.metadata = baserow_sub.metadata
+
+    return None if edit_op.is_noop() else edit_op
 
-    dupe_emails, baserow_data = (
-        baserow_data_possible_email_dupes.with_no_duplicate_emails()
+
+# Compute the operations needed to make Buttondown match Baserow. This has no
+# side effects: the given `buttondown_data` is left untouched, and nothing is
+# printed.
+#
+# If given `synced` (the state pushed to Buttondown by the last successful
+# sync, see `state.StateStore`), this is a three-way diff: rows that match
+# the synced state in both Baserow and Buttondown are skipped entirely. If
+# also given `changed_ids` (the ids that may have changed on either side since
+# that sync, see `state.StateStore.changed_ids`), only those ids are looked at
+# at all, and `synced` need only cover them.
+#
+# If given `min_batch_size`, groups of at least that many similar operations
+# are replaced with bulk operations. See `batch.batch_operations`.
+#
+# If given `metrics`, records how long deduping Baserow and diffing took, and
+# how many subscribers there are on each side.
+def plan(
+    baserow_data_possible_email_dupes: br.Data,
+    original_buttondown_data: bd.Data,
+    synced: dict[str, st.SyncedSubscriber] | None = None,
+    min_batch_size: int | None = None,
+    metrics: Metrics | None = None,
+    changed_ids: set[str] | None = None,
+) -> Plan:
+    assert changed_ids is None or synced is not None
+    if metrics is None:
+        metrics = Metrics()
+
+    metrics.set_subscriber_count(
+        "baserow", len(baserow_data_possible_email_dupes.subscribers)
     )
+    metrics.set_subscriber_count(
+        "buttondown", len(original_buttondown_data.subscribers)
+    )
+
+    with metrics.phase("dedupe"):
+        dupe_emails, baserow_data = (
+            baserow_data_possible_email_dupes.with_no_duplicate_emails()
+        )
+
+    with metrics.phase("diff"):
+        return diff(
+            baserow_data,
+            dupe_emails,
+            original_buttondown_data,
+            synced=synced,
+            min_batch_size=min_batch_size,
+            changed_ids=changed_ids,
+        )
+
+
+# The bulk of `plan`, once Baserow has no duplicate emails left.
+def diff(
+    baserow_data: br.DataWithUniqueEmails,
+    dupe_emails: list[str],
+    original_buttondown_data: bd.Data,
+    synced: dict[str, st.SyncedSubscriber] | None,
+    min_batch_size: int | None,
+    changed_ids: set[str] | None = None,
+) -> Plan:
+    result = Plan()
+
+    # We keep our own copy of Buttondown up to date as we plan operations, as
+    # later decisions depend on earlier ones.
+    buttondown_data = original_buttondown_data.copy()
+
     for dupe_email in dupe_emails:
         row = baserow_data.get_subscriber(email=dupe_email)
         assert row is not None
-        result.add_warning(
-            f"Unexpectedly found multiple Baserow rows with email={dupe_email!r}. I picked the one with id={row.id!r}"
-        )
-
-    baserow_ids = set(s.id for s in baserow_data.subscribers)
-    buttondown_ids = set(s.id for s in buttondown_data.subscribers if s.id is not None)
+        result.warnings.append(dupe_email_warning(dupe_email, row.id))
 
     # Someone in the mailing list without an `id` is either:
     #
@@ -79,9 +346,7 @@ def sync(
     #
     # We can distinguish between these by checking the database to see if we
     # have someone with the same email address.
-    buttondown_subs_missing_id = [
-        s for s in buttondown_data.subscribers if s.id is None
-    ]
+    buttondown_subs_missing_id = buttondown_data.get_subscribers(id=None)
     new_buttondown_subs, corrupted_buttondown_subs = partition(
         buttondown_subs_missing_id,
         lambda sub: baserow_data.get_subscriber(email=sub.email) is None,
@@ -89,12 +354,84 @@ def sync(
 
     if len(new_buttondown_subs) > 0:
         # A new subscriber. Warn the user that they should add them to the database.
-        pretty_emails = ", ".join(sorted(sub.email for sub in new_buttondown_subs))
-        result.add_warning(
-            f"The following emails signed up for the newsletter directly and need to be added to the database: {pretty_emails}"
+        result.warnings.append(
+            new_subscribers_warning(sub.email for sub in new_buttondown_subs)
         )
 
     # Edit all the corrupted subscribers so they match.
+    result.operations.extend(
+        fix_corrupted(baserow_data, buttondown_data, corrupted_buttondown_subs)
+    )
+
+    if changed_ids is not None:
+        ids = changed_ids
+    else:
+        ids = set(s.id for s in baserow_data.subscribers) | set(
+            s.id for s in buttondown_data.subscribers if s.id is not None
+        )
+    if synced is not None:
+        ids = {
+            id
+            for id in ids
+            if not is_unchanged(synced, baserow_data, buttondown_data, id)
+        }
+
+    result.operations.extend(plan_ids(baserow_data, buttondown_data, sorted(ids)))
+
+    if min_batch_size is not None:
+        result.operations = batch_operations(
+            result.operations, original_buttondown_data, min_batch_size
+        )
+
+    return result
+
+
+def dupe_email_warning(email: str, picked_id: str) -> str:
+    return f"Unexpectedly found multiple Baserow rows with email={email!r}. I picked the one with id={picked_id!r}"
+
+
+def new_subscribers_warning(emails: Iterable[str]) -> str:
+    pretty_emails = ", ".join(sorted(emails))
+    return f"The following emails signed up for the newsletter directly and need to be added to the database: {pretty_emails}"
+
+
+# A row that is unchanged on both sides since the last sync needs no
+# operations. Nothing we do to the other rows can affect it either: its email
+# is taken by it in both Baserow and Buttondown, so no other row can claim it.
+def is_unchanged(
+    synced: dict[str, st.SyncedSubscriber],
+    baserow_data: br.DataWithUniqueEmails,
+    buttondown_data: bd.Data,
+    id: str,
+) -> bool:
+    synced_sub = synced.get(id)
+    baserow_sub = baserow_data.get_subscriber(id=id)
+    buttondown_subs = buttondown_data.get_subscribers(id=id)
+    return (
+        synced_sub is not None
+        and baserow_sub is not None
+        and synced_sub.matches(
+            baserow_sub.email, baserow_sub.tags, baserow_sub.metadata
+        )
+        and len(buttondown_subs) == 1
+        and synced_sub.matches(
+            buttondown_subs[0].email,
+            buttondown_subs[0].tags,
+            buttondown_subs[0].metadata,
+        )
+    )
+
+
+# Edit each of the given corrupted Buttondown subscribers (see `diff`) to match
+# the Baserow row with their email. Like `plan_ids`, this updates
+# `buttondown_data` in place to reflect the operations.
+def fix_corrupted(
+    baserow_data: br.DataWithUniqueEmails,
+    buttondown_data: bd.Data,
+    corrupted_buttondown_subs: Iterable[bd.Subscriber],
+) -> list[SyncOperation]:
+    operations: list[SyncOperation] = []
+
     for corrupted_buttondown_sub in corrupted_buttondown_subs:
         email = corrupted_buttondown_sub.email
         baserow_sub = baserow_data.get_subscriber(email=email)
@@ -102,18 +439,36 @@ def sync(
             f"Unexpected Buttondown subscriber with no corresponding row in Baserow: {email}"
         )
 
-        edit_buttondown_sub(corrupted_buttondown_sub, baserow_sub)
+        edit_op = edit_to_match(corrupted_buttondown_sub, baserow_sub)
+        if edit_op is not None:
+            operations.append(edit_op)
+            buttondown_data.apply(edit_op)
+
+    return operations
 
-    for id in sorted(baserow_ids | buttondown_ids):
+
+# Compute the operations needed to make Buttondown match Baserow for just the
+# given ids. Unlike `plan`, this updates `buttondown_data` in place to reflect
+# the operations.
+def plan_ids(
+    baserow_data: br.DataWithUniqueEmails,
+    buttondown_data: bd.Data,
+    ids: Iterable[str],
+) -> list[SyncOperation]:
+    operations: list[SyncOperation] = []
+
+    def apply_op(op: SyncOperation):
+        operations.append(op)
+        buttondown_data.apply(op)
+
+    for id in ids:
         baserow_sub = baserow_data.get_subscriber(id=id)
         buttondown_subs = buttondown_data.get_subscribers(id=id)
 
         # No such id in Baserow -> delete all Buttondown subs.
         if baserow_sub is None:
             for bd_sub_to_remove in buttondown_subs:
-                delete_op = bd_api.DeleteSub(email=bd_sub_to_remove.email)
-                result.add_op(delete_op)
-                buttondown_data.delete(delete_op, dry_run=dry_run)
+                apply_op(bd_api.DeleteSub(email=bd_sub_to_remove.email))
 
             continue
 
@@ -126,36 +481,29 @@ def sync(
         bd_sub_with_email = buttondown_data.get_subscriber(email=baserow_sub.email)
 
         if bd_sub_with_email is not None and bd_sub_with_email.id != baserow_sub.id:
-            delete_op = bd_api.DeleteSub(email=bd_sub_with_email.email)
-            result.add_op(delete_op)
-            buttondown_data.delete(delete_op, dry_run=dry_run)
+            apply_op(bd_api.DeleteSub(email=bd_sub_with_email.email))
 
         # No such id in Buttondown -> create it!
         if len(buttondown_subs) == 0:
-            add_op = bd_api.AddSub(
-                email=baserow_sub.email,
-                tags=baserow_sub.tags,
-                metadata=baserow_sub.metadata,
-            )
-            result.add_op(add_op)
-            try:
-                buttondown_data.add(add_op, dry_run=dry_run)
-            except bd_api.SkippableEmailError as e:  # pragma: no cover
-                result.add_warning(
-                    f"Ran into trouble adding the email {add_op.email}. code={e.code!r} detail={e.detail!r}"
+            apply_op(
+                bd_api.AddSub(
+                    email=baserow_sub.email,
+                    tags=baserow_sub.tags,
+                    metadata=baserow_sub.metadata,
                 )
+            )
             continue
 
         # If there are multiple Buttondown subs with the same id,
         # delete all but the first one.
         buttondown_sub, *bd_subs_to_remove = buttondown_subs
         for bd_sub_to_remove in bd_subs_to_remove:
-            delete_op = bd_api.DeleteSub(email=bd_sub_to_remove.email)
-            result.add_op(delete_op)
-            buttondown_data.delete(delete_op, dry_run=dry_run)
+            apply_op(bd_api.DeleteSub(email=bd_sub_to_remove.email))
 
         # We've got a matching row from Baserow and a subscription
         # from Buttondown -> edit the subscription in Buttondown to match.
-        edit_buttondown_sub(buttondown_sub, baserow_sub)
+        edit_op = edit_to_match(buttondown_sub, baserow_sub)
+        if edit_op is not None:
+            apply_op(edit_op)
 
-    return result
+    return operations
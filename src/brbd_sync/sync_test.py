@@ -1,8 +1,16 @@
+import io
+import json
+
+import pytest
+
 from . import baserow as br
 from . import buttondown as bd
 from . import buttondown_api
 from .buttondown_api import AddSub, DeleteSub, EditSub
-from .sync import sync
+from .executor_test import FakeClient
+from .metrics import Metrics
+from .state import synced_subscribers
+from .sync import OutputMode, Plan, SyncResult, apply, plan, sync
 
 
 def db(subscribers: list[br.Subscriber]) -> br.Data:
@@ -39,6 +47,7 @@ def bd_sub(
     email: str,
     tags: set[str] = set(),
     metadata: dict[str, str] = {},
+    buttondown_id: str | None = None,
 ) -> bd.Subscriber:
     if id is not None:
         metadata = {
@@ -49,8 +58,9 @@ def bd_sub(
     return bd.Subscriber(
         id=id,
         email=email,
-        tags=tags,
+        tags=frozenset(tags),
         metadata=metadata,
+        buttondown_id=buttondown_id,
     )
 
 
@@ -307,3 +317,343 @@ def test_buttondown_signup():
     assert result.operations == [
         EditSub(old_email="old@example.com", metadata={"id": "1"}),
     ]
+
+
+def test_large_list_is_linear(monkeypatch: pytest.MonkeyPatch):
+    # Count how many times `bd.Data` touches its indices, rather than timing
+    # the sync, which would be flaky on a busy machine.
+    index_updates = 0
+    add_subscriber = bd.Data._add_subscriber
+    delete_subscriber = bd.Data._delete_subscriber
+
+    def counting_add_subscriber(self: bd.Data, new_sub: bd.Subscriber):
+        nonlocal index_updates
+        index_updates += 1
+        add_subscriber(self, new_sub)
+
+    def counting_delete_subscriber(self: bd.Data, email: str):
+        nonlocal index_updates
+        index_updates += 1
+        delete_subscriber(self, email)
+
+    monkeypatch.setattr(bd.Data, "_add_subscriber", counting_add_subscriber)
+    monkeypatch.setattr(bd.Data, "_delete_subscriber", counting_delete_subscriber)
+
+    def count_index_updates(n: int) -> int:
+        nonlocal index_updates
+        # Every subscriber needs an email change, which exercises the
+        # delete + add path through `bd.Data` once per id.
+        baserow_data = db(
+            subscribers=[
+                br_sub(id=str(i), email=f"new{i}@example.com") for i in range(n)
+            ]
+        )
+        buttondown_data = ml(
+            subscribers=[
+                bd_sub(id=str(i), email=f"old{i}@example.com") for i in range(n)
+            ]
+        )
+
+        index_updates = 0
+        result = sync(baserow_data, buttondown_data, dry_run=True)
+        assert len(result.operations) == n
+        return index_updates
+
+    # 10x the subscribers should take exactly 10x the index updates. Rebuilding
+    # the indices after every operation would take ~100x as many.
+    assert count_index_updates(1_000) * 10 == count_index_updates(10_000)
+
+
+def test_concurrent_matches_serial():
+    def run(concurrency: int) -> tuple[SyncResult, FakeClient, bd.Data]:
+        client = FakeClient(skippable_emails={"bad@example.com", "typo@example.com"})
+        buttondown_data = bd.Data(
+            subscribers=[
+                bd_sub(id="1", email="j2@example.com"),
+                bd_sub(id="2", email="j1@example.com"),
+                bd_sub(id="4", email="typo@example.com"),
+            ],
+            api_client=client,
+        )
+        result = sync(
+            db(
+                subscribers=[
+                    br_sub(id="1", email="j1@example.com"),
+                    br_sub(id="2", email="j2@example.com"),
+                    br_sub(id="3", email="bad@example.com"),
+                    br_sub(id="4", email="fixed@example.com"),
+                ]
+            ),
+            buttondown_data,
+            dry_run=False,
+            concurrency=concurrency,
+        )
+        return result, client, buttondown_data
+
+    serial_result, serial_client, serial_data = run(concurrency=1)
+    concurrent_result, concurrent_client, concurrent_data = run(concurrency=4)
+
+    # Operations are reported as they finish, which in a concurrent run may
+    # not be the order they were planned in.
+    assert concurrent_result.model_copy(
+        update={
+            "operations": sorted(concurrent_result.operations, key=repr),
+            "skipped_operations": sorted(
+                concurrent_result.skipped_operations, key=repr
+            ),
+        }
+    ) == serial_result.model_copy(
+        update={
+            "operations": sorted(serial_result.operations, key=repr),
+            "skipped_operations": sorted(serial_result.skipped_operations, key=repr),
+        }
+    )
+    assert concurrent_result.skipped_count == 2
+    assert concurrent_result.warnings == [
+        "Ran into trouble adding the email bad@example.com. code='email_invalid' detail='nope'",
+        "Ran into trouble changing the email from typo@example.com to fixed@example.com. code='email_invalid' detail='nope'",
+    ]
+    assert serial_result.operations == [
+        DeleteSub(email="j1@example.com"),
+        EditSub(old_email="j2@example.com", new_email="j1@example.com"),
+        AddSub(email="j2@example.com", metadata={"id": "2"}, tags=set()),
+        AddSub(email="bad@example.com", metadata={"id": "3"}, tags=set()),
+        EditSub(old_email="typo@example.com", new_email="fixed@example.com"),
+    ]
+    assert serial_result.skipped_operations == [
+        AddSub(email="bad@example.com", metadata={"id": "3"}, tags=set()),
+        EditSub(old_email="typo@example.com", new_email="fixed@example.com"),
+    ]
+    assert sorted(concurrent_client.calls) == sorted(serial_client.calls)
+
+    # Skipped operations leave our picture of Buttondown alone: the failed
+    # rename didn't happen, and the failed add didn't either.
+    def by_email(data: bd.Data) -> list[bd.Subscriber]:
+        return sorted(data.subscribers, key=lambda sub: sub.email)
+
+    assert by_email(concurrent_data) == by_email(serial_data)
+    assert sorted((sub.id, sub.email) for sub in concurrent_data.subscribers) == [
+        ("1", "j1@example.com"),
+        ("2", "j2@example.com"),
+        ("4", "typo@example.com"),
+    ]
+
+
+def test_plan_has_no_side_effects():
+    buttondown_data = ml(subscribers=[bd_sub(id="1", email="tst1@example.com")])
+    the_plan = plan(
+        db(subscribers=[br_sub(id="1", email="test1@example.com")]),
+        buttondown_data,
+    )
+    assert the_plan.operations == [
+        EditSub(old_email="tst1@example.com", new_email="test1@example.com"),
+    ]
+    assert buttondown_data.subscribers == [
+        bd_sub(id="1", email="tst1@example.com"),
+    ]
+
+
+def test_three_way_plan_matches_two_way_plan():
+    last_synced = db(
+        subscribers=[
+            br_sub(id="1", email="j1@example.com"),
+            br_sub(id="2", email="j2@example.com"),
+            br_sub(id="3", email="j3@example.com", tags={"colby"}),
+            br_sub(id="4", email="j4@example.com"),
+            br_sub(id="5", email="j5@example.com"),
+        ]
+    )
+    baserow_data = db(
+        subscribers=[
+            # Unchanged.
+            br_sub(id="1", email="j1@example.com"),
+            # Swapped emails in Baserow.
+            br_sub(id="2", email="j3@example.com"),
+            br_sub(id="3", email="j2@example.com", tags={"colby"}),
+            # Unchanged in Baserow, but edited directly in Buttondown.
+            br_sub(id="4", email="j4@example.com"),
+            # Row 5 was removed, and row 6 is new.
+            br_sub(id="6", email="j6@example.com"),
+        ]
+    )
+    buttondown_data = ml(
+        subscribers=[
+            bd_sub(id="1", email="j1@example.com"),
+            bd_sub(id="2", email="j2@example.com"),
+            bd_sub(id="3", email="j3@example.com", tags={"colby"}),
+            bd_sub(id="4", email="j4@example.com", tags={"gouda"}),
+            bd_sub(id="5", email="j5@example.com"),
+            bd_sub(id=None, email="j1-typo@example.com"),
+        ]
+    )
+
+    synced = {s.id: s for s in synced_subscribers(last_synced)}
+    the_plan = plan(baserow_data, buttondown_data, synced=synced)
+    assert the_plan == plan(baserow_data, buttondown_data)
+    assert the_plan.operations == [
+        DeleteSub(email="j3@example.com"),
+        EditSub(old_email="j2@example.com", new_email="j3@example.com"),
+        AddSub(email="j2@example.com", metadata={"id": "3"}, tags={"colby"}),
+        EditSub(old_email="j4@example.com", tags=set()),
+        DeleteSub(email="j5@example.com"),
+        AddSub(email="j6@example.com", metadata={"id": "6"}, tags=set()),
+    ]
+
+    # Told which ids changed since the last sync, the rest aren't looked at.
+    changed_ids = {"2", "3", "4", "5", "6"}
+    assert (
+        plan(
+            baserow_data,
+            buttondown_data,
+            synced={id: synced[id] for id in changed_ids & synced.keys()},
+            changed_ids=changed_ids,
+        )
+        == the_plan
+    )
+    assert plan(
+        baserow_data, buttondown_data, synced={}, changed_ids={"6"}
+    ).operations == [AddSub(email="j6@example.com", metadata={"id": "6"}, tags=set())]
+
+
+def test_plan_changed_ids_still_fixes_corrupted_subscribers():
+    baserow_data = db(subscribers=[br_sub(id="1", email="j1@example.com")])
+    buttondown_data = ml(subscribers=[bd_sub(id=None, email="j1@example.com")])
+
+    the_plan = plan(baserow_data, buttondown_data, synced={}, changed_ids=set())
+    assert the_plan == plan(baserow_data, buttondown_data)
+    assert the_plan.operations == [
+        EditSub(old_email="j1@example.com", metadata={"id": "1"})
+    ]
+
+
+def test_plan_round_trip():
+    the_plan = Plan(
+        warnings=["warnings are not serialized"],
+        operations=[
+            DeleteSub(email="j1@example.com"),
+            EditSub(old_email="j2@example.com", new_email="j1@example.com"),
+            EditSub(old_email="j3@example.com", tags={"parmesan", "colby"}),
+            AddSub(
+                email="j2@example.com",
+                metadata={"id": "2"},
+                tags={"parmesan", "colby"},
+            ),
+        ],
+    )
+
+    f = io.StringIO()
+    the_plan.write(f)
+    assert f.getvalue().splitlines() == [
+        '{"DeleteSub":{"email":"j1@example.com"}}',
+        '{"EditSub":{"old_email":"j2@example.com","new_email":"j1@example.com"}}',
+        '{"EditSub":{"old_email":"j3@example.com","tags":["colby","parmesan"]}}',
+        '{"AddSub":{"email":"j2@example.com","tags":["colby","parmesan"],"metadata":{"id":"2"}}}',
+    ]
+
+    # Blank lines (say, from a human editing the plan) are ignored.
+    f.write("\n")
+    f.seek(0)
+    assert Plan.read(f) == Plan(operations=the_plan.operations)
+
+
+def test_sync_records_metrics():
+    metrics = Metrics()
+    sync(
+        db(
+            subscribers=[
+                br_sub(id="1", email="j1@example.com"),
+                br_sub(id="2", email="bad@example.com"),
+                br_sub(id="3", email="bad@example.com"),
+            ]
+        ),
+        bd.Data(
+            subscribers=[bd_sub(id="4", email="j4@example.com")],
+            api_client=FakeClient(skippable_emails={"bad@example.com"}),
+        ),
+        dry_run=False,
+        metrics=metrics,
+    )
+
+    report = metrics.report()
+    assert report.operations == {"AddSub": 2, "DeleteSub": 1}
+    assert report.skipped_emails == {"email_invalid": 1}
+    assert report.subscribers == {"baserow": 3, "buttondown": 1}
+    assert sorted(report.phase_seconds) == ["apply", "dedupe", "diff"]
+
+
+def test_output_modes(capsys):
+    def run(output_mode: OutputMode, jsonl: io.StringIO | None = None) -> SyncResult:
+        return sync(
+            db(
+                subscribers=[
+                    br_sub(id="1", email="j1@example.com"),
+                    br_sub(id="2", email="j2@example.com"),
+                ]
+            ),
+            ml(subscribers=[bd_sub(id="3", email="j3@example.com")]),
+            dry_run=True,
+            output_mode=output_mode,
+            jsonl=jsonl,
+        )
+
+    verbose = run(OutputMode.VERBOSE)
+    assert len(verbose.operations) == 3
+    assert verbose.operation_counts == {"AddSub": 2, "DeleteSub": 1}
+    assert capsys.readouterr().out.count("Operation ") == 3
+
+    summary = run(OutputMode.SUMMARY)
+    assert summary.operations == []
+    assert summary.operation_counts == verbose.operation_counts
+    assert summary.operation_count == 3
+    assert capsys.readouterr().out == ""
+
+    f = io.StringIO()
+    jsonl = run(OutputMode.JSONL, f)
+    assert jsonl.operations == []
+    assert jsonl.operation_counts == verbose.operation_counts
+    assert capsys.readouterr().out == ""
+    assert [json.loads(line)["status"] for line in f.getvalue().splitlines()] == [
+        "planned"
+    ] * 3
+
+
+def test_operations_are_reported_as_they_finish(capsys):
+    class BrokenClient(FakeClient):
+        def delete(self, path: str):
+            raise RuntimeError("oh no")
+
+    ops = [
+        AddSub(email="j1@example.com", tags=set(), metadata={"id": "1"}),
+        AddSub(email="bad@example.com", tags=set(), metadata={"id": "2"}),
+        DeleteSub(email="j3@example.com"),
+        AddSub(email="j4@example.com", tags=set(), metadata={"id": "4"}),
+    ]
+    f = io.StringIO()
+    with pytest.raises(RuntimeError, match="oh no"):
+        apply(
+            Plan(operations=ops),
+            BrokenClient(skippable_emails={"bad@example.com"}),
+            dry_run=False,
+            output_mode=OutputMode.JSONL,
+            jsonl=f,
+        )
+
+    # The run stopped at the failed delete, so the last add never ran, and
+    # isn't reported.
+    assert f.getvalue().splitlines() == [
+        '{"AddSub":{"email":"j1@example.com","tags":[],"metadata":{"id":"1"}},"status":"ok"}',
+        '{"AddSub":{"email":"bad@example.com","tags":[],"metadata":{"id":"2"}},"status":"skipped"}',
+        '{"DeleteSub":{"email":"j3@example.com"},"status":"failed"}',
+    ]
+
+    with pytest.raises(RuntimeError, match="oh no"):
+        apply(
+            Plan(operations=ops),
+            BrokenClient(skippable_emails={"bad@example.com"}),
+            dry_run=False,
+        )
+    assert capsys.readouterr().out.splitlines() == [
+        "Operation AddSub: email='j1@example.com' tags=set() metadata={'id': '1'}",
+        "Skipped operation AddSub: email='bad@example.com' tags=set() metadata={'id': '2'}",
+        "Failed operation DeleteSub: email='j3@example.com'",
+    ]
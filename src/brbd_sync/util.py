@@ -1,4 +1,13 @@
-from typing import Callable
+import os
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 
 def group_by[K, V](arr: list[V], key: Callable[[V], K]) -> dict[K, list[V]]:
@@ -13,20 +22,6 @@ def group_by[K, V](arr: list[V], key: Callable[[V], K]) -> dict[K, list[V]]:
     return result
 
 
-def unique_group_by[K, V](arr: list[V], key: Callable[[V], K]) -> dict[K, V]:
-    grouped = group_by(arr, key)
-
-    result: dict[K, V] = {}
-
-    for k, vs in grouped.items():
-        assert len(vs) == 1, f"Expected to find exactly 1 value for key {k!r}: {vs}"
-        (v,) = vs
-
-        result[k] = v
-
-    return result
-
-
 def partition[V](arr: list[V], pred: Callable[[V], bool]) -> tuple[list[V], list[V]]:
     matching: list[V] = []
     not_matching: list[V] = []
@@ -38,3 +33,73 @@ def partition[V](arr: list[V], pred: Callable[[V], bool]) -> tuple[list[V], list
             not_matching.append(v)
 
     return matching, not_matching
+
+
+# The ids of the subscribers on one side (Baserow or Buttondown) that may have
+# changed since the snapshot taken at `since`. Subscribers with any other id
+# are exactly as they were then. See `state.StateStore.changed_ids`.
+@dataclass(frozen=True)
+class ChangedIds:
+    since: datetime
+    ids: set[str]
+
+
+# Like `map(fn, items)`, but calls `fn` on up to `prefetch` items ahead of
+# the one being consumed, on a thread pool. Results are still produced in the
+# same order as `items`.
+def prefetch_map[T, R](
+    fn: Callable[[T], R], items: Iterable[T], prefetch: int
+) -> Iterator[R]:
+    assert prefetch >= 1
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        in_flight: deque[Future[R]] = deque(
+            pool.submit(fn, item) for item in islice(items, prefetch)
+        )
+        while len(in_flight) > 0:
+            result = in_flight.popleft().result()
+            for item in islice(items, 1):
+                in_flight.append(pool.submit(fn, item))
+            yield result
+
+
+# Write atomically, so a crash never leaves a truncated file behind.
+def write_atomically(path: Path, contents: str):
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        # `mkstemp` makes the file readable by us alone. Give it the
+        # permissions simply opening `path` would have, so that others (say,
+        # the node exporter's textfile collector) can read it too.
+        os.chmod(tmp_path, 0o666 & ~current_umask())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# There's no way to read the umask without setting it.
+def current_umask() -> int:
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# Most subscribers have one of a handful of combinations of tags. Rather than
+# keeping a copy of their tags per subscriber, share a single frozenset
+# between everyone with the same tags, on both the Baserow and the Buttondown
+# side. Comparing tags then usually comes down to checking whether they're the
+# same object.
+_interned_tags: dict[frozenset[str], frozenset[str]] = {}
+
+
+def intern_tags(tags: Iterable[str]) -> frozenset[str]:
+    frozen_tags = frozenset(tags)
+    return _interned_tags.setdefault(frozen_tags, frozen_tags)
+
+
+# Every subscriber has the same few metadata keys. Share them, too.
+def intern_keys[V](d: dict[str, V]) -> dict[str, V]:
+    return {sys.intern(k): v for k, v in d.items()}
@@ -0,0 +1,61 @@
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+from .util import prefetch_map, write_atomically
+
+
+def test_prefetch_map_preserves_order():
+    assert list(prefetch_map(lambda n: n * n, range(10), prefetch=3)) == [
+        n * n for n in range(10)
+    ]
+
+
+def test_prefetch_map_runs_ahead():
+    # The first item can't finish until a later item has started, which can
+    # only happen if we're fetching ahead.
+    later_item_started = threading.Event()
+
+    def fn(n: int) -> int:
+        if n == 0:
+            assert later_item_started.wait(timeout=5)
+        else:
+            later_item_started.set()
+        return n
+
+    assert list(prefetch_map(fn, range(5), prefetch=2)) == [0, 1, 2, 3, 4]
+
+
+def test_prefetch_map_propagates_errors():
+    def fn(n: int) -> int:
+        if n == 3:
+            raise ValueError("oh no")
+        return n
+
+    results = prefetch_map(fn, range(5), prefetch=2)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError, match="oh no"):
+        next(results)
+
+
+def test_write_atomically(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    path = tmp_path / "metrics.prom"
+    old_umask = os.umask(0o027)
+    try:
+        write_atomically(path, "hello")
+    finally:
+        os.umask(old_umask)
+    assert path.read_text() == "hello"
+    assert path.stat().st_mode & 0o777 == 0o640
+
+    # A failed write leaves the original alone, and nothing else behind.
+    def fail(src: str, dst: Path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError, match="disk full"):
+        write_atomically(path, "goodbye")
+    assert path.read_text() == "hello"
+    assert list(tmp_path.iterdir()) == [path]